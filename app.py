@@ -8,10 +8,12 @@ This script initializes the app and coordinates the UI, file processing, and log
 import streamlit as st
 import logging
 from ui import render_sidebar, render_main_page, apply_custom_css
-from config import MESSAGE_TYPES, ZIELNIVEAUS_MAP, LANGUAGES, MODEL_OPTIONS
-from file_processing import process_uploaded_files
+from config import MESSAGE_TYPES, ZIELNIVEAUS_MAP, LANGUAGES, MODEL_OPTIONS, AVOID_COVERED_QUESTIONS, STRUCTURED_OUTPUT
+from file_processing import process_uploaded_files, count_pdf_pages, images_size_bytes, pdf_uploads
 from openai_client import initialize_client
-from logic import generate_questions
+from logic import generate_questions, render_generation_job, render_cost_estimate
+from estimator import apply_image_plan
+from metrics import start_metrics_server
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -23,6 +25,9 @@ st.set_page_config(
 # --- Initialize Logging ---
 logging.basicConfig(level=logging.INFO)
 
+# --- Local Prometheus endpoint for per-stage metrics (once per server process) ---
+start_metrics_server()
+
 def main():
     """Main function to run the Streamlit application."""
     
@@ -33,7 +38,13 @@ def main():
 
     # --- API Key and Client Initialization ---
     api_key = st.text_input("🔑 Geben Sie Ihren OpenAI-API-Schlüssel ein", type="password", help="Ihr Schlüssel wird nicht gespeichert.")
-    client = initialize_client(api_key)
+    client = None
+    if api_key:
+        try:
+            client = initialize_client(api_key)
+            st.success("API-Schlüssel erfolgreich erkannt und OpenAI-Client verbunden.")
+        except Exception as e:
+            st.error(f"Fehler bei der Initialisierung des OpenAI-Clients: {e}")
 
     # --- Model, Language, and Level Selection ---
     col1, col2, col3 = st.columns(3)
@@ -57,27 +68,64 @@ def main():
 
     # --- File Upload and Processing ---
     uploaded_files = st.file_uploader(
-        "Laden Sie Inhalt hoch (1 PDF/DOCX oder bis zu 10 Bilder)",
+        "Laden Sie Inhalt hoch (mehrere PDF/DOCX-Dateien und bis zu 10 Bilder)",
         type=["pdf", "docx", "jpg", "jpeg", "png"],
         accept_multiple_files=True
     )
     
+    page_range = ""
+    # The same test as in process_uploaded_files, so the field is shown exactly when the range applies.
+    pdf_files = pdf_uploads(uploaded_files or [])
+    if len(pdf_files) == 1:
+        page_count = count_pdf_pages(pdf_files[0])
+        page_range = st.text_input(
+            f"Seitenbereich (PDF mit {page_count} Seiten, z.B. 1-5, 8; leer = alle Seiten):",
+            help="Nur die ausgewählten Seiten werden verarbeitet und an das Modell gesendet."
+        )
+
     text_content = ""
     image_content_list = []
     if uploaded_files:
         with st.spinner("Dateien werden verarbeitet..."):
-            text_content, image_content_list = process_uploaded_files(uploaded_files)
+            text_content, image_content_list = process_uploaded_files(uploaded_files, page_range, selected_model)
 
     # --- User Input Fields ---
     if image_content_list:
         st.success(f"{len(image_content_list)} Bild(er) erfolgreich geladen und verarbeitet.")
+        st.caption(f"Speicherbedarf der Bilder: {images_size_bytes(image_content_list) / 2**20:.1f} MB")
         cols = st.columns(min(len(image_content_list), 5))
         for idx, img in enumerate(image_content_list):
-            cols[idx % 5].image(img, use_column_width=True, caption=f"Bild {idx + 1}")
+            cols[idx % 5].image(img.thumbnail_bytes, use_column_width=True, caption=f"Bild {idx + 1}")
 
     user_input = st.text_area("Text zum Analysieren:", value=text_content, height=250, help="Fügen Sie hier Ihren Text ein oder er wird aus der hochgeladenen Datei extrahiert.")
     learning_goals = st.text_area("Lernziele (Optional):", height=100, help="Definieren Sie spezifische Lernziele, um die Fragengenerierung zu steuern.")
     selected_types = st.multiselect("Wählen Sie die Fragetypen:", MESSAGE_TYPES)
+    max_questions_per_type = st.number_input(
+        "Maximale Anzahl Fragen pro Typ (0 = unbegrenzt):", min_value=0, value=0, step=1,
+        help="Bei langen Dokumenten werden die Fragen aller Abschnitte zusammengeführt und auf diese Anzahl begrenzt."
+    )
+    avoid_covered = st.checkbox(
+        "Bereits abgedeckte Inhalte an später startende Fragetypen weitergeben", value=AVOID_COVERED_QUESTIONS,
+        help="Fragetypen, die nach anderen starten, erhalten deren Fragen und sollen andere Fakten abfragen. "
+             "Wirkt nur, wenn nicht alle Fragetypen gleichzeitig angefragt werden."
+    )
+    structured = st.checkbox(
+        "Strukturierte Ausgabe (JSON-Schema)", value=STRUCTURED_OUTPUT,
+        help="Das Modell liefert kompaktes JSON, das lokal ins OLAT-Format umgewandelt wird. "
+             "Spart Tokens und vermeidet Formatfehler; die Fragen erscheinen erst, wenn ein Fragetyp fertig ist."
+    )
+    budget = st.number_input(
+        "Kostenbudget pro Lauf in USD (0 = keine Vorgabe):", min_value=0.0, value=0.0, step=0.05, format="%.2f",
+        help="Detailstufe und Auflösung der Bilder werden so gewählt, dass die geschätzten Kosten im Budget bleiben."
+    )
+
+    # --- Pre-flight Cost Estimate ---
+    estimate = None
+    if selected_types and (user_input or image_content_list):
+        estimate = render_cost_estimate(
+            user_input, learning_goals, selected_types, image_content_list, selected_language, selected_model,
+            reasoning_effort, selected_zielniveau_text, structured=structured, budget=budget
+        )
 
     # --- Generation Button and Logic Execution ---
     if st.button("🚀 Fragen generieren", type="primary"):
@@ -93,12 +141,20 @@ def main():
                 user_input=user_input,
                 learning_goals=learning_goals,
                 selected_types=selected_types,
-                images=image_content_list,
+                # Images are only downscaled for the request, not on every rerun.
+                images=apply_image_plan(image_content_list, estimate.image_plan),
                 selected_language=selected_language,
                 selected_model=selected_model,
                 reasoning_effort=reasoning_effort,
-                selected_zielniveau=selected_zielniveau_text
+                selected_zielniveau=selected_zielniveau_text,
+                max_questions_per_type=max_questions_per_type,
+                avoid_covered=avoid_covered,
+                structured=structured,
+                image_detail=estimate.image_plan.detail
             )
+    else:
+        # A generation started in an earlier run keeps going in the background; show its progress and results.
+        render_generation_job()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
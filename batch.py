@@ -0,0 +1,122 @@
+# batch.py
+
+"""
+Runs large offline jobs through the OpenAI Batch API instead of synchronous requests.
+Requests are serialized into a JSONL file, submitted as one batch and polled until the batch
+finishes; the raw results then go through the regular post-processing.
+"""
+
+import json
+import logging
+import time
+from config import BATCH_POLL_INTERVAL, REPAIR_INVALID_QUESTIONS
+from core import repair_response
+from response_cache import get_response_cache
+
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def write_batch_file(requests, path):
+    """
+    Serializes requests (a dict of custom_id -> GenerationRequest) into a batch JSONL file.
+    Returns the API endpoint shared by all requests.
+    """
+    endpoints = set()
+    with open(path, "w", encoding="utf-8") as file:
+        for custom_id, request in requests.items():
+            endpoint, body = request.payload()
+            endpoints.add(endpoint)
+            line = {"custom_id": custom_id, "method": "POST", "url": endpoint, "body": body}
+            file.write(json.dumps(line, ensure_ascii=False) + "\n")
+    if len(endpoints) != 1:
+        raise ValueError("Ein Batch muss genau einen API-Endpunkt verwenden.")
+    return endpoints.pop()
+
+
+def submit_batch(client, path, endpoint):
+    """Uploads a batch file and starts the batch job."""
+    with open(path, "rb") as file:
+        batch_file = client.files.create(file=file, purpose="batch")
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint=endpoint, completion_window="24h")
+    logging.info(f"Batch {batch.id} gestartet.")
+    return batch
+
+
+def wait_for_batch(client, batch_id, poll_interval=BATCH_POLL_INTERVAL):
+    """Polls a batch until it has reached a final status and returns it."""
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in BATCH_FINAL_STATUSES:
+            return batch
+        counts = batch.request_counts
+        if counts:
+            logging.info(f"Batch {batch_id}: {batch.status}, {counts.completed}/{counts.total} erledigt, {counts.failed} fehlgeschlagen.")
+        else:
+            logging.info(f"Batch {batch_id}: {batch.status}")
+        time.sleep(poll_interval)
+
+
+def extract_output_text(body):
+    """Returns the generated text of a chat.completions or responses result body."""
+    if "choices" in body:
+        return body["choices"][0]["message"]["content"]
+    for item in reversed(body.get("output", [])):
+        if item.get("type") == "message" and item.get("role") == "assistant":
+            for content in item.get("content", []):
+                if content.get("type") == "output_text":
+                    return content.get("text")
+    return None
+
+
+def read_batch_results(client, batch):
+    """Downloads the results of a finished batch and returns a dict of custom_id -> raw response text."""
+    results = {}
+    if batch.output_file_id:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") == 200:
+                results[record["custom_id"]] = extract_output_text(response.get("body", {}))
+            else:
+                logging.error(f"Batch-Anfrage {record['custom_id']} fehlgeschlagen: {record.get('error') or response}")
+    if batch.error_file_id:
+        for line in client.files.content(batch.error_file_id).text.splitlines():
+            if line.strip():
+                record = json.loads(line)
+                logging.error(f"Batch-Anfrage {record.get('custom_id')} fehlgeschlagen: {record.get('error') or record.get('response')}")
+    return results
+
+
+def run_batch(client, requests, path, batch_id=None, on_submit=None, poll_interval=BATCH_POLL_INTERVAL):
+    """
+    Generates all requests (a dict of custom_id -> GenerationRequest) through the Batch API.
+    Pass `batch_id` to resume waiting for a batch submitted earlier; `on_submit` receives the id of a new batch.
+    Returns a dict of custom_id -> raw response text for every request that succeeded; map them to
+    OLAT text with core.postprocess_response (after merging chunks with chunking.merge_responses).
+    Raw responses are stored in the response cache, so the app and later runs can reuse them.
+    Invalid questions are repaired with small synchronous follow-up calls before caching.
+    """
+    if batch_id is None:
+        endpoint = write_batch_file(requests, path)
+        batch_id = submit_batch(client, path, endpoint).id
+        if on_submit:
+            on_submit(batch_id)
+
+    batch = wait_for_batch(client, batch_id, poll_interval)
+    if batch.status != "completed":
+        logging.error(f"Batch {batch_id} endete mit Status '{batch.status}'.")
+
+    cache = get_response_cache()
+    responses = {}
+    for custom_id, response in read_batch_results(client, batch).items():
+        request = requests.get(custom_id)
+        if request is None or not response:
+            continue
+        response = request.render(response)
+        if REPAIR_INVALID_QUESTIONS:
+            response, _ = repair_response(client, request, response)
+        cache.set(request.fingerprint(), response)
+        responses[custom_id] = response
+    return responses
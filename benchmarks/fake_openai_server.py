@@ -0,0 +1,395 @@
+# benchmarks/fake_openai_server.py
+
+"""
+A local stand-in for the OpenAI API, so that the app, the CLI and the batch mode can be
+exercised without spending real API money.
+
+Implements /v1/chat/completions, /v1/responses, /v1/files and /v1/batches and answers
+with canned OLAT or inline_fib output matching the requested question type. Requests with
+"stream": true are answered as server-sent events, one small text delta at a time. Requests
+with a JSON schema response format are answered with JSON that follows the schema.
+
+Usage:
+    python benchmarks/fake_openai_server.py --port 8765
+    python cli.py unterlagen/ -o fragen/ --api-key test --base-url http://127.0.0.1:8765/v1
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CANNED_QUESTIONS = {
+    "SC": (
+        "Typ\tSC\nLevel\tWissen\nFeedback correct answer\tRichtig!\nFeedback wrong answer\tFalsch.\n"
+        "Title\tBundesrat {n}\nQuestion\tWie viele Mitglieder hat der Bundesrat? ({n})\nPoints\t1\n"
+        "1\t7\n-0.5\t5\n-0.5\t6\n-0.5\t8"
+    ),
+    "MC": (
+        "Typ\tMC\nLevel\tVerstehen\nFeedback correct answer\tRichtig!\nFeedback wrong answer\tFalsch.\n"
+        "Title\tKantone {n}\nQuestion\tWofür sind die Kantone zuständig? ({n})\nMax answers\t4\nMin answers\t0\nPoints\t3\n"
+        "{scores[0]}\tBildung\n{scores[1]}\tPolizei\n{scores[2]}\tArmee\n{scores[3]}\tAussenpolitik"
+    ),
+    "KPRIM": (
+        "Typ\tKPRIM\nLevel\tAnalyse\nTitle\tWeltmeister {n}\n"
+        "Question\tDiese Länder haben die WM mehr als einmal gewonnen. ({n})\nPoints\t5\n"
+        "+\tDeutschland\n-\tSchweiz\n-\tNorwegen\n+\tUruguay"
+    ),
+    "Truefalse": (
+        "Typ\tTruefalse\nLevel\tWissen\nTitle\tHauptstädte {n}\nQuestion\tSind die Aussagen richtig oder falsch? ({n})\nPoints\t3\n"
+        "\tUnanswered\tRight\tWrong\nParis ist in Frankreich\t0\t1\t-0.5\nBern ist in der Schweiz\t0\t1\t-0.5\n"
+        "Stockholm ist in Dänemark\t0\t-0.5\t1"
+    ),
+    "Drag&Drop": (
+        "Typ\tDrag&drop\nLevel\tVerstehen\nTitle\tDelikte {n}\nQuestion\tOrdnen Sie die Deliktarten zu. ({n})\nPoints\t2\n"
+        "\tAntragsdelikt\tOffizialdelikt\nDiebstahl unter Angehörigen\t1\t-0.5\nMord\t-0.5\t1"
+    ),
+}
+
+CANNED_INLINE_FIB = {
+    "text": "Die direkte Demokratie der Schweiz erlaubt Referenden und Initiativen. Ein Referendum braucht 50000 "
+            "Unterschriften innerhalb von 100 Tagen. Eine Volksinitiative braucht 100000 Unterschriften innerhalb "
+            "von 18 Monaten. ({n})",
+    "blanks": ["Referenden", "50000", "100 Tagen", "100000", "18 Monaten"],
+    "wrong_substitutes": ["Wahlen", "10000", "1000 Tagen", "200000", "12 Monaten"],
+}
+
+# The type templates contain e.g. "Typ\\tKPRIM" as literal characters.
+TEMPLATE_TYPE_PATTERN = re.compile(r"Typ\\t(SC|MC|KPRIM|Truefalse|Drag&Drop)")
+# The answer scores of the MC templates, which differ between multiple_choice1, 2 and 3.
+TEMPLATE_SCORE_PATTERN = re.compile(r"\\n(-?\d+(?:\.\d+)?)\\t(?:in)?correct_answer_placeholder")
+
+
+def canned_output(prompt_text, questions=3):
+    """Returns canned model output in the format requested by the prompt."""
+    if "//JSON Output" in prompt_text:
+        items = [json.loads(json.dumps(CANNED_INLINE_FIB).replace("{n}", str(n))) for n in range(1, questions + 1)]
+        return "```json\n" + json.dumps(items, ensure_ascii=False, indent=2) + "\n```"
+    match = TEMPLATE_TYPE_PATTERN.search(prompt_text)
+    template = CANNED_QUESTIONS[match.group(1) if match else "SC"]
+    scores = TEMPLATE_SCORE_PATTERN.findall(prompt_text)[:4]
+    if len(scores) < 4:
+        scores = ["1.5", "1.5", "-0.5", "-0.5"]
+    return "\n\n".join(template.format(n=n, scores=scores) for n in range(1, questions + 1))
+
+
+# Item counts of the structured-output schemas, e.g. "Exactly 4 statements" or "2 to 5 drag items".
+SCHEMA_COUNT_PATTERN = re.compile(r"^(?:Exactly )?(\d+)")
+
+
+def schema_instance(schema, n):
+    """Builds a value that follows a structured-output schema, with array sizes taken from the descriptions."""
+    if schema["type"] == "object":
+        if set(schema["properties"]) == {"text", "blanks", "wrong_substitutes"}:
+            return json.loads(json.dumps(CANNED_INLINE_FIB).replace("{n}", str(n)))
+        return {name: schema_instance(value, n) for name, value in schema["properties"].items()}
+    if schema["type"] == "array":
+        match = SCHEMA_COUNT_PATTERN.match(schema.get("description", ""))
+        count = int(match.group(1)) if match else 3
+        return [schema_instance(schema["items"], n * 10 + i) for i in range(count)]
+    if schema["type"] == "boolean":
+        return n % 2 == 0
+    if schema["type"] == "integer":
+        return 0
+    return f"Text {n}"
+
+
+def response_schema_of(body):
+    """Returns the JSON schema of a structured-output request, or None for plain text requests."""
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return response_format["json_schema"]["schema"]
+    text_format = (body.get("text") or {}).get("format") or {}
+    return text_format.get("schema") if text_format.get("type") == "json_schema" else None
+
+
+def answer_text(body):
+    """Returns the canned answer to a request body: schema-conforming JSON or text in the requested format."""
+    schema = response_schema_of(body)
+    if schema:
+        return json.dumps(schema_instance(schema, 1), ensure_ascii=False)
+    return canned_output(prompt_text_of(body))
+
+
+def prompt_text_of(body):
+    """Concatenates all text parts of a chat.completions or responses request body."""
+    texts = []
+
+    def collect(value):
+        if isinstance(value, str):
+            texts.append(value)
+        elif isinstance(value, list):
+            for item in value:
+                collect(item)
+        elif isinstance(value, dict):
+            for key in ("content", "text"):
+                if key in value:
+                    collect(value[key])
+
+    collect(body.get("messages") or body.get("input") or [])
+    return "\n".join(texts)
+
+
+def chat_completion_body(model, text, prompt_tokens):
+    completion_tokens = max(1, len(text) // 4)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": text}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+def responses_body(model, text, prompt_tokens):
+    output_tokens = max(1, len(text) // 4)
+    return {
+        "id": f"resp_{uuid.uuid4().hex}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": "completed",
+        "model": model,
+        "output": [{"id": f"msg_{uuid.uuid4().hex}", "type": "message", "role": "assistant", "status": "completed",
+                    "content": [{"type": "output_text", "text": text, "annotations": []}]}],
+        "parallel_tool_calls": False,
+        "tool_choice": "auto",
+        "tools": [],
+        "usage": {"input_tokens": prompt_tokens, "output_tokens": output_tokens,
+                  "total_tokens": prompt_tokens + output_tokens,
+                  "input_tokens_details": {"cached_tokens": 0},
+                  "output_tokens_details": {"reasoning_tokens": 0}},
+    }
+
+
+def chunks_of(text, size=16):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def chat_stream_events(model, text, prompt_tokens, include_usage):
+    """Yields the chunk objects of a streamed chat completion."""
+    base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion.chunk",
+            "created": int(time.time()), "model": model}
+    yield dict(base, choices=[{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+    for piece in chunks_of(text):
+        yield dict(base, choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+    yield dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+    if include_usage:
+        usage = chat_completion_body(model, text, prompt_tokens)["usage"]
+        yield dict(base, choices=[], usage=usage)
+
+
+def responses_stream_events(model, text, prompt_tokens):
+    """Yields the events of a streamed responses API call."""
+    body = responses_body(model, text, prompt_tokens)
+    item_id = body["output"][0]["id"]
+    sequence = 0
+    yield {"type": "response.created", "sequence_number": sequence,
+           "response": dict(body, status="in_progress", output=[], usage=None)}
+    for piece in chunks_of(text):
+        sequence += 1
+        yield {"type": "response.output_text.delta", "sequence_number": sequence, "item_id": item_id,
+               "output_index": 0, "content_index": 0, "delta": piece}
+    yield {"type": "response.completed", "sequence_number": sequence + 1, "response": body}
+
+
+class FakeOpenAIState:
+    """Files and batches kept by the stub server."""
+
+    def __init__(self, batch_delay):
+        self.batch_delay = batch_delay
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def add_file(self, content, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        with self.lock:
+            self.files[file_id] = content
+        return {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": f"{file_id}.jsonl", "purpose": purpose, "status": "processed"}
+
+    def run_batch(self, input_file_id):
+        """Answers every line of a batch input file and stores the output file."""
+        lines = []
+        total = 0
+        for line in self.files[input_file_id].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            total += 1
+            record = json.loads(line)
+            body = record["body"]
+            text = answer_text(body)
+            prompt_tokens = max(1, len(prompt_text_of(body)) // 4)
+            if record["url"] == "/v1/responses":
+                response_body = responses_body(body.get("model"), text, prompt_tokens)
+            else:
+                response_body = chat_completion_body(body.get("model"), text, prompt_tokens)
+            lines.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": record["custom_id"],
+                "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": response_body},
+                "error": None,
+            }, ensure_ascii=False))
+        output = self.add_file(("\n".join(lines) + "\n").encode("utf-8"), "batch_output")
+        return output["id"], total
+
+    def create_batch(self, input_file_id, endpoint):
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        output_file_id, total = self.run_batch(input_file_id)
+        batch = {"id": batch_id, "object": "batch", "endpoint": endpoint, "input_file_id": input_file_id,
+                 "completion_window": "24h", "created_at": int(time.time()), "status": "in_progress",
+                 "output_file_id": None, "error_file_id": None,
+                 "request_counts": {"total": total, "completed": 0, "failed": 0}}
+        with self.lock:
+            self.batches[batch_id] = (batch, time.time() + self.batch_delay, output_file_id)
+        return batch
+
+    def get_batch(self, batch_id):
+        with self.lock:
+            batch, ready_at, output_file_id = self.batches[batch_id]
+        if time.time() >= ready_at:
+            batch = dict(batch, status="completed", output_file_id=output_file_id,
+                         request_counts=dict(batch["request_counts"], completed=batch["request_counts"]["total"]))
+        return batch
+
+
+def make_handler(state, latency, token_interval, rate_limit_rate):
+    class FakeOpenAIHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, payload, status=200):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_events(self, events):
+            """Sends events as server-sent events and closes the connection afterwards."""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            for event in events:
+                name = f"event: {event['type']}\n" if "type" in event else ""
+                self.wfile.write(f"{name}data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(token_interval)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+        def _read_body(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return self.rfile.read(length)
+
+        def do_POST(self):
+            raw = self._read_body()
+            if self.path.endswith("/files"):
+                message = BytesParser(policy=HTTP).parsebytes(
+                    f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + raw
+                )
+                fields = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                          for part in message.iter_parts()}
+                self._send_json(state.add_file(fields["file"], fields.get("purpose", b"batch").decode()))
+                return
+            body = json.loads(raw or b"{}")
+            if self.path.endswith("/batches"):
+                self._send_json(state.create_batch(body["input_file_id"], body["endpoint"]))
+                return
+
+            if random.random() < rate_limit_rate:
+                data = json.dumps({"error": {"message": "Rate limit reached (stub)", "type": "requests",
+                                             "code": "rate_limit_exceeded"}}).encode("utf-8")
+                self.send_response(429)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("retry-after-ms", "200")
+                self.end_headers()
+                self.wfile.write(data)
+                return
+
+            time.sleep(latency)
+            text = answer_text(body)
+            prompt_tokens = max(1, len(prompt_text_of(body)) // 4)
+            model = body.get("model")
+            if self.path.endswith("/chat/completions"):
+                if body.get("stream"):
+                    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+                    self._send_events(chat_stream_events(model, text, prompt_tokens, include_usage))
+                else:
+                    self._send_json(chat_completion_body(model, text, prompt_tokens))
+            elif self.path.endswith("/responses"):
+                if body.get("stream"):
+                    self._send_events(responses_stream_events(model, text, prompt_tokens))
+                else:
+                    self._send_json(responses_body(model, text, prompt_tokens))
+            else:
+                self._send_json({"error": {"message": f"Unbekannter Pfad {self.path}"}}, status=404)
+
+        def do_GET(self):
+            match = re.search(r"/batches/([^/]+)$", self.path)
+            if match:
+                self._send_json(state.get_batch(match.group(1)))
+                return
+            match = re.search(r"/files/([^/]+)/content$", self.path)
+            if match and match.group(1) in state.files:
+                data = state.files[match.group(1)]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            self._send_json({"error": {"message": f"Unbekannter Pfad {self.path}"}}, status=404)
+
+    return FakeOpenAIHandler
+
+
+def start_server(port=0, latency=0.0, batch_delay=0.0, token_interval=0.0, rate_limit_rate=0.0):
+    """
+    Starts the stub server in a background thread and returns it; its base URL is server.base_url.
+    `latency` delays every answer (time to first token), `token_interval` every streamed delta.
+    A share of `rate_limit_rate` of all model requests is answered with 429 and a Retry-After header.
+    """
+    state = FakeOpenAIState(batch_delay)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state, latency, token_interval, rate_limit_rate))
+    server.daemon_threads = True
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lokaler Stub-Server für die OpenAI API.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Sekunden Verzögerung pro Anfrage")
+    parser.add_argument("--batch-delay", type=float, default=2.0, help="Sekunden bis ein Batch fertig ist")
+    parser.add_argument("--token-interval", type=float, default=0.0,
+                        help="Sekunden Verzögerung zwischen zwei gestreamten Textstücken")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Anteil der Anfragen, die mit 429 (Rate Limit) beantwortet werden")
+    args = parser.parse_args()
+    server = start_server(args.port, args.latency, args.batch_delay, args.token_interval, args.rate_limit_rate)
+    print(f"Stub-Server läuft auf {server.base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
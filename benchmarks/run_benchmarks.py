@@ -0,0 +1,336 @@
+# benchmarks/run_benchmarks.py
+
+"""
+Offline benchmark suite for the question generator.
+All API calls go to the local stub in fake_openai_server.py, so no API money is spent.
+
+Scenarios:
+    large_pdf    process_uploaded_files on a generated text PDF (--pdf-pages pages)
+    images       process_uploaded_files on ten 12 MP photos, and process_image per photo
+    all_types    generate_questions for all eight MESSAGE_TYPES
+    sessions     --sessions concurrent generate_questions runs, as from several teachers at once
+    inline_fib   transform_inline_fib_output on a response with --fib-items questions, and
+                 write_inline_fib_olat streaming --fib-batch-items questions to a file
+    startup      cold start of a fresh interpreter importing the app, and reruns of app.py
+
+For every measured function the suite reports p50/p95 wall time, CPU time per call and the
+peak Python memory of one traced call, followed by p50/p95 of the internal stages recorded by
+metrics.py (extraction, image encoding, prompt assembly, API latency, parsing).
+
+Usage:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --scenarios all_types sessions --latency 0.5 --token-interval 0.01
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+# Keep the response cache and the metrics of benchmark runs away from the real ones.
+# These must be set before the application modules read config.py.
+WORK_DIR = tempfile.mkdtemp(prefix="olat-benchmark-")
+os.environ["OLAT_RESPONSE_CACHE_PATH"] = os.path.join(WORK_DIR, "responses.sqlite3")
+os.environ["OLAT_METRICS_LOG_PATH"] = os.path.join(WORK_DIR, "metrics.jsonl")
+os.environ["OLAT_METRICS_PORT"] = "0"
+
+import numpy as np  # noqa: E402  (installed with streamlit)
+import streamlit as st  # noqa: E402
+from PIL import Image  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+from config import MESSAGE_TYPES, ZIELNIVEAUS_MAP, METRICS_LOG_PATH  # noqa: E402
+from core import transform_inline_fib_output, write_inline_fib_olat  # noqa: E402
+from file_processing import process_uploaded_files  # noqa: E402
+from logic import generate_questions  # noqa: E402
+from openai_client import initialize_client  # noqa: E402
+from scheduler import RateLimitScheduler, set_scheduler  # noqa: E402
+from utils import process_image, clean_json_string  # noqa: E402
+import fake_openai_server  # noqa: E402
+
+# Time windows of the traced calls; tracemalloc distorts the stage timings recorded during them.
+TRACED_WINDOWS = []
+
+SOURCE_SENTENCE = "Die Schweiz hat 26 Kantone, eine direkte Demokratie und vier Landessprachen."
+
+
+class FakeUpload:
+    """Stands in for Streamlit's UploadedFile."""
+
+    def __init__(self, name, mime_type, data):
+        self.name = name
+        self.type = mime_type
+        self.file_id = f"{name}-{id(data)}"
+        self._data = data
+
+    def getvalue(self):
+        return self._data
+
+
+def make_text_pdf(pages, lines_per_page=45):
+    """Builds a PDF with `pages` pages of extractable text."""
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [{}] /Count {} >>".format(" ".join(f"{4 + 2 * i} 0 R" for i in range(pages)), pages),
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for page in range(pages):
+        content = "".join(
+            f"BT /F1 10 Tf 40 {800 - 16 * line} Td (Seite {page + 1}, Zeile {line + 1}: {SOURCE_SENTENCE}) Tj ET\n"
+            for line in range(lines_per_page)
+        )
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {5 + 2 * page} 0 R "
+                       f"/Resources << /Font << /F1 3 0 R >> >> >>")
+        objects.append(f"<< /Length {len(content)} >>\nstream\n{content}endstream")
+    output = "%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n{body}\nendobj\n"
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n"
+    output += "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return output.encode("latin-1")
+
+
+def make_photo(seed, width=4000, height=3000):
+    """Builds a noisy JPEG of phone-camera size, which compresses about as badly as a real photo."""
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def measure(function, iterations):
+    """Calls `function(i)` repeatedly and returns wall times, CPU time per call and the peak memory of one call."""
+    wall_times = []
+    cpu_start = time.process_time()
+    for i in range(iterations):
+        start = time.perf_counter()
+        function(i)
+        wall_times.append(time.perf_counter() - start)
+    cpu_per_call = (time.process_time() - cpu_start) / iterations
+
+    # Memory is traced in a separate call, since tracemalloc slows everything down.
+    tracemalloc.start()
+    traced_start = time.time()
+    function(iterations)
+    TRACED_WINDOWS.append((traced_start, time.time()))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"wall": wall_times, "cpu": cpu_per_call, "peak_bytes": peak}
+
+
+def percentile(values, fraction):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[round(fraction * 100) - 1]
+
+
+def clear_caches():
+    # Every iteration must do the full work instead of hitting the Streamlit caches.
+    st.cache_data.clear()
+
+
+def bench_large_pdf(args, client):
+    upload = FakeUpload("skript.pdf", "application/pdf", make_text_pdf(args.pdf_pages))
+
+    def run(_):
+        clear_caches()
+        process_uploaded_files([upload])
+    return {"process_uploaded_files (PDF)": measure(run, args.iterations)}
+
+
+def bench_images(args, client):
+    photos = [make_photo(seed) for seed in range(10)]
+    uploads = [FakeUpload(f"foto{i}.jpg", "image/jpeg", data) for i, data in enumerate(photos)]
+
+    def run_uploads(_):
+        clear_caches()
+        process_uploaded_files(uploads)
+
+    def run_process_image(i):
+        process_image(photos[i % len(photos)])
+    return {
+        "process_uploaded_files (10 Bilder)": measure(run_uploads, args.iterations),
+        "process_image": measure(run_process_image, args.iterations * len(photos)),
+    }
+
+
+def run_generation(client, args, tag, selected_types):
+    """Runs generate_questions and waits for its background job to finish."""
+    # A unique source text per call keeps the response cache out of the measurement.
+    job = generate_questions(
+        client=client,
+        user_input=f"{SOURCE_SENTENCE} ({tag})\n\n" + SOURCE_SENTENCE * args.source_sentences,
+        learning_goals="",
+        selected_types=selected_types,
+        images=[],
+        selected_language="German",
+        selected_model=args.model,
+        reasoning_effort="medium",
+        selected_zielniveau=list(ZIELNIVEAUS_MAP.values())[2],
+        structured=args.structured,
+    )
+    deadline = time.monotonic() + args.job_timeout
+    while not job.done:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Generierung '{tag}' nach {args.job_timeout:.0f} s nicht abgeschlossen.")
+        time.sleep(0.01)
+
+
+def bench_all_types(args, client):
+    def run(i):
+        run_generation(client, args, f"all_types {i} {time.time()}", MESSAGE_TYPES)
+    return {"generate_questions (8 Typen)": measure(run, args.iterations)}
+
+
+def bench_sessions(args, client):
+    def run(i):
+        threads = [
+            threading.Thread(target=run_generation, args=(client, args, f"session {i}/{s} {time.time()}", MESSAGE_TYPES))
+            for s in range(args.sessions)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return {f"generate_questions ({args.sessions} Sitzungen)": measure(run, args.iterations)}
+
+
+def bench_inline_fib(args, client):
+    response = fake_openai_server.canned_output("//JSON Output", questions=args.fib_items)
+
+    # A batch CLI run converts the questions of many parts at once.
+    items = json.loads(clean_json_string(fake_openai_server.canned_output("//JSON Output", questions=args.fib_batch_items)))
+    output_path = os.path.join(WORK_DIR, "inline_fib.txt")
+
+    def run(_):
+        transform_inline_fib_output(response)
+
+    def run_batch(_):
+        with open(output_path, "w", encoding="utf-8") as file:
+            write_inline_fib_olat(items, file)
+    return {
+        f"transform_inline_fib_output ({args.fib_items} Fragen)": measure(run, args.iterations * 10),
+        f"write_inline_fib_olat ({args.fib_batch_items} Fragen, Datei)": measure(run_batch, args.iterations),
+    }
+
+
+def bench_startup(args, client):
+    # Run from another directory, so the measurement also covers prompts found independently of the CWD.
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+
+    def interpreter(code):
+        def run(_):
+            subprocess.run([sys.executable, "-c", code], cwd=WORK_DIR, env=env, check=True, capture_output=True)
+        return run
+
+    app = AppTest.from_file(os.path.join(REPO_DIR, "app.py"), default_timeout=60)
+    app.run()
+
+    def run_rerun(_):
+        app.run()
+    return {
+        "Kaltstart: import streamlit": measure(interpreter("import streamlit"), args.iterations),
+        "Kaltstart: streamlit + App-Module": measure(
+            interpreter("import streamlit, ui, file_processing, openai_client, logic"), args.iterations
+        ),
+        "Rerun app.py (ohne Eingaben)": measure(run_rerun, args.iterations * 10),
+    }
+
+
+SCENARIOS = {
+    "large_pdf": bench_large_pdf,
+    "images": bench_images,
+    "all_types": bench_all_types,
+    "sessions": bench_sessions,
+    "inline_fib": bench_inline_fib,
+    "startup": bench_startup,
+}
+
+
+def stage_timings(log_path):
+    """Reads the stage durations recorded by metrics.py, grouped by stage."""
+    stages = {}
+    if not os.path.exists(log_path):
+        return stages
+    with open(log_path, encoding="utf-8") as file:
+        for line in file:
+            record = json.loads(line)
+            if any(start <= record["time"] <= end for start, end in TRACED_WINDOWS):
+                continue
+            if "stage" in record:
+                stages.setdefault(record["stage"], []).append(record["seconds"])
+    return stages
+
+
+def print_report(results, stages):
+    print(f"\n{'Messung':<42} {'n':>5} {'p50 ms':>10} {'p95 ms':>10} {'CPU ms':>10} {'Peak MB':>9}")
+    for name, result in results.items():
+        wall = result["wall"]
+        print(f"{name:<42} {len(wall):>5} {percentile(wall, 0.5) * 1000:>10.1f} {percentile(wall, 0.95) * 1000:>10.1f} "
+              f"{result['cpu'] * 1000:>10.1f} {result['peak_bytes'] / 2**20:>9.1f}")
+    if stages:
+        print(f"\n{'Stufe (metrics.py)':<42} {'n':>5} {'p50 ms':>10} {'p95 ms':>10}")
+        for stage, values in sorted(stages.items()):
+            print(f"{stage:<42} {len(values):>5} {percentile(values, 0.5) * 1000:>10.1f} {percentile(values, 0.95) * 1000:>10.1f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline-Benchmarks mit lokalem Stub-Server.")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--iterations", type=int, default=5, help="Wiederholungen pro Messung")
+    parser.add_argument("--latency", type=float, default=0.2, help="Sekunden bis zur ersten Antwort des Stubs")
+    parser.add_argument("--token-interval", type=float, default=0.002, help="Sekunden zwischen gestreamten Textstücken")
+    parser.add_argument("--model", default="gpt-4o", help="Modell der Anfragen (o4-mini nutzt die Responses API)")
+    parser.add_argument("--structured", action="store_true",
+                        help="Fragen im Modus 'strukturierte Ausgabe' generieren (JSON-Schema statt OLAT-Text)")
+    parser.add_argument("--sessions", type=int, default=4, help="Gleichzeitige Sitzungen im Szenario 'sessions'")
+    parser.add_argument("--pdf-pages", type=int, default=100)
+    parser.add_argument("--source-sentences", type=int, default=200, help="Länge des Quelltexts in Sätzen")
+    parser.add_argument("--fib-items", type=int, default=50)
+    parser.add_argument("--fib-batch-items", type=int, default=5000, help="Fragen pro Datei im Szenario 'inline_fib'")
+    parser.add_argument("--job-timeout", type=float, default=600, help="Sekunden, bis eine Generierung als hängend gilt")
+    parser.add_argument("--json", dest="json_path", help="Ergebnisse zusätzlich als JSON speichern")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # generate_questions runs without a Streamlit server here, so every st.* call from a worker
+    # thread would warn about its missing script run context.
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").disabled = True
+    server = fake_openai_server.start_server(latency=args.latency, token_interval=args.token_interval)
+    client = initialize_client("benchmark", base_url=server.base_url)
+    # The stub has no rate limits; configured ones would only measure the scheduler's pacing.
+    set_scheduler(RateLimitScheduler(limits={}, default_limit=None))
+
+    results = {}
+    for scenario in args.scenarios:
+        print(f"Szenario {scenario}...", file=sys.stderr)
+        results.update(SCENARIOS[scenario](args, client))
+    stages = stage_timings(METRICS_LOG_PATH)
+    print_report(results, stages)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as file:
+            json.dump({"results": results, "stages": stages, "args": vars(args)}, file, indent=2)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
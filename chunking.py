@@ -0,0 +1,172 @@
+# chunking.py
+
+"""
+Token-budgeted chunking of long source texts and merging of the per-chunk responses.
+Long documents are split at heading and paragraph (page) boundaries, every chunk is sent
+as its own request, and the resulting questions are merged and deduplicated afterwards.
+"""
+
+import json
+import math
+import re
+from utils import clean_json_string
+from streaming import split_olat_blocks
+
+# Word pieces and single punctuation marks, roughly how BPE tokenizers split text.
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+# Average number of characters a tokenizer packs into one token of a long word.
+CHARS_PER_TOKEN = 4
+HEADING_PATTERN = re.compile(r"^(#{1,6}\s|\d+(\.\d+)*\.?\s+\S|[A-ZÄÖÜ][^.!?:;]{0,80}$)")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text):
+    """Estimates the number of tokens of a text without calling a tokenizer."""
+    return sum(math.ceil(len(piece) / CHARS_PER_TOKEN) for piece in TOKEN_PATTERN.findall(text))
+
+
+def _is_heading(paragraph):
+    return "\n" not in paragraph and len(paragraph) <= 100 and bool(HEADING_PATTERN.match(paragraph))
+
+
+def _sections(text):
+    """Splits text into sections, each starting at a heading and made of paragraphs."""
+    sections = []
+    for paragraph in (p.strip() for p in re.split(r"\n\s*\n", text)):
+        if not paragraph:
+            continue
+        if not sections or _is_heading(paragraph):
+            sections.append([paragraph])
+        else:
+            sections[-1].append(paragraph)
+    return sections
+
+
+def _split_oversized(paragraph, token_budget):
+    """Splits a paragraph that alone exceeds the budget at sentence, then word boundaries."""
+    pieces = []
+    current = []
+    current_tokens = 0
+    for sentence in SENTENCE_PATTERN.split(paragraph):
+        units = [sentence] if estimate_tokens(sentence) <= token_budget else sentence.split()
+        for unit in units:
+            unit_tokens = estimate_tokens(unit)
+            if current and current_tokens + unit_tokens > token_budget:
+                pieces.append(" ".join(current))
+                current, current_tokens = [], 0
+            current.append(unit)
+            current_tokens += unit_tokens
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def chunk_text(text, token_budget):
+    """
+    Splits text into chunks of at most `token_budget` estimated tokens.
+    Sections (a heading and its paragraphs) are kept together whenever they fit.
+    """
+    if estimate_tokens(text) <= token_budget:
+        return [text]
+
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            chunks.append("\n\n".join(current))
+        current, current_tokens = [], 0
+
+    for section in _sections(text):
+        section_text = "\n\n".join(section)
+        section_tokens = estimate_tokens(section_text)
+        if section_tokens > token_budget:
+            # Too large to keep together: continue paragraph by paragraph.
+            units = []
+            for paragraph in section:
+                if estimate_tokens(paragraph) > token_budget:
+                    units.extend(_split_oversized(paragraph, token_budget))
+                else:
+                    units.append(paragraph)
+            # Never leave a heading behind on its own: it belongs to the text that follows it.
+            if len(units) > 1 and _is_heading(section[0]):
+                units[:2] = [f"{units[0]}\n\n{units[1]}"]
+        else:
+            units = [section_text]
+
+        for unit in units:
+            unit_tokens = estimate_tokens(unit)
+            if current and current_tokens + unit_tokens > token_budget:
+                flush()
+            current.append(unit)
+            current_tokens += unit_tokens
+    flush()
+    return chunks
+
+
+def _normalize(text):
+    return re.sub(r"\W+", " ", text.lower()).strip()
+
+
+def _olat_question_key(block):
+    """Returns the part of an OLAT block that identifies the question: its Question, else its Title."""
+    fields = {}
+    for line in block.split("\n"):
+        name, _, value = line.partition("\t")
+        fields.setdefault(name.strip(), value)
+    return _normalize(fields.get("Question") or fields.get("Title") or block)
+
+
+def merge_responses(msg_type, responses, max_questions=0):
+    """
+    Merges the raw responses of several chunks into one raw response of the same format.
+    Questions that appear more than once are dropped, and at most `max_questions`
+    questions are kept (0 keeps all).
+    """
+    responses = [response for response in responses if response]
+    if not responses:
+        return None
+    if len(responses) == 1 and not max_questions:
+        return responses[0]
+
+    if msg_type == "inline_fib":
+        per_response = []
+        for response in responses:
+            try:
+                data = json.loads(clean_json_string(response))
+            except json.JSONDecodeError:
+                continue
+            per_response.append(data if isinstance(data, list) else [data])
+        unique = _select(per_response, lambda item: _normalize(item.get("text", "")), max_questions)
+        return json.dumps(unique, ensure_ascii=False, indent=2)
+
+    # Keep responses the block splitter cannot make sense of instead of dropping them.
+    per_response = [split_olat_blocks(response) or [response.strip()] for response in responses]
+    return "\n\n".join(_select(per_response, _olat_question_key, max_questions))
+
+
+def _select(per_response, key, max_questions):
+    """
+    Drops duplicate questions and keeps at most `max_questions` of them.
+    Questions are picked round-robin across chunks, so a capped result covers the whole
+    document, and are returned in document order.
+    """
+    positions = [
+        (position, chunk_index)
+        for position in range(max((len(items) for items in per_response), default=0))
+        for chunk_index, items in enumerate(per_response)
+        if position < len(items)
+    ]
+    seen = set()
+    selected = []
+    for position, chunk_index in positions:
+        item_key = key(per_response[chunk_index][position])
+        if item_key in seen:
+            continue
+        seen.add(item_key)
+        selected.append((chunk_index, position))
+        if max_questions and len(selected) == max_questions:
+            break
+    return [per_response[chunk_index][position] for chunk_index, position in sorted(selected)]
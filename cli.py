@@ -0,0 +1,312 @@
+# cli.py
+
+"""
+Headless batch generation of OLAT questions, without Streamlit.
+
+Generates questions for every PDF, DOCX and image file in a directory, for a matrix of
+question types, Zielniveaus and languages, and writes one OLAT text file per source.
+Finished requests are kept in OUTPUT/.parts, so an interrupted run resumes where it stopped.
+With --batch, the requests are sent through the OpenAI Batch API instead of synchronous calls.
+
+Example:
+    python cli.py unterlagen/ --output fragen/ --types single_choice kprim --levels B1 B2 --languages Deutsch
+"""
+
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from batch import run_batch
+from chunking import merge_responses
+from config import MESSAGE_TYPES, ZIELNIVEAUS_MAP, LANGUAGES, MODEL_OPTIONS, MAX_CONCURRENT_REQUESTS, BATCH_POLL_INTERVAL, CHUNK_TOKEN_BUDGET, STRUCTURED_OUTPUT
+from core import GenerationRequest, cached_response, chunk_request, generate_response, write_postprocessed_response
+from documents import SOURCE_EXTENSIONS, load_source_file
+from openai_client import initialize_client
+
+PARTS_DIRNAME = ".parts"
+BATCH_FILENAME = "batch_requests.jsonl"
+BATCH_ID_FILENAME = "batch_id.txt"
+
+
+def level_code(label):
+    """Returns the short code of a Zielniveau label, e.g. 'B1'."""
+    return label.split()[0]
+
+
+def resolve_levels(codes):
+    """Maps short level codes (or 'all') to the Zielniveau labels of ZIELNIVEAUS_MAP."""
+    labels = {level_code(label).upper(): label for label in ZIELNIVEAUS_MAP}
+    if "all" in codes:
+        return list(ZIELNIVEAUS_MAP)
+    unknown = [code for code in codes if code.upper() not in labels]
+    if unknown:
+        raise ValueError(f"Unbekannte Zielniveaus: {', '.join(unknown)}")
+    return [labels[code.upper()] for code in codes]
+
+
+def resolve_languages(names):
+    """Maps language names (German UI names or English API names) to the API language names."""
+    known = {key.lower(): value for key, value in LANGUAGES.items()}
+    known.update({value.lower(): value for value in LANGUAGES.values()})
+    unknown = [name for name in names if name.lower() not in known]
+    if unknown:
+        raise ValueError(f"Unbekannte Sprachen: {', '.join(unknown)}")
+    return [known[name.lower()] for name in names]
+
+
+def find_sources(source_dir):
+    """Returns all supported source files below `source_dir`, sorted for a deterministic order."""
+    sources = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if name.lower().endswith(SOURCE_EXTENSIONS):
+                sources.append(os.path.join(root, name))
+    return sources
+
+
+def source_name(source_dir, path):
+    """Returns a flat, file-system-safe name for a source, unique within `source_dir`."""
+    relative = os.path.splitext(os.path.relpath(path, source_dir))[0]
+    return relative.replace(os.sep, "__")
+
+
+@contextmanager
+def open_atomic(path):
+    """Opens a file for writing so that an interrupted run never leaves a truncated result behind."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            yield file
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def write_atomic(path, text):
+    """Writes a file atomically, see open_atomic."""
+    with open_atomic(path) as file:
+        file.write(text)
+
+
+def finish_part(msg_type, responses, part_path, max_questions):
+    """Merges the chunk responses of one part and streams the converted OLAT text to its part file."""
+    merged = merge_responses(msg_type, responses, max_questions)
+    with open_atomic(part_path) as file:
+        write_postprocessed_response(msg_type, merged, file)
+
+
+def run_with_pool(client, pending, workers, max_questions):
+    """
+    Runs pending parts (part_id -> (chunk requests, part_path)) in a thread pool and returns the number of failed parts.
+    All chunks of all parts share the pool; a part is written once all of its chunks have succeeded.
+    """
+    responses = {part_id: [None] * len(requests) for part_id, (requests, _) in pending.items()}
+    remaining = {part_id: len(requests) for part_id, (requests, _) in pending.items()}
+    failed = set()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(generate_response, client, request): (part_id, index)
+            for part_id, (requests, _) in pending.items()
+            for index, request in enumerate(requests)
+        }
+        for index, future in enumerate(as_completed(futures), start=1):
+            part_id, chunk_index = futures[future]
+            requests, part_path = pending[part_id]
+            label = part_id if len(requests) == 1 else f"{part_id} (Abschnitt {chunk_index + 1}/{len(requests)})"
+            try:
+                response, from_cache = future.result()
+                if not response:
+                    raise RuntimeError("Keine Antwort vom Modell erhalten.")
+                responses[part_id][chunk_index] = response
+                logging.info(f"[{index}/{len(futures)}] {label} fertig{' (Cache)' if from_cache else ''}")
+            except Exception as e:
+                failed.add(part_id)
+                logging.error(f"[{index}/{len(futures)}] {label} fehlgeschlagen: {e}")
+            remaining[part_id] -= 1
+            if remaining[part_id] == 0 and part_id not in failed:
+                try:
+                    finish_part(requests[0].msg_type, responses[part_id], part_path, max_questions)
+                except ValueError as e:
+                    failed.add(part_id)
+                    logging.error(f"{part_id}: Antwort konnte nicht verarbeitet werden: {e}")
+    return len(failed)
+
+
+def run_with_batch(client, pending, parts_dir, poll_interval, max_questions):
+    """
+    Runs pending parts through the OpenAI Batch API and returns the number of failed parts.
+    Cached chunks are not sent again; the id of a submitted batch is kept so that an
+    interrupted run resumes waiting for the same batch instead of submitting it again.
+    """
+    responses = {}
+    uncached = {}
+    for part_id, (requests, _) in pending.items():
+        responses[part_id] = [cached_response(request) for request in requests]
+        for index, request in enumerate(requests):
+            if not responses[part_id][index]:
+                uncached[f"{part_id}#{index}"] = request
+
+    if uncached:
+        os.makedirs(parts_dir, exist_ok=True)
+        batch_id_path = os.path.join(parts_dir, BATCH_ID_FILENAME)
+        batch_id = None
+        if os.path.exists(batch_id_path):
+            with open(batch_id_path, encoding="utf-8") as file:
+                batch_id = file.read().strip() or None
+            logging.info(f"Setze Batch {batch_id} fort.")
+
+        results = run_batch(
+            client, uncached, os.path.join(parts_dir, BATCH_FILENAME), batch_id=batch_id,
+            on_submit=lambda new_batch_id: write_atomic(batch_id_path, new_batch_id),
+            poll_interval=poll_interval,
+        )
+        for custom_id, response in results.items():
+            part_id, _, index = custom_id.rpartition("#")
+            responses[part_id][int(index)] = response
+        if os.path.exists(batch_id_path):
+            os.remove(batch_id_path)
+
+    failures = 0
+    for part_id, (requests, part_path) in pending.items():
+        if not all(responses[part_id]):
+            failures += 1
+            continue
+        try:
+            finish_part(requests[0].msg_type, responses[part_id], part_path, max_questions)
+            logging.info(f"{part_id} fertig")
+        except ValueError as e:
+            failures += 1
+            logging.error(f"{part_id}: Antwort konnte nicht verarbeitet werden: {e}")
+    return failures
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Generiert OLAT-Fragen für alle Dateien eines Verzeichnisses.")
+    parser.add_argument("source_dir", help="Verzeichnis mit PDF-, DOCX- und Bilddateien")
+    parser.add_argument("--output", "-o", required=True, help="Zielverzeichnis für die OLAT-Textdateien")
+    parser.add_argument("--types", nargs="+", default=MESSAGE_TYPES, choices=MESSAGE_TYPES, metavar="TYPE",
+                        help="Fragetypen (Standard: alle)")
+    parser.add_argument("--levels", nargs="+", default=["B2"],
+                        help="Zielniveaus als Kürzel, z.B. A2 B1, oder 'all' (Standard: B2)")
+    parser.add_argument("--languages", nargs="+", default=["Deutsch"], help="Sprachen (Standard: Deutsch)")
+    parser.add_argument("--model", default=MODEL_OPTIONS[0], choices=MODEL_OPTIONS)
+    parser.add_argument("--reasoning-effort", default="medium", choices=["low", "medium", "high"],
+                        help="Nur für o4-mini")
+    parser.add_argument("--learning-goals", default="", help="Optionale Lernziele für alle Quellen")
+    parser.add_argument("--workers", type=int, default=MAX_CONCURRENT_REQUESTS,
+                        help="Anzahl paralleler Anfragen")
+    parser.add_argument("--max-questions", type=int, default=0,
+                        help="Maximale Anzahl Fragen pro Typ und Quelle (0 = unbegrenzt)")
+    parser.add_argument("--chunk-tokens", type=int, default=CHUNK_TOKEN_BUDGET,
+                        help="Längere Texte werden in Abschnitte dieser Grösse (geschätzte Tokens) aufgeteilt")
+    parser.add_argument("--pages", default="",
+                        help="Nur diese Seiten von PDFs verarbeiten, z.B. '1-5, 8' (Standard: alle Seiten)")
+    parser.add_argument("--structured", action="store_true", default=STRUCTURED_OUTPUT,
+                        help="Kompaktes JSON nach Schema anfordern und das OLAT-Format lokal erzeugen")
+    parser.add_argument("--batch", action="store_true",
+                        help="Anfragen über die OpenAI Batch API senden (günstiger, bis zu 24 h Laufzeit)")
+    parser.add_argument("--batch-poll-interval", type=float, default=BATCH_POLL_INTERVAL,
+                        help="Sekunden zwischen zwei Statusabfragen des Batches")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"),
+                        help="OpenAI-API-Schlüssel (Standard: $OPENAI_API_KEY)")
+    parser.add_argument("--base-url", default=os.environ.get("OPENAI_BASE_URL"),
+                        help="Alternative API-URL, z.B. ein lokaler Stub-Server")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    try:
+        levels = resolve_levels(args.levels)
+        languages = resolve_languages(args.languages)
+    except ValueError as e:
+        logging.error(e)
+        return 2
+    client = initialize_client(args.api_key, base_url=args.base_url)
+    if not client:
+        logging.error("Bitte geben Sie einen OpenAI-API-Schlüssel an (--api-key oder OPENAI_API_KEY).")
+        return 2
+
+    sources = find_sources(args.source_dir)
+    if not sources:
+        logging.error(f"Keine unterstützten Dateien in {args.source_dir} gefunden.")
+        return 1
+    parts_dir = os.path.join(args.output, PARTS_DIRNAME)
+
+    def load(path):
+        try:
+            return load_source_file(path, args.pages)
+        except ValueError as e:
+            logging.error(f"{path}: {e}")
+            return "", []
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        loaded = dict(zip(sources, executor.map(load, sources)))
+
+    # Part files in the order they appear in each source's output file.
+    source_parts = {}
+    pending = {}
+    skipped = 0
+    for path in sources:
+        text, images = loaded[path]
+        if not (text or images):
+            logging.warning(f"Kein Inhalt in {path} gefunden, übersprungen.")
+            continue
+        name = source_name(args.source_dir, path)
+        source_parts[name] = []
+        for level in levels:
+            for language in languages:
+                for msg_type in args.types:
+                    part_name = f"{level_code(level)}_{language}_{msg_type}"
+                    part_path = os.path.join(parts_dir, name, f"{part_name}.txt")
+                    source_parts[name].append(part_path)
+                    if os.path.exists(part_path):
+                        skipped += 1
+                        continue
+                    request = GenerationRequest(
+                        msg_type=msg_type,
+                        user_input=text,
+                        learning_goals=args.learning_goals,
+                        images=tuple(images),
+                        language=language,
+                        model=args.model,
+                        reasoning_effort=args.reasoning_effort,
+                        zielniveau=ZIELNIVEAUS_MAP[level],
+                        structured=args.structured,
+                    )
+                    pending[f"{name}/{part_name}"] = (chunk_request(request, args.chunk_tokens), part_path)
+
+    if skipped:
+        logging.info(f"{skipped} bereits erledigte Anfragen werden übersprungen.")
+    if args.batch:
+        try:
+            failures = run_with_batch(client, pending, parts_dir, args.batch_poll_interval, args.max_questions)
+        except Exception as e:
+            logging.error(f"Batch-Verarbeitung fehlgeschlagen: {e}")
+            failures = len(pending)
+    else:
+        failures = run_with_pool(client, pending, args.workers, args.max_questions)
+
+    for name, part_paths in source_parts.items():
+        if not all(os.path.exists(part_path) for part_path in part_paths):
+            logging.warning(f"{name}: unvollständig, erneut ausführen, um fehlende Teile nachzuholen.")
+            continue
+        with open_atomic(os.path.join(args.output, f"{name}.txt")) as output:
+            for index, part_path in enumerate(part_paths):
+                with open(part_path, encoding="utf-8") as file:
+                    output.write(("\n\n" if index else "") + file.read().strip())
+            output.write("\n")
+        logging.info(f"{name}: {os.path.join(args.output, name + '.txt')} geschrieben.")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
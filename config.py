@@ -4,6 +4,8 @@
 Stores application-wide constants and configurations.
 """
 
+import os
+
 # A list of all available question types that the application can generate.
 MESSAGE_TYPES = [
     "single_choice",
@@ -36,4 +38,124 @@ LANGUAGES = {
 }
 
 # Available OpenAI models for question generation.
-MODEL_OPTIONS = ["gpt-4o", "gpt-4.1", "o4-mini"]
\ No newline at end of file
+MODEL_OPTIONS = ["gpt-4o", "gpt-4.1", "o4-mini"]
+
+# Requests and tokens per minute allowed for each model. The limits depend on the organisation's
+# usage tier, so none are assumed: requests are only paused when the API reports a rate limit.
+# To pace requests ahead of it, enter your limits, e.g. {"gpt-4o": {"rpm": 500, "tpm": 30000}};
+# every API key is scheduled within budgets of its own.
+MODEL_RATE_LIMITS = {}
+DEFAULT_RATE_LIMIT = None
+# Tokens reserved for the answer of a request until its actual usage is known.
+EXPECTED_COMPLETION_TOKENS = 2000
+# OpenAI list prices in USD per million tokens (update them when they change) and typical latencies
+# (seconds to the first token, output tokens per second), used for the cost estimate before a run.
+MODEL_PRICING = {
+    "gpt-4o": {"input": 2.50, "output": 10.00},
+    "gpt-4.1": {"input": 2.00, "output": 8.00},
+    "o4-mini": {"input": 1.10, "output": 4.40},
+}
+MODEL_LATENCY = {
+    "gpt-4o": {"first_token": 0.8, "tokens_per_second": 80},
+    "gpt-4.1": {"first_token": 0.8, "tokens_per_second": 75},
+    "o4-mini": {"first_token": 2.0, "tokens_per_second": 110},
+}
+# Hidden reasoning tokens of an o4-mini request per reasoning effort; they are billed as output.
+REASONING_TOKEN_ESTIMATES = {"low": 1000, "medium": 3000, "high": 8000}
+# Longest image sides (px) the estimator may downscale images to, so that a run stays within the
+# user's cost budget (see estimator.py).
+IMAGE_DOWNSCALE_SIZES = (1024, 768, 512)
+# Retries of rate-limited or failed API requests, with jittered exponential backoff (seconds).
+MAX_API_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+# Upper bound on the number of requests one generation runs against the OpenAI API in parallel.
+# Lower this if your API key runs into rate limits.
+MAX_CONCURRENT_REQUESTS = 4
+# Generations run as background jobs on one worker pool per server: at most GENERATION_WORKERS
+# requests of all sessions run at the same time. Finished jobs and their export files are kept for
+# JOB_RETENTION_SECONDS, so a reloaded tab can still show their results; open sessions poll them
+# every JOB_POLL_INTERVAL seconds.
+GENERATION_WORKERS = 8
+JOB_RETENTION_SECONDS = 60 * 60
+JOB_POLL_INTERVAL = 1.0
+
+
+# Persistent response cache shared by all sessions on this server.
+# Entries are evicted least-recently-used once the cache exceeds its size budget or maximum age.
+RESPONSE_CACHE_PATH = os.environ.get(
+    "OLAT_RESPONSE_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "responses.sqlite3"),
+)
+RESPONSE_CACHE_MAX_BYTES = 200 * 1024 * 1024
+RESPONSE_CACHE_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+
+# Number of questions per page of the result preview; the full output is only offered as download
+# (OLAT text files and a QTI 2.1 package, see export.py).
+PREVIEW_PAGE_SIZE = 20
+
+# Stream responses token by token and show finished questions while the rest is still being generated.
+STREAM_RESPONSES = True
+
+# Seconds between two status checks of a submitted OpenAI batch job (CLI batch mode).
+BATCH_POLL_INTERVAL = 30
+
+# Questions that violate the format of their type are re-requested in one small follow-up call
+# per response, at most REPAIR_MAX_QUESTIONS of them; larger failures are kept as they are.
+REPAIR_INVALID_QUESTIONS = True
+REPAIR_MAX_QUESTIONS = 5
+
+# Structured-output mode: the model answers with compact JSON following a schema per question type
+# and the OLAT text is rendered locally (see structured.py). Structured responses are not streamed.
+STRUCTURED_OUTPUT = False
+
+# Source texts longer than this (estimated tokens) are split into chunks that are generated separately.
+CHUNK_TOKEN_BUDGET = 6000
+
+# Connection pool of the shared HTTP client per API key. Clients unused for
+# HTTP_CLIENT_IDLE_SECONDS are closed.
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 10
+HTTP_KEEPALIVE_EXPIRY = 120
+HTTP_CLIENT_IDLE_SECONDS = 30 * 60
+
+# PDFs with at least PDF_PARALLEL_MIN_PAGES pages are read by up to PDF_WORKERS processes,
+# PDF_PAGES_PER_TASK pages at a time.
+PDF_WORKERS = min(4, os.cpu_count() or 1)
+PDF_PARALLEL_MIN_PAGES = 24
+PDF_PAGES_PER_TASK = 8
+# Several uploaded documents are extracted by up to DOCUMENT_WORKERS threads, at most
+# MAX_UPLOAD_DOCUMENTS PDF/DOCX files and MAX_UPLOAD_IMAGES images per run.
+DOCUMENT_WORKERS = 4
+MAX_UPLOAD_DOCUMENTS = 20
+MAX_UPLOAD_IMAGES = 10
+
+# Upper bound for the compressed images kept per user session (model images plus previews).
+MAX_SESSION_IMAGE_BYTES = 40 * 1024 * 1024
+
+# Near-duplicate images (overlapping photos, repeated scanned pages) and blank pages are found
+# before the API call: "drop" removes them, "flag" only reports them, "off" disables the check.
+IMAGE_DEDUPE_MODE = "drop"
+# Images whose 256-bit difference hashes differ in at most this many bits (about 10%) count as
+# duplicates; distinct text pages differ in about a quarter of their bits.
+DHASH_MAX_DISTANCE = 25
+# Images whose grayscale preview has a lower standard deviation (0-255) count as blank.
+BLANK_IMAGE_STDDEV = 4.0
+
+# Generated questions are compared across types and chunks with a local MinHash index; stems whose
+# estimated Jaccard similarity (character 5-grams) reaches SIMILARITY_THRESHOLD are reported as duplicates.
+SIMILARITY_THRESHOLD = 0.5
+# If enabled, requests that start after other types have finished list up to MAX_COVERED_QUESTIONS
+# of their questions, so the model asks about other facts. Their cache keys then depend on which
+# types finished first.
+AVOID_COVERED_QUESTIONS = False
+MAX_COVERED_QUESTIONS = 30
+
+# Per-stage metrics: every measurement is appended to METRICS_LOG_PATH (JSON lines, empty disables)
+# and served in Prometheus text format on 127.0.0.1:METRICS_PORT (0 disables).
+METRICS_LOG_PATH = os.environ.get(
+    "OLAT_METRICS_LOG_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "metrics.jsonl"),
+)
+METRICS_PORT = int(os.environ.get("OLAT_METRICS_PORT", "9464"))
@@ -0,0 +1,352 @@
+# core.py
+
+"""
+UI-free core API for question generation.
+Both the Streamlit app and the batch CLI build on these functions; nothing here touches st.*.
+"""
+
+import json
+import logging
+import random
+from dataclasses import dataclass, replace
+import metrics
+import validation
+from chunking import chunk_text
+from config import CHUNK_TOKEN_BUDGET, REPAIR_INVALID_QUESTIONS, REPAIR_MAX_QUESTIONS
+from utils import read_prompt_from_md, clean_json_string, replace_german_sharp_s
+from openai_client import get_chatgpt_response, build_request_payload, SYSTEM_PROMPT
+from response_cache import get_response_cache, request_fingerprint
+from similarity import covered_prompt
+from structured import response_schema, structured_prompt, render_response
+from singleflight import SingleFlight
+
+# Identical requests from concurrent sessions share one API call.
+_in_flight = SingleFlight()
+
+
+@dataclass(frozen=True)
+class GenerationRequest:
+    """Everything needed to generate the questions of one type for one source."""
+    msg_type: str
+    user_input: str
+    learning_goals: str
+    images: tuple
+    language: str
+    model: str
+    reasoning_effort: str
+    zielniveau: str
+    # Stems of questions already generated for other types (see similarity.covered_prompt).
+    covered_questions: tuple = ()
+    # Ask for JSON following the type's schema and render the OLAT text locally (see structured.py).
+    structured: bool = False
+    # Detail level of the images ("low", "high" or "auto"); None keeps the default (see openai_client).
+    image_detail: str = None
+
+    def prompt_template(self):
+        """
+        Returns the prompt template of the type, with the instructions of the structured mode and
+        the already covered questions, if any.
+        """
+        template = read_prompt_from_md(self.msg_type)
+        if self.structured:
+            template = structured_prompt(template)
+        if self.covered_questions:
+            template += covered_prompt(self.covered_questions)
+        return template
+
+    def response_schema(self):
+        return response_schema(self.msg_type) if self.structured else None
+
+    def render(self, response):
+        """Converts a raw API answer into the text format of the type (a no-op unless structured)."""
+        return render_response(self.msg_type, response) if self.structured and response else response
+
+    def payload(self):
+        """Returns the endpoint and body of the API request, e.g. for batch files."""
+        return build_request_payload(
+            self.prompt_template(), self.user_input, self.model, list(self.images), self.language,
+            self.reasoning_effort, self.zielniveau, learning_goals=self.learning_goals,
+            response_schema=self.response_schema(), image_detail=self.image_detail
+        )
+
+    def fingerprint(self):
+        """Returns the response cache key of this request."""
+        return request_fingerprint(
+            prompt_template=self.prompt_template(),
+            user_input=self.user_input,
+            learning_goals=self.learning_goals,
+            image_digests=[img.digest for img in self.images],
+            model=self.model,
+            language=self.language,
+            zielniveau=self.zielniveau,
+            reasoning_effort=self.reasoning_effort,
+            system_prompt=SYSTEM_PROMPT,
+            image_detail=self.image_detail,
+        )
+
+
+def chunk_request(request, token_budget=CHUNK_TOKEN_BUDGET):
+    """
+    Splits a request whose source text exceeds `token_budget` into one request per chunk.
+    Images are attached to the first chunk only, so they are paid for once.
+    """
+    chunks = chunk_text(request.user_input, token_budget)
+    if len(chunks) <= 1:
+        return [request]
+    return [
+        replace(request, user_input=chunk, images=request.images if index == 0 else ())
+        for index, chunk in enumerate(chunks)
+    ]
+
+
+def display_title(msg_type):
+    """Returns the user-facing title for a question type."""
+    return msg_type.replace('_', ' ').title()
+
+
+def cached_response(request):
+    """Returns the cached raw response for a request, or None."""
+    response = get_response_cache().get(request.fingerprint())
+    metrics.count("response_cache_lookups", result="hit" if response else "miss",
+                  msg_type=request.msg_type, model=request.model)
+    return response
+
+
+def repair_response(client, request, response, on_usage=None):
+    """
+    Validates every question of a raw response against the rules of its type and re-requests only
+    the invalid ones in one follow-up call, whose corrected questions replace them in place.
+    Returns the (possibly) repaired response and the number of repaired questions. Questions that
+    are still invalid after the repair, or when the repair call fails, are kept unchanged.
+    """
+    questions = validation.split_questions(request.msg_type, response)
+    if not questions:
+        return response, 0
+    invalid = validation.find_invalid(request.msg_type, questions)
+    if not invalid:
+        return validation.join_questions(request.msg_type, questions), 0
+    metrics.count("invalid_questions", len(invalid))
+    if len(invalid) > REPAIR_MAX_QUESTIONS:
+        logging.warning(f"{len(invalid)} ungültige Fragen ({request.msg_type}), zu viele für eine Nachbesserung.")
+        return validation.join_questions(request.msg_type, questions), 0
+
+    try:
+        with metrics.timed("repair"):
+            repaired = get_chatgpt_response(
+                client, validation.repair_prompt(request.msg_type, len(invalid)),
+                validation.repair_input(request.msg_type, questions, invalid), request.model, [],
+                request.language, request.reasoning_effort, request.zielniveau, on_usage=on_usage
+            )
+    except Exception as e:
+        logging.warning(f"Nachbesserung ungültiger Fragen ({request.msg_type}) fehlgeschlagen: {e}")
+        return validation.join_questions(request.msg_type, questions), 0
+
+    replacements = validation.split_questions(request.msg_type, repaired or "") or []
+    repaired_count = 0
+    for index, replacement in zip(sorted(invalid), replacements):
+        if not validation.find_invalid(request.msg_type, [replacement]):
+            questions[index] = replacement
+            repaired_count += 1
+    metrics.count("repaired_questions", repaired_count)
+    logging.info(f"{repaired_count} von {len(invalid)} ungültigen Fragen nachgebessert ({request.msg_type}).")
+    return validation.join_questions(request.msg_type, questions), repaired_count
+
+
+def generate_response(client, request, on_delta=None, on_usage=None, use_cache=True, on_repair=None):
+    """
+    Returns the raw model response for a request and whether it came from the response cache.
+    Fresh responses are stored in the cache. Identical requests running at the same time, e.g. from
+    several sessions on the same worksheet, share one API call. API errors are raised to the caller.
+    Invalid questions of a fresh response are repaired (see repair_response) before it is cached;
+    `on_repair` is called with the number of repaired questions.
+    Structured requests are not streamed: their JSON is rendered into OLAT text once it is complete.
+    """
+    fingerprint = request.fingerprint()
+    if request.structured:
+        on_delta = None
+    with metrics.labels(msg_type=request.msg_type, model=request.model):
+        if use_cache:
+            response = cached_response(request)
+            if response:
+                return response, True
+
+        def call_api(on_delta):
+            # An identical call may have finished between the cache lookup above and this one.
+            response = get_response_cache().get(fingerprint) if use_cache else None
+            if response:
+                return response
+            response = get_chatgpt_response(
+                client, request.prompt_template(), request.user_input, request.model, list(request.images),
+                request.language, request.reasoning_effort, request.zielniveau, learning_goals=request.learning_goals,
+                on_delta=on_delta, on_usage=on_usage, response_schema=request.response_schema(),
+                image_detail=request.image_detail
+            )
+            response = request.render(response)
+            if response and REPAIR_INVALID_QUESTIONS:
+                response, repaired_count = repair_response(client, request, response, on_usage=on_usage)
+                if repaired_count and on_repair:
+                    on_repair(repaired_count)
+            # Stored before the call is released, so later identical requests find it in the cache.
+            if response and use_cache:
+                get_response_cache().set(fingerprint, response)
+            return response
+
+        response, shared = _in_flight.do(fingerprint, call_api, on_delta)
+        if shared:
+            metrics.count("coalesced_requests")
+            logging.info(f"Antwort einer identischen, bereits laufenden Anfrage übernommen ({request.msg_type}).")
+    return response, False
+
+
+FIB_HEADER = (
+    "Type\tFIB\n"
+    "Title\t✏️ Vervollständigen Sie die Lücken mit dem korrekten Begriff. ✏️\n"
+    "Points\t"
+)
+INLINE_CHOICE_HEADER = (
+    "Type\tInlinechoice\n"
+    "Title\tWörter einordnen\n"
+    "Question\t✏️ Wählen Sie die richtigen Wörter. ✏️\n"
+    "Points\t"
+)
+
+
+def find_blanks(text, blanks):
+    """
+    Locates the blanks of an inline_fib text and returns the text split at them: a list of
+    (text_part, blank) pairs in text order, the last one with blank None.
+    Every blank takes its first occurrence that is not taken by another blank, so a blank listed
+    twice takes two occurrences and overlapping blanks (e.g. 'Bund' and 'Bundesrat') are placed
+    longest first. Blanks that do not occur in the text are left out.
+    """
+    try:
+        # Usually every blank occurs in the text and the first occurrences do not overlap.
+        segments = _split_at(text, sorted([(text.find(blank), blank) for blank in blanks]))
+    except TypeError:
+        # Numbers in the JSON, e.g. "blanks": [1848, ...]
+        blanks = [str(blank) for blank in blanks]
+        segments = None
+    if segments is not None:
+        return segments
+
+    spans = []
+    for blank in sorted(filter(None, blanks), key=len, reverse=True):
+        start = text.find(blank)
+        while start != -1 and any(s < start + len(blank) and start < s + len(b) for s, b in spans):
+            start = text.find(blank, start + 1)
+        if start != -1:
+            spans.append((start, blank))
+    return _split_at(text, sorted(spans))
+
+
+def _split_at(text, spans):
+    """Splits text at sorted (offset, blank) spans; returns None if a span is missing, empty or overlapping."""
+    segments = []
+    cursor = 0
+    for start, blank in spans:
+        if start < cursor or not blank:
+            return None
+        segments.append((text[cursor:start], blank))
+        cursor = start + len(blank)
+    segments.append((text[cursor:], None))
+    return segments
+
+
+def _parsed_items(json_input):
+    data = json.loads(json_input) if isinstance(json_input, str) else json_input
+    return data if isinstance(data, list) else [data]
+
+
+def _convert_items(items):
+    """Yields the FIB and the Inlinechoice text of every item; each text is tokenized once."""
+    for item in items:
+        blanks = item.get("blanks", [])
+        *gaps, (tail, _) = find_blanks(str(item.get("text", "")), blanks)
+        gaps = [(part.strip(), blank) for part, blank in gaps]
+        tail = f"Text\t{tail.strip()}\n"
+        options = blanks + item.get("wrong_substitutes", [])
+        random.shuffle(options)
+        try:
+            options = "|".join(options)
+        except TypeError:
+            options = "|".join(map(str, options))
+        points = f"{len(gaps)}\n"
+        yield (
+            FIB_HEADER + points + "".join([f"Text\t{part}\n1\t{blank}\t20\n" for part, blank in gaps]) + tail,
+            INLINE_CHOICE_HEADER + points
+            + "".join([f"Text\t{part}\n1\t{options}\t{blank}\t|\n" for part, blank in gaps]) + tail,
+        )
+
+
+def write_inline_fib_olat(json_input, sink):
+    """
+    Streams the OLAT text of inline_fib items (a JSON string or parsed list) to a file-like `sink`:
+    all Inlinechoice questions, a '---' line, then all FIB questions, with 'ß' replaced by 'ss'.
+    Only the FIB part is held back until the Inlinechoice part has been written.
+    Raises ValueError (json.JSONDecodeError) if `json_input` is a string that is not valid JSON.
+    """
+    fib_texts = []
+    for index, (fib_text, ic_text) in enumerate(_convert_items(_parsed_items(json_input))):
+        sink.write(replace_german_sharp_s(ic_text if not index else "\n" + ic_text))
+        fib_texts.append(fib_text)
+    sink.write("---\n")
+    for index, fib_text in enumerate(fib_texts):
+        sink.write(replace_german_sharp_s(fib_text if not index else "\n" + fib_text))
+
+
+def convert_json_to_text_format(json_input):
+    """
+    Converts JSON from inline/FIB questions to OLAT text format; returns the FIB and the Inlinechoice text.
+    Raises ValueError if `json_input` is a string that is not valid JSON.
+    """
+    converted = list(_convert_items(_parsed_items(json_input)))
+    return (
+        "\n".join(fib_text for fib_text, _ in converted).rstrip("\n"),
+        "\n".join(ic_text for _, ic_text in converted).rstrip("\n"),
+    )
+
+
+def transform_inline_fib_output(json_string):
+    """
+    Transforms the JSON output for inline/FIB questions into OLAT text.
+    Raises ValueError (json.JSONDecodeError) if the response contains no valid JSON.
+    """
+    fib_output, ic_output = convert_json_to_text_format(clean_json_string(json_string))
+    return replace_german_sharp_s(f"{ic_output}\n---\n{fib_output}")
+
+
+def postprocess_response(msg_type, response):
+    """Converts a raw API response into the final OLAT text of its question type."""
+    with metrics.timed("parsing", msg_type=msg_type):
+        if msg_type == "inline_fib":
+            return transform_inline_fib_output(response)
+        return replace_german_sharp_s(response)
+
+
+def iter_olat_questions(msg_type, response):
+    """
+    Yields the final OLAT text of every question of a raw response as (section, text) pairs, in the
+    order of postprocess_response: for inline_fib all Inlinechoice questions (section "Inlinechoice"),
+    then all FIB questions (section "FIB"); the questions of other types have the section None.
+    A response that cannot be split into questions is yielded as one question.
+    Raises ValueError (json.JSONDecodeError) if an inline_fib response contains no valid JSON.
+    """
+    if msg_type == "inline_fib":
+        fib_texts = []
+        for fib_text, ic_text in _convert_items(_parsed_items(clean_json_string(response))):
+            yield "Inlinechoice", replace_german_sharp_s(ic_text.rstrip("\n"))
+            fib_texts.append(fib_text)
+        for fib_text in fib_texts:
+            yield "FIB", replace_german_sharp_s(fib_text.rstrip("\n"))
+        return
+    for block in validation.split_questions(msg_type, response) or [response]:
+        yield None, replace_german_sharp_s(block.strip("\n"))
+
+
+def write_postprocessed_response(msg_type, response, sink):
+    """Like postprocess_response, but streams the OLAT text to a file-like `sink`."""
+    with metrics.timed("parsing", msg_type=msg_type):
+        if msg_type == "inline_fib":
+            write_inline_fib_olat(clean_json_string(response), sink)
+        else:
+            sink.write(replace_german_sharp_s(response))
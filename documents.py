@@ -0,0 +1,248 @@
+# documents.py
+
+"""
+UI-free extraction of text and images from PDF, DOCX and image files.
+Used by the Streamlit upload handling and by the batch CLI.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import metrics
+from config import PDF_WORKERS, PDF_PARALLEL_MIN_PAGES, PDF_PAGES_PER_TASK, DOCUMENT_WORKERS
+from image_dedupe import dedupe_images
+from utils import encode_image, MAX_IMAGE_SIZE
+
+PDF_EXTENSIONS = (".pdf",)
+DOCX_EXTENSIONS = (".docx",)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+SOURCE_EXTENSIONS = PDF_EXTENSIONS + DOCX_EXTENSIONS + IMAGE_EXTENSIONS
+
+# PyPDF2, python-docx, pdf2image and multiprocessing are imported by the functions that use them,
+# so that importing this module stays cheap until a file of the corresponding type is uploaded.
+
+
+def pdf_page_count(file_bytes):
+    """Returns the number of pages of a PDF file."""
+    import PyPDF2
+
+    return len(PyPDF2.PdfReader(io.BytesIO(file_bytes)).pages)
+
+
+def parse_page_range(spec, page_count):
+    """
+    Parses a page selection like "1-5, 8" into a tuple of 0-based page indexes in page order.
+    An empty selection selects all pages. Raises ValueError for invalid selections.
+    """
+    if not spec or not spec.strip():
+        return tuple(range(page_count))
+    pages = set()
+    for part in spec.split(","):
+        match = re.fullmatch(r"\s*(\d+)\s*(?:-\s*(\d+)\s*)?", part)
+        if not match:
+            raise ValueError(f"Ungültiger Seitenbereich: '{part.strip()}'")
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if not 1 <= first <= last <= page_count:
+            raise ValueError(f"Seitenbereich '{part.strip()}' liegt ausserhalb der Seiten 1-{page_count}.")
+        pages.update(range(first - 1, last))
+    return tuple(sorted(pages))
+
+
+def _read_page_texts(file_bytes, page_indexes):
+    """Extracts the text of the given pages, calling extract_text() once per page."""
+    import PyPDF2
+
+    reader = PyPDF2.PdfReader(io.BytesIO(file_bytes))
+    return [reader.pages[index].extract_text() or "" for index in page_indexes]
+
+
+def _render_pages(file_bytes, page_indexes):
+    """
+    Rasterizes the given pages straight to the size sent to the model and encodes them.
+    Consecutive pages are rendered by one pdftoppm call; at most one run is held in memory.
+    """
+    from pdf2image import convert_from_bytes
+
+    encoded = []
+    runs = []
+    for index in page_indexes:
+        if runs and runs[-1][1] == index - 1:
+            runs[-1][1] = index
+        else:
+            runs.append([index, index])
+    for first, last in runs:
+        for page in convert_from_bytes(file_bytes, first_page=first + 1, last_page=last + 1, size=MAX_IMAGE_SIZE):
+            encoded.append(encode_image(page))
+            page.close()
+    return encoded
+
+
+# The PDF handed to each worker process once, instead of once per task.
+_worker_file_bytes = None
+
+
+def _init_worker(file_bytes):
+    global _worker_file_bytes
+    _worker_file_bytes = file_bytes
+
+
+def _run_in_worker(function, page_indexes):
+    return function(_worker_file_bytes, page_indexes)
+
+
+def _map_pages(function, file_bytes, page_indexes):
+    """
+    Applies `function(file_bytes, page_indexes)` to batches of PDF_PAGES_PER_TASK pages and yields
+    its results in page order. Long documents are processed by a pool of worker processes.
+    """
+    batches = [page_indexes[i:i + PDF_PAGES_PER_TASK] for i in range(0, len(page_indexes), PDF_PAGES_PER_TASK)]
+    if len(page_indexes) < PDF_PARALLEL_MIN_PAGES or PDF_WORKERS <= 1:
+        for batch in batches:
+            yield from function(file_bytes, batch)
+        return
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Spawned workers do not inherit the threads of the Streamlit server.
+    with ProcessPoolExecutor(
+        max_workers=min(PDF_WORKERS, len(batches)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(file_bytes,),
+    ) as executor:
+        for result in executor.map(partial(_run_in_worker, function), batches):
+            yield from result
+
+
+def _selected_pages(file_bytes, pages):
+    return list(range(pdf_page_count(file_bytes))) if pages is None else list(pages)
+
+
+def read_pdf_text(file_bytes, pages=None):
+    """
+    Extracts text from a PDF file using PyPDF2; pages are separated by blank lines.
+    `pages` is a sequence of 0-based page indexes (see parse_page_range); None reads all pages.
+    """
+    with metrics.timed("extraction", source="pdf"):
+        texts = _map_pages(_read_page_texts, file_bytes, _selected_pages(file_bytes, pages))
+        return "\n\n".join(text for text in texts if text).strip()
+
+
+def _docx_block_texts(element):
+    """Yields the text of a paragraph, or one line per table row with the cells separated by ' | '."""
+    from docx.oxml.ns import qn
+    from docx.text.paragraph import Paragraph
+
+    if element.tag == qn("w:p"):
+        yield Paragraph(element, None).text
+    elif element.tag == qn("w:tbl"):
+        for row in element.iterchildren(qn("w:tr")):
+            cells = []
+            for cell in row.iterchildren(qn("w:tc")):
+                text = " ".join(Paragraph(p, None).text for p in cell.iter(qn("w:p"))).strip()
+                # Merged cells repeat their text in python-docx; here they appear once, as in the document.
+                if text and (not cells or cells[-1] != text):
+                    cells.append(text)
+            if cells:
+                yield " | ".join(cells)
+
+
+def iter_docx_text(file_bytes):
+    """
+    Yields the non-empty text blocks of a DOCX file: first the distinct page header texts, then
+    the paragraphs and table rows of the body in document order.
+    """
+    import docx
+
+    doc = docx.Document(io.BytesIO(file_bytes))
+    headers = []
+    for section in doc.sections:
+        header = section.header
+        if header.is_linked_to_previous:
+            continue
+        text = "\n".join(paragraph.text for paragraph in header.paragraphs).strip()
+        if text and text not in headers:
+            headers.append(text)
+    yield from headers
+    for element in doc.element.body.iterchildren():
+        for text in _docx_block_texts(element):
+            if text.strip():
+                yield text
+
+
+def read_docx_text(file_bytes):
+    """Extracts the header, paragraph and table text of a DOCX file (see iter_docx_text)."""
+    with metrics.timed("extraction", source="docx"):
+        return "\n".join(iter_docx_text(file_bytes)).strip()
+
+
+def iter_pdf_page_images(file_bytes, pages=None):
+    """Yields the selected PDF pages one by one as encoded (downscaled JPEG) images."""
+    yield from _map_pages(_render_pages, file_bytes, _selected_pages(file_bytes, pages))
+
+
+def render_pdf_pages(file_bytes, pages=None):
+    """Converts the selected PDF pages to a list of encoded (downscaled JPEG) images."""
+    with metrics.timed("extraction", source="pdf_pages"):
+        return list(iter_pdf_page_images(file_bytes, pages))
+
+
+def _without_duplicates(path, images):
+    result = dedupe_images(images)
+    if result.found:
+        logging.info(f"{path}: {len(result.duplicates)} fast identische und {len(result.blanks)} leere Seite(n) gefunden.")
+    return result.images
+
+
+def file_digest(file_bytes):
+    """Returns a content digest of a file, computed once per upload and used as its cache key."""
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+
+def extract_document(file_bytes, extension, pages=None):
+    """
+    Extracts the text and images of one PDF or DOCX document; returns (text, images, rendered).
+    PDFs without extractable text fall back to their rendered pages, in which case `rendered` is true.
+    `pages` limits PDFs to the selected 0-based page indexes.
+    """
+    if extension in PDF_EXTENSIONS:
+        text = read_pdf_text(file_bytes, pages)
+        return (text, [], False) if text else ("", render_pdf_pages(file_bytes, pages), True)
+    if extension in DOCX_EXTENSIONS:
+        return read_docx_text(file_bytes), [], False
+    raise ValueError(f"Nicht unterstützter Dokumenttyp: {extension}")
+
+
+def map_documents(function, documents, workers=DOCUMENT_WORKERS):
+    """
+    Calls `function(document)` for every document on a pool of up to `workers` threads and returns
+    the results in input order. Long PDFs additionally use the process pool of _map_pages.
+    """
+    if len(documents) <= 1 or workers <= 1:
+        return [function(document) for document in documents]
+    with ThreadPoolExecutor(max_workers=min(workers, len(documents)), thread_name_prefix="documents") as executor:
+        return list(executor.map(function, documents))
+
+
+def load_source_file(path, page_range=""):
+    """
+    Loads a single source file from disk and returns its text and encoded images.
+    PDFs without extractable text fall back to their rendered pages, without near-duplicate and blank
+    pages (see image_dedupe.py). `page_range` (e.g. "1-5, 8") limits PDFs to the selected pages.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, "rb") as file:
+        file_bytes = file.read()
+
+    if extension in IMAGE_EXTENSIONS:
+        return "", [encode_image(file_bytes)]
+    if extension not in PDF_EXTENSIONS + DOCX_EXTENSIONS:
+        raise ValueError(f"Nicht unterstützter Dateityp: {path}")
+    pages = parse_page_range(page_range, pdf_page_count(file_bytes)) if extension in PDF_EXTENSIONS else None
+    text, images, rendered = extract_document(file_bytes, extension, pages)
+    return text, _without_duplicates(path, images) if rendered else images
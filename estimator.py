@@ -0,0 +1,142 @@
+# estimator.py
+
+"""
+Local pre-flight estimate of the tokens, cost and duration of a generation run, per model.
+Input tokens are predicted from the type templates, the chunked source text and the sizes of the
+encoded images; nothing is sent to the API. With a cost budget, the image detail level and the
+downscale target are chosen so that the estimate stays within it.
+"""
+
+import math
+from dataclasses import dataclass, replace
+from chunking import estimate_tokens
+from config import (
+    MODEL_OPTIONS, MODEL_PRICING, MODEL_LATENCY, MODEL_RATE_LIMITS, DEFAULT_RATE_LIMIT, EXPECTED_COMPLETION_TOKENS,
+    REASONING_TOKEN_ESTIMATES, IMAGE_DOWNSCALE_SIZES, MAX_CONCURRENT_REQUESTS, CHUNK_TOKEN_BUDGET,
+)
+from core import chunk_request
+from openai_client import SYSTEM_PROMPT, DEFAULT_CHAT_IMAGE_DETAIL, image_tokens
+from utils import MAX_IMAGE_SIZE, scaled_size, downscale_image
+
+
+@dataclass(frozen=True)
+class ImagePlan:
+    """How the images of a run are sent: detail level (None = the model's default) and longest side in px."""
+    detail: str = None
+    max_size: int = MAX_IMAGE_SIZE
+
+    @property
+    def label(self):
+        return f"{self.detail or 'Standard'}, max. {self.max_size} px"
+
+
+DEFAULT_IMAGE_PLAN = ImagePlan()
+
+
+def image_plans(model):
+    """
+    Returns the image plans the budget planner chooses from for `model`: the default plan first,
+    then ever cheaper ones, so that a budget never raises the cost of the images.
+    """
+    smaller_sizes = [size for size in IMAGE_DOWNSCALE_SIZES if size < DEFAULT_IMAGE_PLAN.max_size]
+    if model == "o4-mini":
+        # o4-mini charges image patches whatever the detail, so only the resolution changes the cost.
+        return [DEFAULT_IMAGE_PLAN] + [ImagePlan(None, size) for size in smaller_sizes]
+    if DEFAULT_CHAT_IMAGE_DETAIL == "low":
+        # Low detail costs the same few tokens at any size; there is nothing cheaper to step down to.
+        return [DEFAULT_IMAGE_PLAN]
+    return [DEFAULT_IMAGE_PLAN] + [ImagePlan("high", size) for size in smaller_sizes] + [ImagePlan("low", MAX_IMAGE_SIZE)]
+
+
+def apply_image_plan(images, plan):
+    """Returns the images downscaled to the plan's longest side."""
+    return [downscale_image(image, plan.max_size) for image in images]
+
+
+@dataclass(frozen=True)
+class RunProfile:
+    """The model-independent part of a run: the text tokens of every request and the image sizes."""
+    text_tokens: tuple   # one entry per type and chunk
+    image_requests: int  # requests that carry the images: the first chunk of every type
+    image_sizes: tuple   # (width, height) of every image
+    reasoning_effort: str
+
+
+@dataclass(frozen=True)
+class RunEstimate:
+    """Estimated totals of a run with one model and image plan."""
+    model: str
+    image_plan: ImagePlan
+    requests: int
+    input_tokens: int
+    image_tokens: int  # part of input_tokens
+    output_tokens: int
+    cost: float        # USD, without prompt-cache discounts and cached responses
+    seconds: float
+
+
+def profile_run(base_request, selected_types, token_budget=CHUNK_TOKEN_BUDGET):
+    """Returns the RunProfile of generating `selected_types` from the source of `base_request`."""
+    chunks = chunk_request(base_request, token_budget)
+    # Tokens of the parts every request shares; the estimate is additive over whitespace-separated parts.
+    shared_tokens = estimate_tokens(f"{SYSTEM_PROMPT}\n{base_request.learning_goals}\n{base_request.zielniveau}")
+    chunk_tokens = [estimate_tokens(chunk.user_input) for chunk in chunks]
+    text_tokens = []
+    for msg_type in selected_types:
+        template_tokens = estimate_tokens(replace(base_request, msg_type=msg_type).prompt_template())
+        text_tokens += [shared_tokens + template_tokens + tokens for tokens in chunk_tokens]
+    return RunProfile(
+        text_tokens=tuple(text_tokens),
+        image_requests=len(selected_types) if base_request.images else 0,
+        image_sizes=tuple((image.width, image.height) for image in base_request.images),
+        reasoning_effort=base_request.reasoning_effort,
+    )
+
+
+def estimate_run(profile, model, image_plan=DEFAULT_IMAGE_PLAN, max_concurrency=MAX_CONCURRENT_REQUESTS):
+    """Estimates tokens, cost and duration of a profiled run with `model` and `image_plan`."""
+    per_request_images = sum(
+        image_tokens(model, *scaled_size(width, height, image_plan.max_size), image_plan.detail)
+        for width, height in profile.image_sizes
+    )
+    requests = len(profile.text_tokens)
+    images = per_request_images * profile.image_requests
+    input_tokens = sum(profile.text_tokens) + images
+    completion_tokens = EXPECTED_COMPLETION_TOKENS
+    if model == "o4-mini":
+        completion_tokens += REASONING_TOKEN_ESTIMATES.get(profile.reasoning_effort, 0)
+    output_tokens = completion_tokens * requests
+    pricing = MODEL_PRICING[model]
+    latency = MODEL_LATENCY[model]
+    request_seconds = latency["first_token"] + completion_tokens / latency["tokens_per_second"]
+    # Requests run in waves of max_concurrency; beyond the first minute a configured token rate limit paces them.
+    seconds = math.ceil(requests / max(1, max_concurrency)) * request_seconds
+    limit = MODEL_RATE_LIMITS.get(model, DEFAULT_RATE_LIMIT)
+    if limit is not None:
+        seconds = max(seconds, 60 * max(0, input_tokens + output_tokens - limit["tpm"]) / limit["tpm"])
+    return RunEstimate(
+        model=model,
+        image_plan=image_plan,
+        requests=requests,
+        input_tokens=input_tokens,
+        image_tokens=images,
+        output_tokens=output_tokens,
+        cost=(input_tokens * pricing["input"] + output_tokens * pricing["output"]) / 1_000_000,
+        seconds=seconds,
+    )
+
+
+def plan_run(profile, model, budget=0, max_concurrency=MAX_CONCURRENT_REQUESTS):
+    """
+    Returns the estimate of the first plan of image_plans whose cost stays within `budget` (USD),
+    or of the cheapest plan if none does. Without a budget (0) or images, the default plan is kept.
+    """
+    if budget <= 0 or not profile.image_sizes:
+        return estimate_run(profile, model, DEFAULT_IMAGE_PLAN, max_concurrency)
+    estimates = [estimate_run(profile, model, plan, max_concurrency) for plan in image_plans(model)]
+    return next((estimate for estimate in estimates if estimate.cost <= budget), min(estimates, key=lambda e: e.cost))
+
+
+def estimate_models(profile, budget=0, models=MODEL_OPTIONS, max_concurrency=MAX_CONCURRENT_REQUESTS):
+    """Returns the planned estimate (see plan_run) of the run for every model."""
+    return [plan_run(profile, model, budget, max_concurrency) for model in models]
@@ -0,0 +1,146 @@
+# export.py
+
+"""
+Streaming export of generated questions.
+As the types of a run finish, their questions are written one at a time to files in a temporary
+directory: one OLAT text file per type and a QTI 2.1 package (zip) with one item per question.
+Only the question being written is held in memory; the byte range of every question is recorded,
+so previews read one page of questions at a time instead of the whole output.
+No Streamlit calls are made here.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+import metrics
+import qti
+from core import display_title, iter_olat_questions
+
+QTI_FILENAME = "fragen_qti21.zip"
+COMBINED_FILENAME = "alle_antworten.txt"
+
+
+class QuestionExport:
+    """
+    The export files of one generation run. `add_type` may be called from several threads as
+    types finish; `close` completes the QTI package and writes the combined text file of all types
+    in the order of `selected_types`. `discard` removes the files.
+    """
+
+    def __init__(self, selected_types, title="OLAT Fragen"):
+        self.directory = tempfile.mkdtemp(prefix="olat_export_")
+        self.selected_types = list(selected_types)
+        self.title = title
+        self.qti_path = os.path.join(self.directory, QTI_FILENAME)
+        self.combined_path = os.path.join(self.directory, COMBINED_FILENAME)
+        self.closed = False
+        self._lock = threading.Lock()
+        # Items are added to the zip as they are converted; it is only readable after close().
+        self._zip = zipfile.ZipFile(self.qti_path, "w", zipfile.ZIP_DEFLATED)
+        self._items = {}  # msg_type -> QTI item identifiers
+        self._spans = {}  # msg_type -> (offset, length) of every question in its text file
+
+    def text_path(self, msg_type):
+        return os.path.join(self.directory, f"{msg_type}.txt")
+
+    def add_type(self, msg_type, response):
+        """
+        Writes the questions of a finished type (its raw, merged response) to the type's text file,
+        in the format of core.postprocess_response, and to the QTI package. Returns the number of
+        questions and how many of them could not be converted to QTI.
+        Raises ValueError if an inline_fib response contains no valid JSON.
+        """
+        spans = []
+        items = []
+        section = None
+        with metrics.timed("export", msg_type=msg_type), open(self.text_path(msg_type), "wb") as file:
+            for index, (question_section, text) in enumerate(iter_olat_questions(msg_type, response)):
+                if index:
+                    # Inline_fib: a '---' line between the Inlinechoice and the FIB questions.
+                    file.write(b"\n---\n" if question_section != section else b"\n\n")
+                section = question_section
+                data = text.encode("utf-8")
+                spans.append((file.tell(), len(data)))
+                file.write(data)
+                identifier = f"{msg_type}_{index + 1}"
+                item = qti.question_item(identifier, text)
+                if item is not None:
+                    with self._lock:
+                        self._zip.writestr(qti.item_href(identifier), item)
+                    items.append(identifier)
+            if spans:
+                file.write(b"\n")
+        with self._lock:
+            self._spans[msg_type] = spans
+            self._items[msg_type] = items
+        skipped = len(spans) - len(items)
+        if skipped:
+            logging.warning(f"{skipped} Frage(n) ({msg_type}) konnten nicht ins QTI-Format übernommen werden.")
+        return len(spans), skipped
+
+    def _exported_types(self):
+        return [msg_type for msg_type in self.selected_types if self._spans.get(msg_type)]
+
+    def close(self):
+        """Writes the test and manifest of the QTI package and the combined text file."""
+        with self._lock:
+            if self.closed:
+                return
+            sections = [(display_title(msg_type), self._items[msg_type]) for msg_type in self._exported_types()]
+            self._zip.writestr(qti.TEST_FILENAME, qti.assessment_test("test", self.title, sections))
+            self._zip.writestr(qti.MANIFEST_FILENAME, qti.manifest(
+                f"manifest_{os.path.basename(self.directory)}", [item for _, items in sections for item in items]
+            ))
+            self._zip.close()
+            exported_types = self._exported_types()
+        with open(self.combined_path, "wb") as combined:
+            for msg_type in exported_types:
+                with open(self.text_path(msg_type), "rb") as file:
+                    shutil.copyfileobj(file, combined)
+                combined.write(b"\n")
+        with self._lock:
+            self.closed = True
+
+    def discard(self):
+        """Removes the export files."""
+        with self._lock:
+            if not self.closed:
+                self._zip.close()
+                self.closed = True
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def exported_types(self):
+        """Returns the types with at least one exported question, in the order of `selected_types`."""
+        with self._lock:
+            return self._exported_types()
+
+    def question_count(self):
+        with self._lock:
+            return sum(len(spans) for spans in self._spans.values())
+
+    def read_questions(self, start, stop):
+        """
+        Returns (msg_type, OLAT text) of the questions start to stop - 1, counted over all types in
+        the order of `selected_types`. Only these questions are read from the text files.
+        """
+        with self._lock:
+            spans = [
+                (msg_type, offset, length)
+                for msg_type in self._exported_types()
+                for offset, length in self._spans[msg_type]
+            ][start:stop]
+        questions = []
+        files = {}
+        try:
+            for msg_type, offset, length in spans:
+                if msg_type not in files:
+                    files[msg_type] = open(self.text_path(msg_type), "rb")
+                files[msg_type].seek(offset)
+                questions.append((msg_type, files[msg_type].read(length).decode("utf-8")))
+        finally:
+            for file in files.values():
+                file.close()
+        return questions
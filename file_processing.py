@@ -4,64 +4,142 @@
 Handles processing of uploaded files like PDF, DOCX, and images.
 """
 
+import logging
+import os
+import threading
 import streamlit as st
-import io
-import PyPDF2
-import docx
-from pdf2image import convert_from_bytes
-from PIL import Image
-
-@st.cache_data
-def extract_text_from_pdf(file_bytes):
-    """Extracts text from a PDF file using PyPDF2."""
-    pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_bytes))
-    text = "".join(page.extract_text() for page in pdf_reader.pages if page.extract_text())
-    return text.strip()
-
-@st.cache_data
-def extract_text_from_docx(file_bytes):
-    """Extracts text from a DOCX file."""
-    doc = docx.Document(io.BytesIO(file_bytes))
-    return "\n".join([paragraph.text for paragraph in doc.paragraphs]).strip()
-
-@st.cache_data
-def convert_pdf_to_images(_file_bytes):
-    """Converts PDF pages to a list of PIL Image objects."""
-    return convert_from_bytes(_file_bytes)
-
-def process_uploaded_files(uploaded_files):
-    """Processes uploaded files, extracting text and images."""
-    text_content = ""
-    image_content_list = []
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from config import MAX_SESSION_IMAGE_BYTES, MAX_UPLOAD_DOCUMENTS, MAX_UPLOAD_IMAGES
+from documents import (
+    extract_document, map_documents, pdf_page_count, parse_page_range, file_digest, PDF_EXTENSIONS, DOCX_EXTENSIONS,
+)
+from image_dedupe import dedupe_images
+from openai_client import image_token_cost
+from utils import encode_image
+
+# Streamlit-cached wrappers around the UI-free extractors in documents.py. They are keyed on the
+# content digest of the upload; parameters with a leading underscore are not hashed by Streamlit,
+# so the file bytes are not hashed again on every rerun.
+DIGESTS_STATE_KEY = "upload_digests"
+
+@st.cache_data(show_spinner=False)
+def _extract_document(digest, extension, pages, _file_bytes):
+    return extract_document(_file_bytes, extension, pages)
+
+@st.cache_data(show_spinner=False)
+def _count_pdf_pages(digest, _file_bytes):
+    return pdf_page_count(_file_bytes)
+
+@st.cache_data(show_spinner=False)
+def _encode_image(digest, _file_bytes):
+    return encode_image(_file_bytes)
+
+def upload_digest(uploaded_file):
+    """Returns the content digest of an uploaded file, computed once per upload."""
+    digests = st.session_state.setdefault(DIGESTS_STATE_KEY, {})
+    if uploaded_file.file_id not in digests:
+        digests[uploaded_file.file_id] = file_digest(uploaded_file.getvalue())
+    return digests[uploaded_file.file_id]
+
+def count_pdf_pages(uploaded_file):
+    """Returns the number of pages of an uploaded PDF."""
+    return _count_pdf_pages(upload_digest(uploaded_file), uploaded_file.getvalue())
+
+def encode_uploaded_image(uploaded_file):
+    """Encodes an uploaded image file once, so reruns and question types can reuse it."""
+    return _encode_image(upload_digest(uploaded_file), uploaded_file.getvalue())
+
+def upload_extension(uploaded_file):
+    """Returns the lower-case file extension of an upload; browsers do not report PDF MIME types consistently."""
+    return os.path.splitext(uploaded_file.name)[1].lower()
+
+def pdf_uploads(uploaded_files):
+    """Returns the uploaded PDFs, as process_uploaded_files recognizes them."""
+    return [f for f in uploaded_files if upload_extension(f) in PDF_EXTENSIONS]
+
+def images_size_bytes(images):
+    """Returns the memory held by a list of encoded images."""
+    return sum(image.size_bytes for image in images)
+
+def report_duplicate_images(result, model):
+    """Shows which near-duplicate and blank images were found and the image tokens their removal saves."""
+    if not result.found:
+        return
+    found = f"{len(result.duplicates)} fast identische(s) Bild(er) und {len(result.blanks)} leere Seite(n)"
+    if result.dropped:
+        saved = result.saved_tokens(image_token_cost(model))
+        st.info(f"🖼️ {found} werden nicht gesendet. Das spart ca. {saved} Bild-Tokens pro Fragetyp.")
+        logging.info(f"Bild-Deduplizierung: {found} entfernt, ca. {saved} Tokens pro Anfrage gespart.")
+    else:
+        details = [f"Bild {index + 1} ähnelt Bild {original + 1}" for index, original in result.duplicates]
+        details += [f"Bild {index + 1} ist leer" for index in result.blanks]
+        st.warning(f"🖼️ {found} gefunden: {'; '.join(details)}.")
+
+def process_uploaded_files(uploaded_files, page_range="", model=None):
+    """
+    Processes uploaded files, extracting text and encoded images.
+    Several PDF/DOCX documents are extracted in parallel and their texts joined in upload order;
+    `page_range` (e.g. "1-5, 8") applies when a single PDF is uploaded.
+    Near-duplicate and blank images are handled as configured in IMAGE_DEDUPE_MODE; `model`
+    is used to report the image tokens saved.
+    """
+    documents = [f for f in uploaded_files if upload_extension(f) in PDF_EXTENSIONS + DOCX_EXTENSIONS]
+    images = [f for f in uploaded_files if f.type.startswith('image/')]
 
     # File validation
-    if len(uploaded_files) > 10:
-        st.error("Bitte laden Sie maximal 10 Bilder hoch.")
-        return None, None
-    
-    has_doc = any(f.name.lower().endswith(('.pdf', '.docx')) for f in uploaded_files)
-    has_img = any(f.type.startswith('image/') for f in uploaded_files)
-    
-    if has_doc and has_img and len(uploaded_files) > 1:
-        st.error("Sie können entweder eine einzelne PDF/DOCX-Datei oder mehrere Bilddateien hochladen, nicht beides mischen.")
+    if len(documents) > MAX_UPLOAD_DOCUMENTS:
+        st.error(f"Bitte laden Sie maximal {MAX_UPLOAD_DOCUMENTS} PDF- oder DOCX-Dateien hoch.")
         return None, None
-    if len([f for f in uploaded_files if has_doc]) > 1:
-        st.error("Bitte laden Sie nur eine einzelne PDF- oder DOCX-Datei hoch.")
+    if len(images) > MAX_UPLOAD_IMAGES:
+        st.error(f"Bitte laden Sie maximal {MAX_UPLOAD_IMAGES} Bilder hoch.")
         return None, None
 
-    # Process files
-    for uploaded_file in uploaded_files:
-        file_bytes = uploaded_file.getvalue()
-        if uploaded_file.type == "application/pdf":
-            text_from_pdf = extract_text_from_pdf(file_bytes)
-            if text_from_pdf:
-                text_content += text_from_pdf + "\n\n"
-            else:
-                st.warning("Kein extrahierbarer Text im PDF gefunden. Es wird versucht, das PDF als Bilder zu verarbeiten.")
-                image_content_list.extend(convert_pdf_to_images(file_bytes))
-        elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            text_content += extract_text_from_docx(file_bytes) + "\n\n"
-        elif uploaded_file.type.startswith('image/'):
-            image_content_list.append(Image.open(io.BytesIO(file_bytes)))
+    pdf_documents = pdf_uploads(documents)
+    pages = {}
+    if len(pdf_documents) == 1:
+        try:
+            pages[pdf_documents[0].file_id] = parse_page_range(page_range, count_pdf_pages(pdf_documents[0]))
+        except ValueError as e:
+            st.error(str(e))
+            return None, None
+
+    # Digests are computed here, in the script thread, where the session state is available.
+    jobs = [(upload_digest(f), upload_extension(f), pages.get(f.file_id), f.getvalue()) for f in documents]
+    # st.cache_data needs the script run context, which the threads of the document pool do not have.
+    script_ctx = get_script_run_ctx()
+
+    def extract(job):
+        add_script_run_ctx(threading.current_thread(), script_ctx)
+        return _extract_document(*job)
+
+    extracted = map_documents(extract, jobs)
+
+    texts = []
+    image_content_list = []
+    for uploaded_file, (text, rendered_images, rendered) in zip(documents, extracted):
+        if rendered:
+            st.warning(f"Kein extrahierbarer Text in '{uploaded_file.name}' gefunden. Es wird versucht, das PDF als Bilder zu verarbeiten.")
+            image_content_list.extend(rendered_images)
+        elif text:
+            texts.append(f"# {uploaded_file.name}\n\n{text}" if len(documents) > 1 else text)
+    image_content_list.extend(encode_uploaded_image(f) for f in images)
+    text_content = "\n\n".join(texts)
+
+    dedupe_result = dedupe_images(image_content_list)
+    report_duplicate_images(dedupe_result, model)
+    image_content_list = dedupe_result.images
+
+    # Bound the image memory held by this session; rendered PDFs can produce many pages.
+    total_bytes = 0
+    for index, image in enumerate(image_content_list):
+        total_bytes += image.size_bytes
+        if total_bytes > MAX_SESSION_IMAGE_BYTES:
+            st.warning(
+                f"Die Bilder überschreiten das Speicherlimit von {MAX_SESSION_IMAGE_BYTES / 2**20:.0f} MB. "
+                f"Es werden nur die ersten {index} Bilder verwendet; wählen Sie gegebenenfalls einen Seitenbereich."
+            )
+            image_content_list = image_content_list[:index]
+            break
+    logging.info(f"Bildspeicher der Sitzung: {images_size_bytes(image_content_list) / 2**20:.1f} MB für {len(image_content_list)} Bild(er)")
 
     return text_content.strip(), image_content_list
\ No newline at end of file
@@ -0,0 +1,59 @@
+# image_dedupe.py
+
+"""
+Finds near-duplicate and blank images before they are sent to the model.
+Every image is compared by the perceptual difference hash computed in utils.encode_image, so
+overlapping photos and repeated scanned pages are recognised even when their JPEG bytes differ.
+"""
+
+from dataclasses import dataclass, field
+import metrics
+from config import IMAGE_DEDUPE_MODE, DHASH_MAX_DISTANCE
+
+
+@dataclass
+class DedupeResult:
+    """The images to send and what was found among the uploaded ones (indexes refer to the input list)."""
+    images: list
+    duplicates: list = field(default_factory=list)  # (index, index of the image it duplicates)
+    blanks: list = field(default_factory=list)
+    dropped: bool = False
+
+    @property
+    def found(self):
+        return len(self.duplicates) + len(self.blanks)
+
+    def saved_tokens(self, tokens_per_image):
+        """Image tokens saved per request by the dropped images."""
+        return self.found * tokens_per_image if self.dropped else 0
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def dedupe_images(images, mode=IMAGE_DEDUPE_MODE, max_distance=DHASH_MAX_DISTANCE):
+    """
+    Finds blank images and images within `max_distance` bits of an earlier image.
+    With mode "drop" they are removed from the returned images, with "flag" they are only reported,
+    with "off" nothing is checked. Images without a hash (encoded by older versions) are kept.
+    """
+    if mode == "off" or not images:
+        return DedupeResult(list(images))
+    result = DedupeResult([], dropped=mode == "drop")
+    kept = []  # (index, dhash) of the images that are neither blank nor duplicates
+    for index, image in enumerate(images):
+        if image.is_blank:
+            result.blanks.append(index)
+        elif image.dhash is not None:
+            original = next((i for i, h in kept if hamming_distance(h, image.dhash) <= max_distance), None)
+            if original is not None:
+                result.duplicates.append((index, original))
+            else:
+                kept.append((index, image.dhash))
+    skipped = {index for index, _ in result.duplicates} | set(result.blanks)
+    result.images = [image for index, image in enumerate(images) if not (result.dropped and index in skipped)]
+    if result.found:
+        metrics.count("images_deduplicated", len(result.duplicates), kind="duplicate", mode=mode)
+        metrics.count("images_deduplicated", len(result.blanks), kind="blank", mode=mode)
+    return result
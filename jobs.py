@@ -0,0 +1,275 @@
+# jobs.py
+
+"""
+Background generation jobs.
+A job generates the questions of several types for one source on a process-wide worker pool, so
+it keeps running when the Streamlit script is rerun, the tab is reloaded or the connection drops.
+Its state (finished types, streamed previews and messages) lives in the job; sessions look the job
+up by its ID and render it. Chunk responses are also stored in the response cache as they arrive,
+and the questions of finished types are streamed to the job's export files (see export.py).
+No Streamlit calls are made here.
+"""
+
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+import metrics
+import validation
+from chunking import merge_responses
+from config import GENERATION_WORKERS, MAX_CONCURRENT_REQUESTS, STREAM_RESPONSES, JOB_RETENTION_SECONDS
+from core import cached_response, chunk_request, generate_response, display_title, convert_json_to_text_format
+from export import QuestionExport
+from openai_client import client_account
+from scheduler import session
+from similarity import QuestionIndex, question_stems
+from streaming import make_question_parser
+from utils import replace_german_sharp_s
+
+
+def _preview_question(msg_type, question):
+    """Formats a single streamed question for the live preview."""
+    if msg_type == "inline_fib":
+        fib_output, _ = convert_json_to_text_format([question])
+        return replace_german_sharp_s(fib_output)
+    return replace_german_sharp_s(question)
+
+
+class GenerationJob:
+    """
+    The generation of `selected_types` for one source. Every chunk of every uncached type is
+    requested on the shared pool, at most `max_concurrency` of this job at a time; the chunk
+    results of a type are merged and deduplicated once all of them have arrived.
+    `max_questions_per_type` caps the number of questions kept per type (0 keeps all). Finished
+    types are compared with the ones before them and near-duplicate questions are reported; with
+    `avoid_covered`, requests that start later list the questions generated so far in their prompt.
+    """
+
+    def __init__(self, client, base_request, selected_types, session_id, max_concurrency=MAX_CONCURRENT_REQUESTS,
+                 stream=STREAM_RESPONSES, max_questions_per_type=0, avoid_covered=False):
+        self.id = uuid.uuid4().hex
+        self.model = base_request.model
+        # The API key's rate-limit bucket, for the queue status shown while waiting.
+        self.account = client_account(client)
+        self.selected_types = list(selected_types)
+        self.created_at = time.time()
+        self.finished_at = None
+        self._client = client
+        self._session_id = session_id
+        self._max_concurrency = max(1, max_concurrency)
+        self._stream = stream
+        self._max_questions_per_type = max_questions_per_type
+        self._avoid_covered = avoid_covered
+        self._lock = threading.Lock()
+        self._question_index = QuestionIndex()
+        self.chunk_requests = {
+            msg_type: chunk_request(replace(base_request, msg_type=msg_type))
+            for msg_type in self.selected_types
+        }
+        self.chunk_count = len(next(iter(self.chunk_requests.values()), []))
+        self._chunk_responses = {}
+        self._chunk_errors = {msg_type: [] for msg_type in self.selected_types}
+        self._remaining_chunks = {}
+        self._pending_chunks = deque()
+        self._running = 0
+        self._parsers = {}
+        self.export = QuestionExport(self.selected_types)
+        # Read by the UI through snapshot().
+        self._results = {}    # msg_type -> (title, number of exported questions)
+        self._errors = {}     # msg_type -> error message of a type without result
+        self._cached = set()  # types loaded from the response cache
+        self._previews = {}   # msg_type -> preview of the questions streamed so far
+        self._messages = []   # (level, text) in the order they occurred
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    def snapshot(self):
+        """Returns a consistent copy of the job state for rendering."""
+        with self._lock:
+            return {
+                "results": dict(self._results),
+                "errors": dict(self._errors),
+                "cached": set(self._cached),
+                "previews": {msg_type: list(questions) for msg_type, questions in self._previews.items()},
+                "messages": list(self._messages),
+                "done": self.done,
+            }
+
+    def _message(self, level, text):
+        with self._lock:
+            self._messages.append((level, text))
+
+    def start(self, executor):
+        """Loads the cached chunks and submits the others to `executor`."""
+        self._executor = executor
+        finished = []
+        for msg_type in self.selected_types:
+            responses = [cached_response(request) for request in self.chunk_requests[msg_type]]
+            self._chunk_responses[msg_type] = responses
+            missing = [index for index, response in enumerate(responses) if not response]
+            self._remaining_chunks[msg_type] = len(missing)
+            if missing:
+                self._pending_chunks.extend((msg_type, index) for index in missing)
+            else:
+                self._cached.add(msg_type)
+                finished.append(msg_type)
+        for msg_type in finished:
+            self._finish_type(msg_type)
+        if not self._pending_chunks:
+            self._finish()
+        self._submit_pending()
+
+    def _finish(self):
+        # The export is complete before the job is reported done.
+        self.export.close()
+        with self._lock:
+            self.finished_at = time.time()
+
+    def _submit_pending(self):
+        with self._lock:
+            chunks = []
+            while self._pending_chunks and self._running < self._max_concurrency:
+                chunks.append(self._pending_chunks.popleft())
+                self._running += 1
+        for msg_type, index in chunks:
+            self._executor.submit(self._run_chunk, msg_type, index)
+
+    def _on_delta(self, msg_type, index, delta):
+        with self._lock:
+            parser = self._parsers.setdefault((msg_type, index), make_question_parser(msg_type))
+            questions = [_preview_question(msg_type, question) for question in parser.feed(delta)]
+            self._previews.setdefault(msg_type, []).extend(questions)
+
+    def _on_usage(self, usage):
+        self._message("info", (
+            f"📊 Token Usage: Prompt={usage['prompt_tokens']} (davon aus dem Prompt-Cache: {usage['cached_tokens']}), "
+            f"Completion={usage['completion_tokens']}"
+        ))
+
+    def _run_chunk(self, msg_type, index):
+        request = self.chunk_requests[msg_type][index]
+        covered = self._question_index.stems() if self._avoid_covered else []
+        if covered:
+            request = replace(request, covered_questions=tuple(covered))
+        on_delta = (lambda delta: self._on_delta(msg_type, index, delta)) if self._stream else None
+        response = None
+        try:
+            with session(self._session_id):
+                response, _ = generate_response(
+                    self._client, request, on_delta=on_delta, on_usage=self._on_usage,
+                    on_repair=lambda count: self._message(
+                        "info", f"🔧 '{display_title(msg_type)}': {count} fehlerhafte Frage(n) gezielt nachgebessert."
+                    )
+                )
+        except Exception as e:
+            # A failing chunk or type must not take the others down with it.
+            logging.error(f"Fehler bei der Generierung für {msg_type} (Abschnitt {index + 1}): {e}")
+            self._chunk_errors[msg_type].append(e)
+
+        with self._lock:
+            self._chunk_responses[msg_type][index] = response
+            self._remaining_chunks[msg_type] -= 1
+            type_finished = self._remaining_chunks[msg_type] == 0
+        if type_finished:
+            try:
+                self._finish_type(msg_type)
+            except Exception as e:
+                logging.error(f"Fehler beim Verarbeiten der Antwort für {msg_type}: {e}")
+                with self._lock:
+                    self._errors[msg_type] = str(e)
+        with self._lock:
+            # Only now the slot is released, so the job is not reported done while a type is still being merged.
+            self._running -= 1
+            job_finished = not self._running and not self._pending_chunks
+        if job_finished:
+            self._finish()
+        self._submit_pending()
+
+    def _finish_type(self, msg_type):
+        errors = self._chunk_errors[msg_type]
+        response = merge_responses(msg_type, self._chunk_responses[msg_type], self._max_questions_per_type)
+        # The raw responses are in the response cache; the job only keeps the exported files.
+        self._chunk_responses[msg_type] = None
+        if not response:
+            with self._lock:
+                self._errors[msg_type] = str(errors[0]) if errors else ""
+            return
+        try:
+            question_count, skipped = self.export.add_type(msg_type, response)
+        except Exception as e:
+            self._message("error", f"Fehler beim Verarbeiten der Antwort für '{display_title(msg_type)}': {e}")
+            with self._lock:
+                self._errors[msg_type] = "Eingabe konnte nicht verarbeitet werden."
+            return
+        title = f"{display_title(msg_type)} (Verarbeitet)" if msg_type == "inline_fib" else display_title(msg_type)
+        with self._lock:
+            self._results[msg_type] = (title, question_count)
+        if skipped:
+            self._message("warning", f"'{display_title(msg_type)}': {skipped} Frage(n) konnten nicht ins QTI-Format übernommen werden und fehlen im QTI-Paket.")
+        if errors:
+            self._message("warning", f"'{display_title(msg_type)}': {len(errors)} von {self.chunk_count} Abschnitten fehlgeschlagen.")
+        invalid = validation.find_invalid(msg_type, validation.split_questions(msg_type, response) or [])
+        if invalid:
+            self._message("warning", f"'{display_title(msg_type)}': {len(invalid)} Frage(n) entsprechen nicht dem OLAT-Format. Bitte vor dem Import prüfen.")
+        self._report_duplicates(msg_type, response)
+
+    def _report_duplicates(self, msg_type, response):
+        duplicates = []
+        for number, stem in enumerate(question_stems(msg_type, response), start=1):
+            matches = self._question_index.add((msg_type, number), stem)
+            if matches:
+                (other_type, other_number), _ = matches[0]
+                duplicates.append(f"Frage {number} ≈ '{display_title(other_type)}' Frage {other_number}")
+        if duplicates:
+            self._message("warning", f"🔁 '{display_title(msg_type)}': {len(duplicates)} Frage(n) ähneln bereits generierten Fragen ({', '.join(duplicates)}).")
+
+
+_executor = None
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="generation")
+    return _executor
+
+
+def _prune_jobs(now):
+    for job_id, job in list(_jobs.items()):
+        if job.done and now - job.finished_at > JOB_RETENTION_SECONDS:
+            job.export.discard()
+            del _jobs[job_id]
+
+
+@atexit.register
+def _discard_exports():
+    """Removes the export files of all jobs when the server stops."""
+    with _jobs_lock:
+        for job in _jobs.values():
+            job.export.discard()
+
+
+def submit_job(client, base_request, selected_types, session_id, **options):
+    """Creates a GenerationJob (see there for `options`), starts it on the shared pool and returns it."""
+    job = GenerationJob(client, base_request, selected_types, session_id, **options)
+    with _jobs_lock:
+        _prune_jobs(time.time())
+        _jobs[job.id] = job
+        executor = _get_executor()
+    job.start(executor)
+    metrics.count("generation_jobs")
+    return job
+
+
+def get_job(job_id):
+    """Returns the job with this ID, or None if it is unknown or has expired."""
+    with _jobs_lock:
+        return _jobs.get(job_id)
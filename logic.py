@@ -1,158 +1,198 @@
 # logic.py
 
 """
-Contains the core business logic for question generation and response transformation.
+Streamlit orchestration of the question generation process.
+The UI-free generation and transformation logic lives in core.py, the background jobs in jobs.py.
 """
 
+import math
 import streamlit as st
-import json
-import random
-import hashlib
-# The fix is on the next line: adding 'process_image' to the import list
-from utils import read_prompt_from_md, clean_json_string, replace_german_sharp_s, process_image
-from openai_client import get_chatgpt_response
-
-def convert_json_to_text_format(json_input):
-    """Converts JSON from inline/FIB questions to OLAT text format."""
-    if isinstance(json_input, str):
-        try:
-            data = json.loads(json_input)
-        except json.JSONDecodeError:
-            st.error("Fehler beim Dekodieren des JSON-Strings in 'convert_json_to_text_format'.")
-            return "", ""
-    else:
-        data = json_input
-
-    fib_output = []
-    ic_output = []
-
-    for item in data:
-        text = item.get('text', '')
-        blanks = item.get('blanks', [])
-        wrong_substitutes = item.get('wrong_substitutes', [])
-        num_blanks = len(blanks)
-
-        # --- FIB (Fill-in-the-Blank) Generation ---
-        fib_lines = [
-            "Type\tFIB",
-            "Title\t✏️ Vervollständigen Sie die Lücken mit dem korrekten Begriff. ✏️",
-            f"Points\t{num_blanks}"
-        ]
-        placeholder = "||BLANK||"
-        original_text = text
-        for blank in blanks:
-            original_text = original_text.replace(blank, placeholder, 1)
-
-        parts = original_text.split(placeholder)
-        for index, part in enumerate(parts):
-            fib_lines.append(f"Text\t{part.strip()}")
-            if index < len(blanks):
-                fib_lines.append(f"1\t{blanks[index]}\t20")
-        fib_output.append('\n'.join(fib_lines))
-
-        # --- IC (Inline Choice) Generation ---
-        ic_lines = [
-            "Type\tInlinechoice",
-            "Title\tWörter einordnen",
-            "Question\t✏️ Wählen Sie die richtigen Wörter. ✏️",
-            f"Points\t{num_blanks}"
-        ]
-        all_options = blanks + wrong_substitutes
-        random.shuffle(all_options)
-
-        for index, part in enumerate(parts):
-            ic_lines.append(f"Text\t{part.strip()}")
-            if index < len(blanks):
-                options_str = '|'.join(all_options)
-                ic_lines.append(f"1\t{options_str}\t{blanks[index]}\t|")
-        ic_output.append('\n'.join(ic_lines))
-
-    return '\n\n'.join(fib_output), '\n\n'.join(ic_output)
-
-
-def transform_inline_fib_output(json_string):
-    """Transforms the JSON output for inline/FIB questions."""
-    try:
-        cleaned_json_string = clean_json_string(json_string)
-        json_data = json.loads(cleaned_json_string)
-        fib_output, ic_output = convert_json_to_text_format(json_data)
-
-        fib_output = replace_german_sharp_s(fib_output)
-        ic_output = replace_german_sharp_s(ic_output)
-
-        return f"{ic_output}\n---\n{fib_output}"
-    except json.JSONDecodeError as e:
-        st.error(f"Fehler beim Parsen von JSON in 'transform_inline_fib_output': {e}")
-        st.text_area("Fehlerhafter JSON-String", json_string)
-        return "Fehler: Ungültiges JSON-Format erhalten."
-    except Exception as e:
-        st.error(f"Ein unerwarteter Fehler ist in 'transform_inline_fib_output' aufgetreten: {e}")
-        return "Fehler: Eingabe konnte nicht verarbeitet werden."
-
-
-def generate_questions(client, user_input, learning_goals, selected_types, images, selected_language, selected_model, reasoning_effort, selected_zielniveau):
-    """Orchestrates the question generation process, including caching."""
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from config import MAX_CONCURRENT_REQUESTS, STREAM_RESPONSES, AVOID_COVERED_QUESTIONS, STRUCTURED_OUTPUT, JOB_POLL_INTERVAL, PREVIEW_PAGE_SIZE
+from core import GenerationRequest, display_title
+from estimator import profile_run, estimate_models
+from export import QTI_FILENAME, COMBINED_FILENAME
+from jobs import submit_job, get_job
+from scheduler import get_scheduler
+
+
+JOB_STATE_KEY = "generation_job_id"
+# The job ID is also kept in the URL, so a reloaded tab finds its job again.
+JOB_QUERY_PARAM = "job"
+
+
+def generate_questions(client, user_input, learning_goals, selected_types, images, selected_language, selected_model, reasoning_effort, selected_zielniveau, max_concurrency=MAX_CONCURRENT_REQUESTS, stream=STREAM_RESPONSES, max_questions_per_type=0, avoid_covered=AVOID_COVERED_QUESTIONS, structured=STRUCTURED_OUTPUT, image_detail=None):
+    """
+    Starts the question generation as a background job (see jobs.GenerationJob), renders it and returns it.
+    The job keeps running across reruns and disconnects; its ID is stored in the session state and
+    the URL, and render_generation_job shows its progress and results on every later run.
+    Long source texts are split into token-budgeted chunks. With `stream` enabled, finished
+    questions are shown while the rest of the response is still arriving. With `structured`, the
+    model answers with JSON following a schema per type, and the OLAT text is rendered locally.
+    `image_detail` sets the detail level the images are sent with (None = the model's default).
+    """
     if not client:
         st.error("Ein gültiger OpenAI-API-Schlüssel ist erforderlich.")
         return
 
-    # Application-side caching logic
-    cache_key = "cached_responses"
-    hash_key = "source_content_hash"
-    if cache_key not in st.session_state:
-        st.session_state[cache_key] = {}
-
-    # Create a hash of the current source content to detect changes
-    content_to_hash = user_input
-    if images:
-        # This line now works because process_image is imported
-        content_to_hash += "".join([process_image(img) for img in images])
-    current_content_hash = hashlib.md5(content_to_hash.encode()).hexdigest()
-
-    if st.session_state.get(hash_key) != current_content_hash:
-        st.info("Quellinhalt hat sich geändert. Leere den Anwendungs-Cache.")
-        st.session_state[cache_key] = {}
-        st.session_state[hash_key] = current_content_hash
-
-    all_responses = ""
-    generated_content = {}
-    with st.spinner("Generiere Fragen... dies kann einen Moment dauern."):
-        for msg_type in selected_types:
-            response = None
-            if msg_type in st.session_state[cache_key]:
-                st.success(f"💾 Antwort für '{msg_type.replace('_', ' ').title()}' aus dem Cache geladen.")
-                response = st.session_state[cache_key][msg_type]
-            else:
-                st.info(f"🧠 Rufe OpenAI API für '{msg_type.replace('_', ' ').title()}' auf...")
-                prompt_template = read_prompt_from_md(msg_type)
-                full_prompt = f"{prompt_template}\n\nBenutzereingabe: {user_input}\n\nLernziele: {learning_goals}"
-
-                response = get_chatgpt_response(client, full_prompt, selected_model, images, selected_language, reasoning_effort, selected_zielniveau)
-                if response:
-                    st.session_state[cache_key][msg_type] = response
-
-            if response:
-                if msg_type == "inline_fib":
-                    processed_response = transform_inline_fib_output(response)
-                    generated_content[f"{msg_type.replace('_', ' ').title()} (Verarbeitet)"] = processed_response
-                    all_responses += f"{processed_response}\n\n"
-                else:
-                    cleaned_response = replace_german_sharp_s(response)
-                    generated_content[msg_type.replace('_', ' ').title()] = cleaned_response
-                    all_responses += f"{cleaned_response}\n\n"
-            else:
-                st.error(f"Fehler bei der Generierung einer Antwort für {msg_type}.")
-
-    # Display results
+    base_request = GenerationRequest(
+        msg_type="",
+        user_input=user_input,
+        learning_goals=learning_goals,
+        images=tuple(images or ()),
+        language=selected_language,
+        model=selected_model,
+        reasoning_effort=reasoning_effort,
+        zielniveau=selected_zielniveau,
+        structured=structured,
+        image_detail=image_detail,
+    )
+    # Requests of all sessions with the same API key share its rate limits; the scheduler serves sessions in turn.
+    script_ctx = get_script_run_ctx()
+    session_id = script_ctx.session_id if script_ctx else "default"
+    job = submit_job(
+        client, base_request, selected_types, session_id, max_concurrency=max_concurrency, stream=stream,
+        max_questions_per_type=max_questions_per_type, avoid_covered=avoid_covered
+    )
+    st.session_state[JOB_STATE_KEY] = job.id
+    st.query_params[JOB_QUERY_PARAM] = job.id
+    render_generation_job()
+    return job
+
+
+def render_cost_estimate(user_input, learning_goals, selected_types, images, selected_language, selected_model, reasoning_effort, selected_zielniveau, structured=STRUCTURED_OUTPUT, budget=0, max_concurrency=MAX_CONCURRENT_REQUESTS):
+    """
+    Shows the estimated tokens, cost and duration of the run for every model (see estimator.py) and
+    returns the estimate of the selected model. With a `budget` (USD), the image detail and
+    resolution of each model are chosen to stay within it; the returned estimate holds that image plan.
+    """
+    base_request = GenerationRequest(
+        msg_type="",
+        user_input=user_input,
+        learning_goals=learning_goals,
+        images=tuple(images or ()),
+        language=selected_language,
+        model=selected_model,
+        reasoning_effort=reasoning_effort,
+        zielniveau=selected_zielniveau,
+        structured=structured,
+    )
+    estimates = estimate_models(profile_run(base_request, selected_types), budget, max_concurrency=max_concurrency)
+    selected = next(estimate for estimate in estimates if estimate.model == selected_model)
+    with st.expander(f"💰 Geschätzte Kosten: ca. {selected.cost:.3f} USD, Dauer ca. {selected.seconds:.0f} s ({selected_model})"):
+        st.table([
+            {
+                "Modell": estimate.model,
+                "Anfragen": estimate.requests,
+                "Input-Tokens": estimate.input_tokens,
+                "davon Bilder": estimate.image_tokens,
+                "Output-Tokens": estimate.output_tokens,
+                "Bilder": estimate.image_plan.label if images else "–",
+                "Kosten (USD)": f"{estimate.cost:.3f}",
+                "Dauer (s)": f"{estimate.seconds:.0f}",
+            }
+            for estimate in estimates
+        ])
+        st.caption(
+            "Lokale Schätzung ohne API-Aufruf. Prompt-Caching und bereits zwischengespeicherte Antworten "
+            "machen den Lauf günstiger; o4-mini enthält geschätzte Reasoning-Tokens."
+        )
+    if budget and selected.cost > budget:
+        message = f"Die geschätzten Kosten ({selected.cost:.3f} USD) übersteigen das Budget von {budget:.2f} USD"
+        if images:
+            message += " auch mit der geringsten Bildauflösung"
+        st.warning(message + ". Weniger Fragetypen oder ein kürzerer Text senken die Kosten.")
+    return selected
+
+
+def render_generation_job():
+    """Renders the generation job of this session, if any; a running job is polled until it is done."""
+    job_id = st.session_state.get(JOB_STATE_KEY) or st.query_params.get(JOB_QUERY_PARAM)
+    if not job_id:
+        return
+    job = get_job(job_id)
+    if not job:
+        st.session_state.pop(JOB_STATE_KEY, None)
+        st.query_params.pop(JOB_QUERY_PARAM, None)
+        st.info("Die letzte Generierung ist nicht mehr verfügbar. Bitte starten Sie sie erneut.")
+        return
+    st.session_state[JOB_STATE_KEY] = job.id
+    polling = not job.done
+    st.fragment(run_every=JOB_POLL_INTERVAL if polling else None)(_render_job)(job, polling)
+
+
+def _render_waiting(job, msg_type):
+    depth, wait_seconds = get_scheduler().status(job.model, job.account)
+    message = f"🧠 Rufe OpenAI API für '{display_title(msg_type)}' auf..."
+    if depth:
+        message += f" (Warteschlange: {depth} Anfrage(n), geschätzte Wartezeit ca. {wait_seconds:.0f} s)"
+    st.info(message)
+
+
+def _render_job(job, polling):
+    state = job.snapshot()
+    if polling and state["done"]:
+        # Redraw once without the poll timer.
+        st.rerun()
+
+    if job.chunk_count > 1:
+        st.info(f"📚 Langer Text: Er wird in {job.chunk_count} Abschnitte aufgeteilt, die Fragen werden anschliessend zusammengeführt.")
     st.subheader("Generierter Inhalt:")
-    for title in generated_content:
-        st.write(f"✔️ {title}")
-
-    if all_responses:
-        st.download_button(
-            label="Alle Antworten herunterladen",
-            data=all_responses,
-            file_name="alle_antworten.txt",
-            mime="text/plain"
+    for msg_type in job.selected_types:
+        if msg_type in state["results"]:
+            if msg_type in state["cached"]:
+                st.success(f"💾 Antwort für '{display_title(msg_type)}' aus dem Cache geladen.")
+            title, question_count = state["results"][msg_type]
+            st.write(f"✔️ {title} ({question_count} Fragen)")
+        elif msg_type in state["errors"]:
+            error = state["errors"][msg_type]
+            st.error(f"Fehler bei der Generierung einer Antwort für {msg_type}" + (f": {error}" if error else "."))
+        elif msg_type in state["previews"]:
+            questions = state["previews"][msg_type]
+            st.write(f"⏳ {display_title(msg_type)}: {len(questions)} Frage(n) fertig")
+            if questions:
+                st.code("\n\n".join(questions), language=None)
+        else:
+            _render_waiting(job, msg_type)
+    for level, text in state["messages"]:
+        getattr(st, level)(text)
+
+    if not state["done"]:
+        st.caption("⏳ Die Generierung läuft im Hintergrund weiter, auch wenn Sie Eingaben ändern oder die Seite neu laden.")
+        return
+    _render_export(job)
+
+
+def _render_export(job):
+    """Offers the export files of a finished job for download and previews its questions page by page."""
+    export = job.export
+    question_count = export.question_count()
+    if not question_count:
+        return
+    col1, col2 = st.columns(2)
+    with open(export.combined_path, "rb") as file:
+        col1.download_button("Alle Antworten herunterladen", file, file_name=COMBINED_FILENAME, mime="text/plain")
+    with open(export.qti_path, "rb") as file:
+        col2.download_button("QTI 2.1-Paket herunterladen", file, file_name=QTI_FILENAME, mime="application/zip")
+    with st.expander("Fragetypen einzeln herunterladen"):
+        for msg_type in export.exported_types():
+            with open(export.text_path(msg_type), "rb") as file:
+                st.download_button(
+                    f"{display_title(msg_type)} herunterladen", file, file_name=f"{msg_type}.txt",
+                    mime="text/plain", key=f"download_{job.id}_{msg_type}"
+                )
+
+    # Only one page of questions is read and rendered at a time.
+    st.subheader("Vorschau der generierten Fragen")
+    page_count = math.ceil(question_count / PREVIEW_PAGE_SIZE)
+    page = 1
+    if page_count > 1:
+        page = st.number_input(
+            f"Seite (von {page_count}):", min_value=1, max_value=page_count, value=1, step=1,
+            key=f"preview_page_{job.id}"
         )
-        st.text_area("Vorschau der generierten Fragen", all_responses, height=400)
\ No newline at end of file
+    start = (page - 1) * PREVIEW_PAGE_SIZE
+    questions = export.read_questions(start, start + PREVIEW_PAGE_SIZE)
+    st.caption(f"Fragen {start + 1}–{start + len(questions)} von {question_count}")
+    for msg_type, text in questions:
+        st.code(text, language=None)
@@ -0,0 +1,160 @@
+# metrics.py
+
+"""
+Per-stage latency and token instrumentation.
+Every measurement is appended to a JSON lines log and aggregated in memory, from where it is
+served in the Prometheus text format by a small local HTTP endpoint.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import METRICS_LOG_PATH, METRICS_PORT
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Labels such as the question type and model, attached to every measurement of the current context.
+_context_labels = contextvars.ContextVar("metric_labels", default={})
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_log_file = None
+_server = None
+_server_attempted = False
+
+
+@contextmanager
+def labels(**new_labels):
+    """Attaches labels (e.g. msg_type, model) to all measurements recorded inside the block."""
+    token = _context_labels.set({**_context_labels.get(), **new_labels})
+    try:
+        yield
+    finally:
+        _context_labels.reset(token)
+
+
+def _label_key(extra_labels):
+    merged = {**_context_labels.get(), **extra_labels}
+    return tuple(sorted((name, str(value)) for name, value in merged.items() if value is not None))
+
+
+def _write_log(record):
+    global _log_file
+    if not METRICS_LOG_PATH:
+        return
+    try:
+        if _log_file is None:
+            directory = os.path.dirname(METRICS_LOG_PATH)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            _log_file = open(METRICS_LOG_PATH, "a", encoding="utf-8", buffering=1)
+        _log_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logging.warning(f"Metrik-Log konnte nicht geschrieben werden: {e}")
+
+
+def observe(stage, seconds, **extra_labels):
+    """Records the duration of one stage, e.g. observe("api_total", 2.4, msg_type="kprim")."""
+    key = _label_key(extra_labels)
+    with _lock:
+        histogram = _histograms.setdefault((stage, key), {"buckets": [0] * len(LATENCY_BUCKETS), "count": 0, "sum": 0.0})
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][index] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        _write_log({"time": time.time(), "stage": stage, "seconds": round(seconds, 6), **dict(key)})
+
+
+def count(name, value=1, **extra_labels):
+    """Adds `value` to a counter, e.g. count("tokens", 812, kind="prompt")."""
+    if not value:
+        return
+    key = _label_key(extra_labels)
+    with _lock:
+        _counters[(name, key)] = _counters.get((name, key), 0) + value
+        _write_log({"time": time.time(), "counter": name, "value": value, **dict(key)})
+
+
+@contextmanager
+def timed(stage, **extra_labels):
+    """Measures the duration of the block as `stage`, also when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, **extra_labels)
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (f'{name}="{value}"'.replace("\n", " ") for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_prometheus():
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        histograms = sorted(_histograms.items())
+        counters = sorted(_counters.items())
+    if histograms:
+        lines.append("# TYPE olat_stage_seconds histogram")
+    for (stage, key), histogram in histograms:
+        key = (("stage", stage),) + key
+        for bound, bucket_count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+            lines.append(f"olat_stage_seconds_bucket{_format_labels(key, [('le', bound)])} {bucket_count}")
+        lines.append(f"olat_stage_seconds_bucket{_format_labels(key, [('le', '+Inf')])} {histogram['count']}")
+        lines.append(f"olat_stage_seconds_sum{_format_labels(key)} {histogram['sum']:.6f}")
+        lines.append(f"olat_stage_seconds_count{_format_labels(key)} {histogram['count']}")
+    for name in sorted({name for (name, _) in _counters}):
+        lines.append(f"# TYPE olat_{name}_total counter")
+    for (name, key), value in counters:
+        lines.append(f"olat_{name}_total{_format_labels(key)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        data = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """
+    Serves the metrics on http://127.0.0.1:<port>/metrics from a background thread, once per process.
+    Returns the server, or None if the endpoint is disabled or the port is taken.
+    """
+    global _server, _server_attempted
+    with _lock:
+        if _server_attempted or not port:
+            return _server
+        _server_attempted = True
+        try:
+            _server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+        except OSError as e:
+            logging.warning(f"Metrik-Endpunkt auf Port {port} konnte nicht gestartet werden: {e}")
+            return None
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+        logging.info(f"Metriken werden unter http://127.0.0.1:{port}/metrics bereitgestellt.")
+        return _server
@@ -2,124 +2,389 @@
 
 """
 Manages the OpenAI client and API calls, including special handling for o4-mini.
+This module is UI-free: errors are raised to the caller and progress is reported through logging.
 """
 
-import streamlit as st
+import atexit
+import hashlib
+import importlib.util
 import logging
-import httpx
-from openai import OpenAI
-from utils import process_image
-import os
+import math
+import threading
+import time
+import weakref
+import metrics
+from chunking import estimate_tokens
+from scheduler import call_with_retries
+from config import HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS, HTTP_KEEPALIVE_EXPIRY, HTTP_CLIENT_IDLE_SECONDS
+from config import EXPECTED_COMPLETION_TOKENS
+from utils import encode_image, MAX_IMAGE_SIZE
 
-def initialize_client(api_key):
-    """Initializes and returns the OpenAI client."""
-    if not api_key:
-        return None
-    try:
-        # Clear proxy settings to avoid connection issues
-        os.environ.pop('HTTP_PROXY', None)
-        os.environ.pop('HTTPS_PROXY', None)
-        os.environ.pop('http_proxy', None)
-        os.environ.pop('https_proxy', None)
-
-        http_client = httpx.Client()
-        
-        client = OpenAI(api_key=api_key, http_client=http_client)
-        st.success("API-Schlüssel erfolgreich erkannt und OpenAI-Client verbunden.")
-        return client
-    except Exception as e:
-        st.error(f"Fehler bei der Initialisierung des OpenAI-Clients: {e}")
-        return None
-
-def get_chatgpt_response(client, prompt, model, images, selected_language, reasoning_effort, selected_zielniveau):
-    """Fetches a response from the OpenAI API, with custom logic for different models."""
-    if not client:
-        st.error("OpenAI-Client nicht initialisiert. Bitte geben Sie einen gültigen API-Schlüssel ein.")
-        return None
-
-    system_prompt_template = """
+SYSTEM_PROMPT_TEMPLATE = """
     Du bist ein Experte im Bildungsbereich, spezialisiert auf die Erstellung von Testfragen und -antworten...
     # Zielniveaus
     [ZIELNIVEAU_INJECTION]
     ... (rest of your system prompt) ...
     Achte stets darauf, dass die Formulierungen und kognitiven Anforderungen dem Niveau des vorgesehenen Lernendenkreises entsprechen.
     """
-    system_prompt = system_prompt_template.replace("[ZIELNIVEAU_INJECTION]", selected_zielniveau)
 
+# The system prompt must be identical for every request so that it can be served from the
+# provider's prompt cache; the Zielniveau is therefore given at the end of each request.
+SYSTEM_PROMPT = SYSTEM_PROMPT_TEMPLATE.replace(
+    "[ZIELNIVEAU_INJECTION]", "Das Zielniveau wird am Ende der Anfrage angegeben."
+)
+
+# Process-wide OpenAI clients, keyed by a hash of API key and base URL, with their last use.
+_clients = {}
+_clients_lock = threading.Lock()
+# The key hash of every client, to find its entry in _clients and to schedule its requests within
+# the rate limits of its own API key.
+_client_accounts = weakref.WeakKeyDictionary()
+
+def _client_key(api_key, base_url):
+    return hashlib.sha256(f"{base_url or ''}\0{api_key}".encode("utf-8")).hexdigest()
+
+def _create_client(api_key, base_url):
+    # openai and httpx take a noticeable part of the app's start-up time; they are only
+    # imported once the first client is actually needed.
+    import httpx
+    from openai import OpenAI
+
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        # HTTP/2 needs the optional 'h2' package (pip install httpx[http2]).
+        http2=importlib.util.find_spec("h2") is not None,
+        # Ignore proxy settings from the environment to avoid connection issues.
+        trust_env=False,
+    )
+    # Retries are left to the scheduler, which knows about the rate limits of all sessions.
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+
+def _close_idle_clients(now):
+    """Closes clients that have been neither requested nor used for HTTP_CLIENT_IDLE_SECONDS. Expects the lock to be held."""
+    for key, (client, last_used) in list(_clients.items()):
+        if now - last_used > HTTP_CLIENT_IDLE_SECONDS:
+            del _clients[key]
+            client.close()
+
+def initialize_client(api_key, base_url=None):
+    """
+    Returns the shared OpenAI client for an API key, or None if no API key was given.
+    `base_url` points the client at an OpenAI-compatible server, e.g. a local stub.
+    Clients are reused across Streamlit reruns and sessions, so warm keep-alive connections are
+    reused instead of opening a new connection pool on every widget interaction.
+    """
+    if not api_key:
+        return None
+    key = _client_key(api_key, base_url)
+    now = time.monotonic()
+    with _clients_lock:
+        _close_idle_clients(now)
+        client = _clients[key][0] if key in _clients else _create_client(api_key, base_url)
+        _clients[key] = (client, now)
+        _client_accounts[client] = key
+    return client
+
+def client_account(client):
+    """Returns the key hash of a client from initialize_client, or "default" for other clients."""
     try:
-        # --- START OF o4-mini IMPLEMENTATION ---
-        if model == "o4-mini":
-            st.info(f"🧠 Rufe OpenAI Reasoning API (o4-mini) mit '{reasoning_effort}' Aufwand auf...")
-            
-            # Construct the payload according to the client.responses.create format
-            input_payload = []
-            
-            # 1. Add the developer role with system and user prompts
-            full_text_prompt = f"Generate questions in {selected_language}.\n\n{system_prompt}\n\n{prompt}"
-            input_payload.append({
-                "role": "developer",
-                "content": [{"type": "input_text", "text": full_text_prompt}]
-            })
-
-            # 2. Add the user role with images, if they exist
-            if images:
-                image_content = []
-                for image in images:
-                    base64_image = process_image(image)
-                    image_content.append({
-                        "type": "input_image",
-                        "image_url": f"data:image/jpeg;base64,{base64_image}"
-                    })
-                input_payload.append({"role": "user", "content": image_content})
-
-            # 3. Call the API
-            response_obj = client.responses.create(
-                model="o4-mini",
-                input=input_payload,
-                reasoning={"effort": reasoning_effort},
-                text={"format": {"type": "text"}},
-                tools=[],
-                store=False
-            )
-            
-            # 4. Parse the response
-            # The response is a list of events. We need the last 'assistant' message.
-            if hasattr(response_obj, 'output') and isinstance(response_obj.output, list):
-                for item in reversed(response_obj.output): # Check from the end
-                    if hasattr(item, 'role') and item.role == "assistant":
-                        if hasattr(item, 'content') and item.content and isinstance(item.content, list):
-                            # The text is in the first element of the content list
-                            return item.content[0].text
-            
-            st.error("Konnte keine gültige Antwort vom o4-mini Modell finden.")
-            logging.error(f"Unerwartete o4-mini Antwortstruktur: {response_obj}")
+        return _client_accounts.get(client, "default")
+    except TypeError:
+        # Clients that cannot be weakly referenced are not shared either.
+        return "default"
+
+def _touch_client(client):
+    """Marks a shared client as used now, so it is not closed as idle while requests go through it."""
+    key = client_account(client)
+    with _clients_lock:
+        if key in _clients and _clients[key][0] is client:
+            _clients[key] = (client, time.monotonic())
+
+@atexit.register
+def close_clients():
+    """Closes all shared clients and their connection pools."""
+    with _clients_lock:
+        for client, _ in _clients.values():
+            client.close()
+        _clients.clear()
+
+def _read_chat_stream(stream, on_delta):
+    """Collects a streamed chat completion, forwarding each text delta to `on_delta`."""
+    parts = []
+    usage = None
+    for chunk in stream:
+        if chunk.usage:
+            usage = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            delta = chunk.choices[0].delta.content
+            parts.append(delta)
+            on_delta(delta)
+    return "".join(parts), usage
+
+def _read_responses_stream(stream, on_delta):
+    """Collects a streamed o4-mini response, forwarding each output text delta to `on_delta`."""
+    parts = []
+    usage = None
+    for event in stream:
+        if event.type == "response.output_text.delta":
+            parts.append(event.delta)
+            on_delta(event.delta)
+        elif event.type == "response.completed":
+            usage = event.response.usage
+        elif event.type in ("response.failed", "error"):
+            raise RuntimeError(f"Streaming-Antwort fehlgeschlagen: {event}")
+    return "".join(parts), usage
+
+def usage_counts(usage):
+    """
+    Returns the prompt, completion and cached prompt tokens of a chat completions or responses usage object.
+    Cached tokens are the part of the prompt served from the provider's prompt cache.
+    """
+    if hasattr(usage, "input_tokens"):
+        details = getattr(usage, "input_tokens_details", None)
+        prompt_tokens, completion_tokens = usage.input_tokens, usage.output_tokens
+    else:
+        details = getattr(usage, "prompt_tokens_details", None)
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+    return {
+        "prompt_tokens": prompt_tokens or 0,
+        "completion_tokens": completion_tokens or 0,
+        "cached_tokens": (getattr(details, "cached_tokens", None) or 0) if details else 0,
+    }
+
+def _report_usage(usage, on_usage):
+    if not usage:
+        return
+    counts = usage_counts(usage)
+    logging.info(
+        f"Token Usage: Prompt={counts['prompt_tokens']} (davon gecacht: {counts['cached_tokens']}), "
+        f"Completion={counts['completion_tokens']}"
+    )
+    for kind, value in counts.items():
+        metrics.count("tokens", value, kind=kind.removesuffix("_tokens"))
+    if on_usage:
+        on_usage(counts)
+
+# Chat requests send images with detail "low" unless another detail is requested; a low-detail
+# image costs a flat number of tokens.
+DEFAULT_CHAT_IMAGE_DETAIL = "low"
+LOW_DETAIL_IMAGE_TOKENS = 85
+# At detail "high", gpt-4o and gpt-4.1 scale an image into 2048 x 2048 px and its shortest side to
+# 768 px, and charge per 512 px tile.
+HIGH_DETAIL_BASE_TOKENS = 85
+HIGH_DETAIL_TILE_TOKENS = 170
+# o4-mini charges per 32 px patch (at most 1536 per image) with a model-specific multiplier,
+# whatever the detail level.
+IMAGE_PATCH_SIZE = 32
+MAX_IMAGE_PATCHES = 1536
+PATCH_TOKEN_MULTIPLIER = 1.72
+
+def image_tokens(model, width, height, detail=None):
+    """
+    Returns the input tokens of one width x height image in a request to `model` that sends
+    images at `detail` (None = the payload's default, see build_request_payload).
+    """
+    if model == "o4-mini":
+        patches = math.ceil(width / IMAGE_PATCH_SIZE) * math.ceil(height / IMAGE_PATCH_SIZE)
+        return math.ceil(min(patches, MAX_IMAGE_PATCHES) * PATCH_TOKEN_MULTIPLIER)
+    if (detail or DEFAULT_CHAT_IMAGE_DETAIL) == "low":
+        return LOW_DETAIL_IMAGE_TOKENS
+    scale = min(1.0, 2048 / max(width, height))
+    scale *= min(1.0, 768 / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return HIGH_DETAIL_BASE_TOKENS + HIGH_DETAIL_TILE_TOKENS * tiles
+
+def image_token_cost(model):
+    """Returns the approximate input tokens of a typical (4:3, full-size) image in a request to `model`."""
+    return image_tokens(model, MAX_IMAGE_SIZE, MAX_IMAGE_SIZE * 3 // 4)
+
+def estimate_input_tokens(prompt_template, source_text, model, images, learning_goals="", image_detail=None):
+    """Estimates the input tokens of one request locally, from its text and the sizes of its images."""
+    return estimate_tokens(f"{SYSTEM_PROMPT}\n{prompt_template}\n{source_text}\n{learning_goals}") + sum(
+        image_tokens(model, image.width, image.height, image_detail) for image in map(encode_image, images or [])
+    )
+
+RESPONSES_ENDPOINT = "/v1/responses"
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+
+def _request_instructions(prompt_template, learning_goals, selected_language, selected_zielniveau):
+    """Returns the type template followed by the parts of a request that vary between runs."""
+    return (
+        f"{prompt_template}\n\n"
+        f"Lernziele: {learning_goals}\n\n"
+        f"# Zielniveau\n{selected_zielniveau}\n\n"
+        f"Generate questions in {selected_language}."
+    )
+
+def build_request_payload(prompt_template, source_text, model, images, selected_language, reasoning_effort, selected_zielniveau, learning_goals="", response_schema=None, image_detail=None):
+    """
+    Builds the API request for one question type without sending it.
+    Returns the endpoint path and the keyword arguments of the corresponding create() call,
+    which double as the request body in batch files.
+    `response_schema` is an optional (name, JSON schema) pair the answer must follow (structured outputs).
+    `image_detail` ("low", "high" or "auto") overrides the default detail level of the images.
+
+    The messages are ordered from most to least shared, so that the provider's automatic prefix
+    caching applies: the static system prompt, then the source text and images (identical for all
+    types of a run), then the type template and finally language, learning goals and Zielniveau.
+    """
+    instructions = _request_instructions(prompt_template, learning_goals, selected_language, selected_zielniveau)
+    source = f"Benutzereingabe: {source_text}"
+
+    # --- START OF o4-mini IMPLEMENTATION ---
+    if model == "o4-mini":
+        # Construct the payload according to the client.responses.create format
+        source_content = [{"type": "input_text", "text": source}]
+        for image in images or []:
+            image_content = {"type": "input_image", "image_url": encode_image(image).data_url}
+            if image_detail:
+                image_content["detail"] = image_detail
+            source_content.append(image_content)
+
+        input_payload = [
+            {"role": "developer", "content": [{"type": "input_text", "text": SYSTEM_PROMPT}]},
+            {"role": "user", "content": source_content},
+            {"role": "developer", "content": [{"type": "input_text", "text": instructions}]},
+        ]
+
+        text_format = {"type": "text"}
+        if response_schema:
+            text_format = {"type": "json_schema", "name": response_schema[0], "schema": response_schema[1], "strict": True}
+        return RESPONSES_ENDPOINT, dict(
+            model="o4-mini",
+            input=input_payload,
+            reasoning={"effort": reasoning_effort},
+            text={"format": text_format},
+            tools=[],
+            store=False
+        )
+    # --- END OF o4-mini IMPLEMENTATION ---
+
+    # Logic for gpt-4o and other standard chat models
+    source_content = [{"type": "text", "text": source}]
+    for image in images or []:
+        source_content.append({"type": "image_url", "image_url": {"url": encode_image(image).data_url, "detail": image_detail or DEFAULT_CHAT_IMAGE_DETAIL}})
+
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": source_content},
+        {"role": "user", "content": instructions}
+    ]
+
+    request_args = dict(
+        model=model,
+        messages=messages,
+        max_tokens=15000,
+        temperature=0.4
+    )
+    if response_schema:
+        request_args["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": response_schema[0], "schema": response_schema[1], "strict": True},
+        }
+    return CHAT_COMPLETIONS_ENDPOINT, request_args
+
+def get_chatgpt_response(client, prompt_template, source_text, model, images, selected_language, reasoning_effort, selected_zielniveau, learning_goals="", on_delta=None, on_usage=None, response_schema=None, image_detail=None):
+    """
+    Fetches a response from the OpenAI API, with custom logic for different models.
+    If `on_delta` is given, the response is streamed and every text fragment is passed to it as it arrives.
+    `on_usage` receives the token counts (see usage_counts) of every response.
+    With `response_schema` (see build_request_payload), the answer is JSON that follows the schema.
+    `image_detail` overrides the default detail level of the images (see build_request_payload).
+    Returns None if the model produced no usable answer; API errors are raised.
+    """
+    if not client:
+        raise ValueError("OpenAI-Client nicht initialisiert. Bitte geben Sie einen gültigen API-Schlüssel ein.")
+
+    with metrics.timed("prompt_assembly"):
+        endpoint, request_args = build_request_payload(
+            prompt_template, source_text, model, images, selected_language, reasoning_effort, selected_zielniveau,
+            learning_goals=learning_goals, response_schema=response_schema, image_detail=image_detail
+        )
+
+    estimated_tokens = estimate_input_tokens(
+        prompt_template, source_text, model, images, learning_goals, image_detail
+    ) + EXPECTED_COMPLETION_TOKENS
+    streamed = False
+
+    def tracked_delta(delta):
+        nonlocal streamed
+        streamed = True
+        on_delta(delta)
+
+    def attempt(slot):
+        def tracked_usage(counts):
+            slot.record_tokens(counts["prompt_tokens"] + counts["completion_tokens"])
+            if on_usage:
+                on_usage(counts)
+        # Background jobs hold their client for a long time; each request keeps it from being closed as idle.
+        _touch_client(client)
+        try:
+            with metrics.timed("api_total"):
+                return _send_request(
+                    client, endpoint, request_args, reasoning_effort, tracked_delta if on_delta else None, tracked_usage
+                )
+        except Exception as e:
+            # Output already shown to the user cannot be taken back by a retry.
+            e.partial_output = streamed
+            raise
+
+    return call_with_retries(model, estimated_tokens, attempt, account=client_account(client))
+
+def _timed_first_delta(on_delta):
+    """Wraps a delta callback so that the time to the first streamed token is recorded."""
+    start = time.perf_counter()
+    first = True
+
+    def forward(delta):
+        nonlocal first
+        if first:
+            metrics.observe("api_ttft", time.perf_counter() - start)
+            first = False
+        on_delta(delta)
+    return forward
+
+def _send_request(client, endpoint, request_args, reasoning_effort, on_delta, on_usage):
+    """Sends a built request to its endpoint and returns the response text."""
+    if on_delta:
+        on_delta = _timed_first_delta(on_delta)
+
+    if endpoint == RESPONSES_ENDPOINT:
+        logging.info(f"Rufe OpenAI Reasoning API (o4-mini) mit '{reasoning_effort}' Aufwand auf...")
+        if on_delta:
+            text, usage = _read_responses_stream(client.responses.create(stream=True, **request_args), on_delta)
+            _report_usage(usage, on_usage)
+            if text:
+                return text
+            logging.error("Konnte keine gültige Antwort vom o4-mini Modell finden.")
             return None
-        # --- END OF o4-mini IMPLEMENTATION ---
-
-        else: # Logic for gpt-4o and other standard chat models
-            user_content = [{"type": "text", "text": f"Generate questions in {selected_language}. {prompt}"}]
-            if images:
-                for image in images:
-                    base64_image = process_image(image)
-                    user_content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}", "detail": "low"}})
-            
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_content}
-            ]
-            
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                max_tokens=15000,
-                temperature=0.4
-            )
-            if response.usage:
-                st.info(f"📊 Token Usage: Prompt={response.usage.prompt_tokens}, Completion={response.usage.completion_tokens}")
-            
-            return response.choices[0].message.content
-
-    except Exception as e:
-        st.error(f"Fehler bei der Kommunikation mit der OpenAI API: {e}")
-        logging.error(f"Fehler bei der OpenAI API: {e}")
-        return None
\ No newline at end of file
+
+        response_obj = client.responses.create(**request_args)
+        _report_usage(getattr(response_obj, "usage", None), on_usage)
+
+        # The response is a list of events. We need the last 'assistant' message.
+        if hasattr(response_obj, 'output') and isinstance(response_obj.output, list):
+            for item in reversed(response_obj.output): # Check from the end
+                if hasattr(item, 'role') and item.role == "assistant":
+                    if hasattr(item, 'content') and item.content and isinstance(item.content, list):
+                        # The text is in the first element of the content list
+                        return item.content[0].text
+
+        logging.error(f"Konnte keine gültige Antwort vom o4-mini Modell finden. Unerwartete Antwortstruktur: {response_obj}")
+        return None
+
+    if on_delta:
+        text, usage = _read_chat_stream(
+            client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **request_args),
+            on_delta
+        )
+        _report_usage(usage, on_usage)
+        return text
+
+    response = client.chat.completions.create(**request_args)
+    _report_usage(response.usage, on_usage)
+    return response.choices[0].message.content
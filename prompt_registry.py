@@ -0,0 +1,61 @@
+# prompt_registry.py
+
+"""
+Process-wide registry of the prompt templates in prompts/.
+All templates are read once at startup; a template whose file has changed since it was read is
+reloaded on its next use, so prompt edits take effect without restarting the server.
+Paths are resolved relative to this module, not to the current working directory.
+"""
+
+import logging
+import os
+import threading
+
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+
+
+class PromptRegistry:
+    """Templates of one prompts directory, keyed by file name without the .md extension."""
+
+    def __init__(self, directory=PROMPTS_DIR):
+        self._directory = directory
+        self._lock = threading.Lock()
+        # name -> (mtime_ns, text)
+        self._prompts = {}
+
+    def _path(self, name):
+        return os.path.join(self._directory, f"{name}.md")
+
+    def _load(self, name, mtime_ns):
+        with open(self._path(name), "r", encoding="utf-8") as file:
+            text = file.read()
+        self._prompts[name] = (mtime_ns, text)
+        return text
+
+    def load_all(self):
+        """Reads every template of the directory; returns the number of templates read."""
+        names = [entry[:-3] for entry in os.listdir(self._directory) if entry.endswith(".md")]
+        with self._lock:
+            for name in names:
+                self._load(name, os.stat(self._path(name)).st_mtime_ns)
+        return len(names)
+
+    def get(self, name):
+        """Returns the template `name`, reloading it if its file has changed. Raises OSError if it does not exist."""
+        mtime_ns = os.stat(self._path(name)).st_mtime_ns
+        with self._lock:
+            cached = self._prompts.get(name)
+            if cached and cached[0] == mtime_ns:
+                return cached[1]
+            if cached:
+                logging.info(f"Prompt '{name}' wurde geändert und neu geladen.")
+            return self._load(name, mtime_ns)
+
+
+_registry = PromptRegistry()
+_registry.load_all()
+
+
+def get_prompt(name):
+    """Returns the prompt template `name` from the process-wide registry."""
+    return _registry.get(name)
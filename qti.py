@@ -0,0 +1,315 @@
+# qti.py
+
+"""
+Conversion of OLAT text questions into a QTI 2.1 package.
+Every question is read from its final OLAT text (see core.iter_olat_questions), so the package
+holds exactly the questions of the text export. The scores of the OLAT answer rows become response
+mappings: SCORE is the sum of the mapped responses (not below 0), MAXSCORE the question's points.
+"""
+
+import xml.etree.ElementTree as ET
+import validation
+
+QTI_NAMESPACE = "http://www.imsglobal.org/xsd/imsqti_v2p1"
+QTI_SCHEMA_LOCATION = f"{QTI_NAMESPACE} http://www.imsglobal.org/xsd/qti/qtiv2p1/imsqti_v2p1.xsd"
+CP_NAMESPACE = "http://www.imsglobal.org/xsd/imscp_v1p1"
+CP_SCHEMA_LOCATION = f"{CP_NAMESPACE} http://www.imsglobal.org/xsd/imscp_v1p1.xsd"
+XSI_NAMESPACE = "http://www.w3.org/2001/XMLSchema-instance"
+
+MANIFEST_FILENAME = "imsmanifest.xml"
+TEST_FILENAME = "test.xml"
+ITEMS_DIRNAME = "items"
+# Columns a Kprim statement is matched to: (identifier, label, OLAT marker).
+KPRIM_TARGETS = (("correct", "richtig", "+"), ("wrong", "falsch", "-"))
+
+
+def _element(parent, tag, text=None, **attributes):
+    element = ET.SubElement(parent, tag, {name: str(value) for name, value in attributes.items()})
+    if text is not None:
+        element.text = text
+    return element
+
+
+def _root(tag, namespace, schema_location, **attributes):
+    return ET.Element(tag, {
+        "xmlns": namespace, "xmlns:xsi": XSI_NAMESPACE, "xsi:schemaLocation": schema_location,
+        **{name: str(value) for name, value in attributes.items()},
+    })
+
+
+def _append_text(element, text):
+    """Appends text after the last child of `element` (mixed content)."""
+    children = list(element)
+    if children:
+        children[-1].tail = (children[-1].tail or "") + text
+    else:
+        element.text = (element.text or "") + text
+
+
+def _to_bytes(root):
+    return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+
+
+def _score(value):
+    value = value.strip()
+    return float(value) if validation.NUMBER_PATTERN.match(value) else 0.0
+
+
+def _format_score(value):
+    return f"{value:g}"
+
+
+def parse_olat_question(text):
+    """Splits the OLAT text of one question into its fields (up to Points) and its answer rows (lists of cells)."""
+    fields = {}
+    rows = []
+    in_answers = False
+    for line in text.split("\n"):
+        if in_answers:
+            if line.strip():
+                rows.append(line.split("\t"))
+            continue
+        name, _, value = line.partition("\t")
+        name = "Typ" if name.strip() == "Type" else name.strip()
+        fields.setdefault(name, value.strip())
+        if name == "Points":
+            in_answers = True
+    return fields, rows
+
+
+class _Response:
+    """The declaration of one response variable: correct values and the score of each value."""
+
+    def __init__(self, identifier, cardinality, base_type, case_sensitive=True):
+        self.identifier = identifier
+        self.cardinality = cardinality
+        self.base_type = base_type
+        self.case_sensitive = case_sensitive
+        self.correct = []
+        self.mapping = []  # (value, score)
+
+    def add(self, value, score):
+        if score:
+            self.mapping.append((value, score))
+        if score > 0:
+            self.correct.append(value)
+
+
+def _choice(fields, rows, body, single):
+    response = _Response("RESPONSE", "single" if single else "multiple", "identifier")
+    interaction = _element(
+        body, "choiceInteraction", responseIdentifier=response.identifier, shuffle="true",
+        maxChoices=1 if single else int(_score(fields.get("Max answers", "0"))),
+        minChoices=0 if single else int(_score(fields.get("Min answers", "0"))),
+    )
+    _element(interaction, "prompt", fields.get("Question", ""))
+    for index, cells in enumerate((cells for cells in rows if len(cells) >= 2), start=1):
+        identifier = f"choice_{index}"
+        _element(interaction, "simpleChoice", cells[1].strip(), identifier=identifier)
+        response.add(identifier, _score(cells[0]))
+    return [response] if response.mapping else []
+
+
+def _match(body, prompt, sources, targets):
+    """Adds a matchInteraction of `sources` to `targets`, both lists of (identifier, label)."""
+    response = _Response("RESPONSE", "multiple", "directedPair")
+    interaction = _element(
+        body, "matchInteraction", responseIdentifier=response.identifier, shuffle="false", maxAssociations=len(sources)
+    )
+    _element(interaction, "prompt", prompt)
+    source_set = _element(interaction, "simpleMatchSet")
+    for identifier, label in sources:
+        _element(source_set, "simpleAssociableChoice", label, identifier=identifier, matchMax=1)
+    target_set = _element(interaction, "simpleMatchSet")
+    for identifier, label in targets:
+        _element(target_set, "simpleAssociableChoice", label, identifier=identifier, matchMax=len(sources))
+    return response
+
+
+def _kprim(fields, rows, body):
+    statements = [cells for cells in rows if len(cells) >= 2]
+    if not statements:
+        return []
+    sources = [(f"statement_{index}", cells[1].strip()) for index, cells in enumerate(statements, start=1)]
+    response = _match(body, fields.get("Question", ""), sources, [(identifier, label) for identifier, label, _ in KPRIM_TARGETS])
+    # Each correctly classified statement is worth an equal share of the points.
+    share = _score(fields.get("Points", "0")) / len(statements)
+    for (source, _), cells in zip(sources, statements):
+        for target, _, marker in KPRIM_TARGETS:
+            if cells[0].strip() == marker:
+                response.add(f"{source} {target}", share)
+    return [response]
+
+
+def _table(fields, rows, body):
+    if len(rows) < 2 or rows[0][0].strip():
+        return []
+    header = [cell.strip() for cell in rows[0][1:] if cell.strip()]
+    items = [cells for cells in rows[1:] if cells[0].strip()]
+    sources = [(f"item_{index}", cells[0].strip()) for index, cells in enumerate(items, start=1)]
+    targets = [(f"target_{index}", label) for index, label in enumerate(header, start=1)]
+    response = _match(body, fields.get("Question", ""), sources, targets)
+    for (source, _), cells in zip(sources, items):
+        for (target, _), score in zip(targets, cells[1:]):
+            response.add(f"{source} {target}", _score(score))
+    return [response]
+
+
+def _gaps(fields, rows, body):
+    """FIB (text entry) and Inlinechoice questions: text rows with gap rows in between."""
+    paragraph = _element(body, "p")
+    responses = []
+    for cells in rows:
+        if cells[0] == "Text":
+            text = " ".join(cells[1:]).strip()
+            if text:
+                _append_text(paragraph, text + " ")
+            continue
+        if len(cells) < 2:
+            continue
+        response_id = f"RESPONSE_{len(responses) + 1}"
+        score = _score(cells[0])
+        if len(cells) >= 4:
+            # Inlinechoice: score, options separated by '|', correct option.
+            response = _Response(response_id, "single", "identifier")
+            interaction = _element(paragraph, "inlineChoiceInteraction", responseIdentifier=response_id, shuffle="false")
+            for index, option in enumerate(cells[1].split("|"), start=1):
+                # Choice identifiers must be unique within the whole item, not only within a gap.
+                identifier = f"{response_id}_option_{index}"
+                _element(interaction, "inlineChoice", option, identifier=identifier)
+                response.add(identifier, score if option == cells[2] else 0)
+        else:
+            # FIB: score, solution, input width.
+            response = _Response(response_id, "single", "string", case_sensitive=False)
+            _element(
+                paragraph, "textEntryInteraction", responseIdentifier=response_id,
+                expectedLength=int(_score(cells[2])) if len(cells) > 2 and _score(cells[2]) else len(cells[1]),
+            )
+            response.add(cells[1].strip(), score)
+        _append_text(paragraph, " ")
+        responses.append(response)
+    return responses
+
+
+def _value(parent, tag, value):
+    _element(_element(parent, tag), "value", value)
+
+
+def _response_processing(item, responses, has_feedback):
+    processing = _element(item, "responseProcessing")
+    for response in responses:
+        condition = _element(_element(processing, "responseCondition"), "responseIf")
+        _element(_element(_element(condition, "not"), "isNull"), "variable", identifier=response.identifier)
+        total = _element(_element(condition, "setOutcomeValue", identifier="SCORE"), "sum")
+        _element(total, "variable", identifier="SCORE")
+        _element(total, "mapResponse", identifier=response.identifier)
+    if has_feedback:
+        condition = _element(processing, "responseCondition")
+        branch = _element(condition, "responseIf")
+        comparison = _element(branch, "gte")
+        _element(comparison, "variable", identifier="SCORE")
+        _element(comparison, "variable", identifier="MAXSCORE")
+        _element(_element(branch, "setOutcomeValue", identifier="FEEDBACKBASIC"), "baseValue", "correct", baseType="identifier")
+        otherwise = _element(condition, "responseElse")
+        _element(_element(otherwise, "setOutcomeValue", identifier="FEEDBACKBASIC"), "baseValue", "incorrect", baseType="identifier")
+
+
+def question_item(identifier, text):
+    """
+    Returns the QTI 2.1 assessmentItem (UTF-8 XML bytes) of one question in OLAT text format,
+    or None if its type is unknown or it has no scorable answers.
+    """
+    fields, rows = parse_olat_question(text)
+    kind = fields.get("Typ", "").casefold()
+    body = ET.Element("itemBody")
+    if kind in ("sc", "mc"):
+        responses = _choice(fields, rows, body, single=kind == "sc")
+    elif kind == "kprim":
+        responses = _kprim(fields, rows, body)
+    elif kind in ("truefalse", "drag&drop"):
+        responses = _table(fields, rows, body)
+    elif kind in ("fib", "inlinechoice"):
+        responses = _gaps(fields, rows, body)
+    else:
+        return None
+    if not responses:
+        return None
+
+    title = fields.get("Title") or fields.get("Question") or identifier
+    item = _root(
+        "assessmentItem", QTI_NAMESPACE, QTI_SCHEMA_LOCATION,
+        identifier=identifier, title=title, adaptive="false", timeDependent="false",
+    )
+    # The schema prescribes the order: declarations, item body, response processing, feedback.
+    for response in responses:
+        declaration = _element(
+            item, "responseDeclaration", identifier=response.identifier,
+            cardinality=response.cardinality, baseType=response.base_type,
+        )
+        if response.correct:
+            correct = _element(declaration, "correctResponse")
+            for value in response.correct:
+                _element(correct, "value", value)
+        mapping = _element(declaration, "mapping", defaultValue="0", lowerBound="0")
+        for value, score in response.mapping:
+            _element(
+                mapping, "mapEntry", mapKey=value, mappedValue=_format_score(score),
+                caseSensitive="true" if response.case_sensitive else "false",
+            )
+    for outcome, default in (("SCORE", 0.0), ("MAXSCORE", _score(fields.get("Points", "0")))):
+        declaration = _element(item, "outcomeDeclaration", identifier=outcome, cardinality="single", baseType="float")
+        _value(declaration, "defaultValue", _format_score(default))
+    feedback = {
+        "correct": fields.get("Feedback correct answer", ""),
+        "incorrect": fields.get("Feedback wrong answer", ""),
+    }
+    has_feedback = any(feedback.values())
+    if has_feedback:
+        _element(item, "outcomeDeclaration", identifier="FEEDBACKBASIC", cardinality="single", baseType="identifier")
+    item.append(body)
+    _response_processing(item, responses, has_feedback)
+    for outcome_value, feedback_text in feedback.items():
+        if feedback_text:
+            _element(
+                item, "modalFeedback", feedback_text, outcomeIdentifier="FEEDBACKBASIC",
+                identifier=outcome_value, showHide="show",
+            )
+    return _to_bytes(item)
+
+
+def item_href(identifier):
+    return f"{ITEMS_DIRNAME}/{identifier}.xml"
+
+
+def assessment_test(identifier, title, sections):
+    """Returns the assessmentTest (XML bytes) with one section per (title, item identifiers) of `sections`."""
+    test = _root("assessmentTest", QTI_NAMESPACE, QTI_SCHEMA_LOCATION, identifier=identifier, title=title)
+    declaration = _element(test, "outcomeDeclaration", identifier="SCORE", cardinality="single", baseType="float")
+    _value(declaration, "defaultValue", "0")
+    part = _element(test, "testPart", identifier="part_1", navigationMode="nonlinear", submissionMode="individual")
+    for index, (section_title, items) in enumerate(sections, start=1):
+        section = _element(part, "assessmentSection", identifier=f"section_{index}", title=section_title, visible="true")
+        for item in items:
+            _element(section, "assessmentItemRef", identifier=item, href=item_href(item))
+    processing = _element(test, "outcomeProcessing")
+    total = _element(_element(processing, "setOutcomeValue", identifier="SCORE"), "sum")
+    _element(total, "testVariables", variableIdentifier="SCORE")
+    return _to_bytes(test)
+
+
+def manifest(identifier, items):
+    """Returns the IMS content package manifest (XML bytes) of a package with the test and `items`."""
+    root = _root("manifest", CP_NAMESPACE, CP_SCHEMA_LOCATION, identifier=identifier)
+    metadata = _element(root, "metadata")
+    _element(metadata, "schema", "QTIv2.1 Package")
+    _element(metadata, "schemaversion", "1.0.0")
+    _element(root, "organizations")
+    resources = _element(root, "resources")
+    test = _element(resources, "resource", identifier="test", type="imsqti_test_xmlv2p1", href=TEST_FILENAME)
+    _element(test, "file", href=TEST_FILENAME)
+    for item in items:
+        _element(test, "dependency", identifierref=item)
+    for item in items:
+        resource = _element(resources, "resource", identifier=item, type="imsqti_item_xmlv2p1", href=item_href(item))
+        _element(resource, "file", href=item_href(item))
+    return _to_bytes(root)
@@ -0,0 +1,119 @@
+# response_cache.py
+
+"""
+Provides a process-wide, disk-backed cache for OpenAI responses.
+Responses are keyed on a fingerprint of everything that influences the generated questions,
+so identical requests from different sessions are only paid for once.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from config import RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_AGE_SECONDS
+
+
+def request_fingerprint(prompt_template, user_input, learning_goals, image_digests, model, language, zielniveau, reasoning_effort, system_prompt="", image_detail=None):
+    """
+    Returns a stable hash over all inputs that determine the response of a single API request.
+    The image detail is only part of the hash when set, so keys of requests without it stay valid.
+    """
+    payload = {
+        "system_prompt": system_prompt,
+        "prompt_template": prompt_template,
+        "user_input": user_input,
+        "learning_goals": learning_goals,
+        "image_digests": list(image_digests),
+        "model": model,
+        "language": language,
+        "zielniveau": zielniveau,
+        "reasoning_effort": reasoning_effort,
+    }
+    if image_detail:
+        payload["image_detail"] = image_detail
+    serialized = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """A SQLite-backed key/value store with size- and age-based LRU eviction."""
+
+    def __init__(self, path, max_bytes, max_age_seconds):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    def _connect(self):
+        # A short-lived connection per operation keeps the cache safe to use from worker threads.
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, key):
+        """Returns the cached response for `key`, or None if it is missing or expired."""
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if now - created > self.max_age_seconds:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            return value
+
+    def set(self, key, value):
+        """Stores a response and evicts old or least recently used entries if necessary."""
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM responses WHERE created < ?", (now - self.max_age_seconds,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logging.info(f"Response-Cache: {len(evicted)} Einträge verdrängt.")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Returns the process-wide response cache, creating it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_AGE_SECONDS)
+        return _cache
@@ -0,0 +1,230 @@
+# scheduler.py
+
+"""
+Process-wide scheduling of OpenAI API requests.
+Requests are admitted per account (API key) and model, within the configured requests-per-minute
+and tokens-per-minute budgets if any, queued fairly across sessions, and retried with jittered
+exponential backoff when the API answers with a rate limit or a transient error.
+"""
+
+import collections
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+import metrics
+from config import (
+    MODEL_RATE_LIMITS, DEFAULT_RATE_LIMIT, MAX_API_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+)
+
+WINDOW_SECONDS = 60.0
+
+# The session on whose behalf requests are made; sessions are served round-robin.
+_current_session = contextvars.ContextVar("scheduler_session", default="default")
+
+
+@contextmanager
+def session(session_id):
+    """Attributes all requests made inside the block to `session_id` for fair queueing."""
+    token = _current_session.set(session_id)
+    try:
+        yield
+    finally:
+        _current_session.reset(token)
+
+
+class _Slot:
+    """The budget taken by one admitted request; its token estimate is corrected once the usage is known."""
+
+    def __init__(self, scheduler, entry):
+        self._scheduler = scheduler
+        self._entry = entry
+
+    def record_tokens(self, tokens):
+        self._scheduler._correct(self._entry, tokens)
+
+
+class RateLimitScheduler:
+    """
+    Admits requests per bucket, an (account, model) pair, within sliding one-minute RPM and TPM
+    windows. Every API key has budgets of its own; models without a limit are only paused after
+    the API reported a rate limit.
+    """
+
+    def __init__(self, limits=MODEL_RATE_LIMITS, default_limit=DEFAULT_RATE_LIMIT):
+        self._limits = limits
+        self._default_limit = default_limit
+        self._condition = threading.Condition()
+        # bucket -> deque of [admitted_at, tokens] within the current window
+        self._windows = collections.defaultdict(collections.deque)
+        # bucket -> session -> deque of waiting tickets; sessions take turns in insertion order
+        self._queues = collections.defaultdict(collections.OrderedDict)
+        self._paused_until = collections.defaultdict(float)
+
+    def _limit(self, bucket):
+        return self._limits.get(bucket[1], self._default_limit)
+
+    def _trim(self, bucket, now):
+        window = self._windows[bucket]
+        while window and window[0][0] <= now - WINDOW_SECONDS:
+            window.popleft()
+
+    def _delay(self, bucket, tokens, now):
+        """Returns how long a request of `tokens` tokens has to wait before it fits the budgets."""
+        self._trim(bucket, now)
+        window = self._windows[bucket]
+        limit = self._limit(bucket)
+        delay = max(0.0, self._paused_until[bucket] - now)
+        if limit is None:
+            return delay
+        if len(window) >= limit["rpm"]:
+            delay = max(delay, window[len(window) - limit["rpm"]][0] + WINDOW_SECONDS - now)
+        used = sum(entry[1] for entry in window)
+        # A request larger than the whole budget is admitted once the window is empty.
+        for admitted_at, entry_tokens in window:
+            if used + tokens <= limit["tpm"]:
+                break
+            used -= entry_tokens
+            delay = max(delay, admitted_at + WINDOW_SECONDS - now)
+        return delay
+
+    def _next_ticket(self, bucket):
+        queues = self._queues[bucket]
+        return next(iter(queues.values()))[0] if queues else None
+
+    @contextmanager
+    def slot(self, model, tokens, account="default"):
+        """
+        Blocks until a request of about `tokens` tokens may be sent to `model` with the API key
+        identified by `account` (see openai_client.client_account), then yields its _Slot.
+        """
+        bucket = (account, model)
+        session_id = _current_session.get()
+        ticket = object()
+        queued_at = time.monotonic()
+        with self._condition:
+            self._queues[bucket].setdefault(session_id, collections.deque()).append(ticket)
+            while True:
+                now = time.monotonic()
+                delay = self._delay(bucket, tokens, now)
+                if self._next_ticket(bucket) is ticket and delay <= 0:
+                    break
+                self._condition.wait(timeout=delay if delay > 0 else None)
+
+            queues = self._queues[bucket]
+            queues[session_id].popleft()
+            # The session moves to the back of the line, so other sessions get the next turn.
+            waiting = queues.pop(session_id)
+            if waiting:
+                queues[session_id] = waiting
+            entry = [now, tokens]
+            self._windows[bucket].append(entry)
+            self._condition.notify_all()
+        metrics.observe("rate_limit_wait", time.monotonic() - queued_at)
+        yield _Slot(self, entry)
+
+    def _correct(self, entry, tokens):
+        with self._condition:
+            entry[1] = tokens
+            self._condition.notify_all()
+
+    def pause(self, model, seconds, account="default"):
+        """Stops admitting requests for `model` with `account`, e.g. after the API reported a rate limit."""
+        bucket = (account, model)
+        with self._condition:
+            self._paused_until[bucket] = max(self._paused_until[bucket], time.monotonic() + seconds)
+
+    def status(self, model, account="default"):
+        """
+        Returns the number of queued requests for `model` with `account` and a rough estimate of
+        their wait in seconds.
+        """
+        bucket = (account, model)
+        with self._condition:
+            now = time.monotonic()
+            depth = sum(len(waiting) for waiting in self._queues[bucket].values())
+            wait = max(0.0, self._paused_until[bucket] - now)
+            limit = self._limit(bucket)
+            if limit is not None:
+                window = self._windows[bucket]
+                self._trim(bucket, now)
+                average_tokens = sum(entry[1] for entry in window) / len(window) if window else 0
+                wait += depth * WINDOW_SECONDS * max(1 / limit["rpm"], average_tokens / limit["tpm"])
+            return depth, wait
+
+
+def _retry_after(error):
+    """Returns the delay the API asked for in its Retry-After headers, if any."""
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+def _is_retryable(error):
+    import openai
+
+    if isinstance(error, openai.RateLimitError):
+        # An exhausted quota does not recover by waiting.
+        return getattr(error, "code", None) != "insufficient_quota"
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return isinstance(error, (openai.APIConnectionError, openai.APITimeoutError))
+
+
+def call_with_retries(model, tokens, function, account="default"):
+    """
+    Calls `function(slot)` within the rate limits of `model` with `account` and retries it on rate limits and
+    transient errors. The delay honours Retry-After and otherwise grows exponentially with full
+    jitter. Errors that are not retryable, errors of calls that already streamed output
+    (marked with a true `partial_output` attribute) and errors after MAX_API_RETRIES retries
+    are raised to the caller.
+    """
+    from openai import RateLimitError
+
+    scheduler = get_scheduler()
+    for attempt in range(MAX_API_RETRIES + 1):
+        slot = None
+        try:
+            with scheduler.slot(model, tokens, account) as slot:
+                return function(slot)
+        except Exception as e:
+            if slot and isinstance(e, RateLimitError):
+                # A rejected request has not used any tokens.
+                slot.record_tokens(0)
+            if attempt == MAX_API_RETRIES or not _is_retryable(e) or getattr(e, "partial_output", False):
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            if isinstance(e, RateLimitError):
+                scheduler.pause(model, delay, account)
+            metrics.count("api_retries", reason=type(e).__name__)
+            logging.warning(f"{type(e).__name__} bei {model}, neuer Versuch {attempt + 1}/{MAX_API_RETRIES} in {delay:.1f} s.")
+            time.sleep(delay)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Returns the process-wide scheduler shared by all sessions."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RateLimitScheduler()
+        return _scheduler
+
+
+def set_scheduler(scheduler):
+    """Replaces the process-wide scheduler, e.g. with one of different limits for benchmarks."""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
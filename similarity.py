@@ -0,0 +1,120 @@
+# similarity.py
+
+"""
+Local near-duplicate detection for generated questions.
+Question stems are reduced to character shingles and MinHash signatures; a banded LSH index finds
+stems about the same fact across question types and chunks without any network call.
+"""
+
+import random
+import re
+import threading
+import zlib
+import validation
+from config import SIMILARITY_THRESHOLD, MAX_COVERED_QUESTIONS
+
+SHINGLE_SIZE = 5
+NUM_PERMUTATIONS = 64
+# 16 bands of 4 rows: pairs with a Jaccard similarity of 0.5 become candidates with ~65% probability,
+# pairs at 0.7 with ~99%.
+LSH_BANDS = 16
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20240601)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def shingles(text):
+    """Returns the character shingles of a text, after lower-casing and collapsing punctuation."""
+    normalized = " ".join(WORD_PATTERN.findall(text.lower()))
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def minhash(shingle_set):
+    """Returns the MinHash signature of a set of shingles."""
+    hashes = [zlib.crc32(shingle.encode("utf-8")) for shingle in shingle_set] or [0]
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def estimated_similarity(signature_a, signature_b):
+    return sum(1 for a, b in zip(signature_a, signature_b) if a == b) / NUM_PERMUTATIONS
+
+
+def question_stems(msg_type, response):
+    """
+    Returns the stem of every question of a raw response: Title and Question of OLAT questions,
+    plus the statements of Truefalse and Drag&Drop tables (whose Question is boilerplate), or
+    the text of inline_fib items.
+    """
+    questions = validation.split_questions(msg_type, response) or []
+    if msg_type == "inline_fib":
+        return [str(item.get("text", "")) for item in questions if isinstance(item, dict)]
+    stems = []
+    for block in questions:
+        parts = []
+        in_table = False
+        for line in block.split("\n"):
+            name, _, value = line.partition("\t")
+            if name in ("Title", "Question"):
+                parts.append(value)
+            elif not name and value:
+                in_table = True
+            elif in_table and name:
+                parts.append(name)
+        stems.append(" ".join(parts))
+    return stems
+
+
+class QuestionIndex:
+    """A MinHash LSH index over the question stems of one generation run; safe to use from several threads."""
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD):
+        self._threshold = threshold
+        self._lock = threading.Lock()
+        self._entries = []  # (label, stem, signature)
+        self._buckets = {}  # (band, band values) -> entry indexes
+
+    def _bands(self, signature):
+        rows = NUM_PERMUTATIONS // LSH_BANDS
+        return [(band, signature[band * rows:(band + 1) * rows]) for band in range(LSH_BANDS)]
+
+    def add(self, label, stem):
+        """
+        Adds a question stem under `label` (e.g. its type and number) and returns the labels and
+        stems of earlier questions it nearly duplicates, most similar first.
+        """
+        signature = minhash(shingles(stem))
+        with self._lock:
+            candidates = set()
+            for key in self._bands(signature):
+                candidates.update(self._buckets.get(key, ()))
+            matches = []
+            for index in candidates:
+                other_label, other_stem, other_signature = self._entries[index]
+                similarity = estimated_similarity(signature, other_signature)
+                if similarity >= self._threshold:
+                    matches.append((similarity, other_label, other_stem))
+            index = len(self._entries)
+            self._entries.append((label, stem, signature))
+            for key in self._bands(signature):
+                self._buckets.setdefault(key, []).append(index)
+        return [(other_label, other_stem) for _, other_label, other_stem in sorted(matches, key=lambda m: -m[0])]
+
+    def stems(self):
+        """Returns all indexed stems in the order they were added."""
+        with self._lock:
+            return [stem for _, stem, _ in self._entries]
+
+
+def covered_prompt(covered_questions):
+    """Returns the prompt section that lists questions already generated for other types."""
+    listed = "\n".join(f"- {stem}" for stem in covered_questions[-MAX_COVERED_QUESTIONS:])
+    return (
+        "\n\n//already_covered\n"
+        "- The following questions were already generated for other question types. Do NOT ask about "
+        "the same facts again; cover other content of the text instead.\n"
+        f"{listed}"
+    )
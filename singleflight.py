@@ -0,0 +1,93 @@
+# singleflight.py
+
+"""
+Coalesces identical concurrent calls: while a call for a key is in flight, further callers
+with the same key wait for it and receive its result instead of starting their own.
+Only results are shared; a caller whose shared call failed makes its own call.
+"""
+
+import threading
+
+
+class _Call:
+    """One in-flight call, with the streamed text fragments it has produced so far."""
+
+    def __init__(self, streaming):
+        # Whether the call streams fragments at all; decided by the caller that started it.
+        self.streaming = streaming
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.deltas = []
+        self.listeners = []
+        self.result = None
+        self.error = None
+
+    def broadcast(self, delta):
+        with self.lock:
+            self.deltas.append(delta)
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(delta)
+
+    def subscribe(self, on_delta):
+        """Replays the fragments streamed so far to `on_delta` and forwards all further ones."""
+        with self.lock:
+            replay = list(self.deltas)
+            self.listeners.append(on_delta)
+        for delta in replay:
+            on_delta(delta)
+
+
+class SingleFlight:
+    """A process-wide registry of in-flight calls, keyed e.g. on a request fingerprint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, on_delta=None):
+        """
+        Runs `function(on_delta)` unless a call with the same key is already running, whose result is
+        then shared. Returns the result and whether it was shared from another caller's call.
+        Errors are not shared: if the running call fails (e.g. because of its caller's API key or
+        quota), a waiting caller makes its own call; only if fragments of the failed call were already
+        streamed to it, the error is raised, since output already shown cannot be taken back.
+        Streamed fragments are passed to the `on_delta` of every caller, including fragments streamed
+        before a caller joined. If the running call does not stream, a caller with `on_delta`
+        receives the complete result as one fragment.
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call(streaming=on_delta is not None)
+            if leader:
+                break
+
+            received = []
+            if on_delta and call.streaming:
+                def forward(delta):
+                    received.append(len(delta))
+                    on_delta(delta)
+                call.subscribe(forward)
+            call.done.wait()
+            if call.error is None:
+                if on_delta and not call.streaming and call.result:
+                    on_delta(call.result)
+                return call.result, True
+            if received:
+                raise call.error
+
+        if on_delta:
+            call.subscribe(on_delta)
+        try:
+            call.result = function(call.broadcast if on_delta else None)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
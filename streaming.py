@@ -0,0 +1,137 @@
+# streaming.py
+
+"""
+Incremental parsers that turn a streamed model response into finished questions
+as soon as each question is complete.
+"""
+
+import json
+import re
+
+# Every OLAT question block starts with a 'Typ' (or 'Type') line, e.g. "Typ\tKPRIM".
+OLAT_HEADER_PATTERN = re.compile(r'^\s*Type?[\t ]')
+
+
+class OlatBlockParser:
+    """
+    Splits tab-separated OLAT text into question blocks.
+    A block is finished as soon as the header line of the next block has arrived.
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._current = []
+
+    def feed(self, text):
+        """Adds streamed text and returns the list of question blocks completed by it."""
+        self._pending += text
+        *lines, self._pending = self._pending.split("\n")
+        finished = []
+        for line in lines:
+            block = self._add_line(line)
+            if block:
+                finished.append(block)
+        return finished
+
+    def close(self):
+        """Flushes the remaining text and returns the last question block(s)."""
+        finished = []
+        if self._pending:
+            block = self._add_line(self._pending)
+            self._pending = ""
+            if block:
+                finished.append(block)
+        block = self._flush()
+        if block:
+            finished.append(block)
+        return finished
+
+    def _add_line(self, line):
+        line = line.rstrip("\r")
+        if OLAT_HEADER_PATTERN.match(line):
+            block = self._flush()
+            self._current = [line]
+            return block
+        if self._current:
+            self._current.append(line)
+        return None
+
+    def _flush(self):
+        # Drop trailing blank lines and closing code fences the model sometimes appends.
+        while self._current and (not self._current[-1].strip() or self._current[-1].strip().startswith("```")):
+            self._current.pop()
+        block = "\n".join(self._current)
+        self._current = []
+        return block or None
+
+
+class InlineFibParser:
+    """
+    Extracts the objects of the inline_fib JSON array one by one while the array is still streaming.
+    Text before the array (e.g. a ```json fence) is ignored.
+    """
+
+    def __init__(self):
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._object_chars = []
+
+    def feed(self, text):
+        """Adds streamed text and returns the list of completed question objects."""
+        finished = []
+        for char in text:
+            capturing = len(self._stack) >= 2 and self._stack[1] == "{"
+            if capturing:
+                self._object_chars.append(char)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"' and self._stack:
+                self._in_string = True
+            elif char in "[{":
+                if not self._stack and char != "[":
+                    continue
+                if len(self._stack) == 1 and char == "{":
+                    self._object_chars = [char]
+                self._stack.append(char)
+            elif char in "]}" and self._stack:
+                self._stack.pop()
+                if len(self._stack) == 1 and char == "}":
+                    item = self._decode("".join(self._object_chars))
+                    if item is not None:
+                        finished.append(item)
+                    self._object_chars = []
+        return finished
+
+    def close(self):
+        """Returns nothing; incomplete trailing objects cannot be recovered."""
+        return []
+
+    @staticmethod
+    def _decode(raw):
+        try:
+            item = json.loads(raw)
+        except json.JSONDecodeError:
+            return None
+        return item if isinstance(item, dict) else None
+
+
+def split_olat_blocks(text):
+    """Splits a complete OLAT response into its question blocks."""
+    parser = OlatBlockParser()
+    return parser.feed(text) + parser.close()
+
+
+def make_question_parser(msg_type):
+    """Returns the incremental parser matching the output format of a question type."""
+    if msg_type == "inline_fib":
+        return InlineFibParser()
+    return OlatBlockParser()
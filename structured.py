@@ -0,0 +1,171 @@
+# structured.py
+
+"""
+Structured-output mode: the model returns compact JSON that follows a schema per question type,
+and the OLAT text in the //templates_closed.txt layout is rendered locally.
+Fixed parts of the layout (type, constant fields, scores and points) are taken from the type's
+template instead of being generated, which saves completion tokens and parsing failures.
+"""
+
+import json
+import logging
+import validation
+
+# Rows of Truefalse questions, as in the truefalse template: columns and the scores of a true and a false statement.
+TRUEFALSE_COLUMNS = ("Unanswered", "Right", "Wrong")
+TRUEFALSE_SCORES = {True: ("0", "1", "-0.5"), False: ("0", "-0.5", "1")}
+# Score of a drag item in a drop category it does not belong to, as in the draganddrop template.
+DRAG_WRONG_SCORE = "-0.5"
+
+STRING = {"type": "string"}
+# Template fields that are filled from the generated JSON, by their JSON property.
+GENERATED_FIELDS = {
+    "Level": "level",
+    "Feedback correct answer": "feedback_correct",
+    "Feedback wrong answer": "feedback_wrong",
+    "Title": "title",
+    "Question": "question",
+}
+
+
+def _object(properties, description=None):
+    # Structured outputs in strict mode require every property and no additional ones.
+    schema = {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+    if description:
+        schema["description"] = description
+    return schema
+
+
+def _array(items, description=None):
+    schema = {"type": "array", "items": items}
+    if description:
+        schema["description"] = description
+    return schema
+
+
+def _is_score_marker(marker):
+    return bool(validation.NUMBER_PATTERN.match(marker))
+
+
+def _question_schema(msg_type):
+    if msg_type == "inline_fib":
+        return _object({
+            "text": STRING,
+            "blanks": _array(STRING, f"Exactly {validation.FIB_BLANKS} words of the text to be blanked out"),
+            "wrong_substitutes": _array(STRING, f"Exactly {validation.FIB_BLANKS} wrong alternatives"),
+        })
+    template = validation.olat_template(msg_type)
+    properties = {GENERATED_FIELDS[field]: STRING for field in template.fields if field in GENERATED_FIELDS}
+    if template.type_name.casefold() == "truefalse":
+        rows = validation.TABLE_LIMITS["truefalse"]["rows"]
+        properties["statements"] = _array(
+            _object({"text": STRING, "correct": {"type": "boolean"}}), f"Exactly {rows[1]} statements"
+        )
+    elif template.is_table:
+        limits = validation.TABLE_LIMITS["drag&drop"]
+        properties["categories"] = _array(STRING, f"{limits['columns'][0]} to {limits['columns'][1]} drop categories")
+        properties["items"] = _array(
+            _object({"text": STRING, "category": {"type": "integer", "description": "0-based index of the correct category"}}),
+            f"{limits['rows'][0]} to {limits['rows'][1]} drag items",
+        )
+    elif all(marker in ("+", "-") for marker in template.answer_markers):
+        properties["answers"] = _array(
+            _object({"text": STRING, "correct": {"type": "boolean"}}),
+            f"Exactly {len(template.answer_markers)} statements, each correct or incorrect",
+        )
+    else:
+        correct = sum(1 for marker in template.answer_markers if _is_score_marker(marker) and float(marker) > 0)
+        properties["correct_answers"] = _array(STRING, f"Exactly {correct} correct answer(s)")
+        properties["incorrect_answers"] = _array(
+            STRING, f"Exactly {len(template.answer_markers) - correct} incorrect answer(s)"
+        )
+    return _object(properties)
+
+
+def response_schema(msg_type):
+    """Returns the name and JSON schema of the structured response for a question type."""
+    return f"{msg_type.replace('&', '_')}_questions", _object({"questions": _array(_question_schema(msg_type))})
+
+
+def structured_prompt(prompt_template):
+    """Appends the output instructions of the structured mode to a type prompt."""
+    return (
+        f"{prompt_template}\n\n"
+        "//structured_output\n"
+        "- IMPORTANT: do NOT write the //templates_closed.txt text. Return the questions as JSON that matches the "
+        "given response schema; it is converted to the template automatically, including type, scores and points.\n"
+        "- All //instruction, //output and //rules about the number and content of questions and answers still apply."
+    )
+
+
+def _render_choice(template, question):
+    answer_rows = []
+    if "answers" in question:
+        for answer in question["answers"]:
+            answer_rows.append(("+" if answer["correct"] else "-", answer["text"]))
+        points = template.points
+    else:
+        correct = iter(question["correct_answers"])
+        incorrect = iter(question["incorrect_answers"])
+        # Scores are assigned in the order of the template: positive markers to the correct answers.
+        for marker in template.answer_markers:
+            answer = next(correct, None) if float(marker) > 0 else next(incorrect, None)
+            if answer is not None:
+                answer_rows.append((marker, answer))
+        # Surplus answers keep the type's score for their kind, so that validation reports their number.
+        positive = [m for m in template.answer_markers if float(m) > 0]
+        negative = [m for m in template.answer_markers if float(m) <= 0]
+        answer_rows += [(positive[-1] if positive else "1", answer) for answer in correct]
+        answer_rows += [(negative[-1] if negative else "-0.5", answer) for answer in incorrect]
+        points = template.points if _is_score_marker(template.points) else f"{sum(float(m) for m in positive):g}"
+    return points, [f"{marker}\t{text}" for marker, text in answer_rows]
+
+
+def _render_table(template, question):
+    if "statements" in question:
+        header = TRUEFALSE_COLUMNS
+        rows = [(statement["text"], TRUEFALSE_SCORES[bool(statement["correct"])]) for statement in question["statements"]]
+    else:
+        header = tuple(question["categories"])
+        rows = [
+            (item["text"], tuple("1" if column == item["category"] else DRAG_WRONG_SCORE for column in range(len(header))))
+            for item in question["items"]
+        ]
+    lines = ["\t" + "\t".join(header)] + [f"{text}\t" + "\t".join(scores) for text, scores in rows]
+    return str(len(rows)), lines
+
+
+def render_question(template, question):
+    """Renders one structured question as an OLAT text block in the layout of `template`."""
+    if template.is_table:
+        points, answer_lines = _render_table(template, question)
+    else:
+        points, answer_lines = _render_choice(template, question)
+    lines = []
+    for field, value in template.values:
+        if field == "Typ":
+            value = template.type_name
+        elif field == "Points":
+            value = points
+        elif field in GENERATED_FIELDS:
+            value = question.get(GENERATED_FIELDS[field], "")
+        lines.append(f"{field}\t{value}")
+    return "\n".join(lines + answer_lines)
+
+
+def render_response(msg_type, response):
+    """
+    Converts a structured response into the text the type would produce without the structured
+    mode: OLAT question blocks, or the inline_fib JSON list. A response that cannot be converted
+    is returned unchanged, so that validation reports it.
+    """
+    try:
+        # Structured outputs are exact JSON; no salvaging as with free-text inline_fib answers.
+        questions = json.loads(response)["questions"]
+        if msg_type == "inline_fib":
+            return json.dumps(questions, ensure_ascii=False, indent=2)
+        template = validation.olat_template(msg_type)
+        return "\n\n".join(render_question(template, question) for question in questions)
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError, IndexError) as e:
+        logging.warning(f"Strukturierte Antwort für {msg_type} konnte nicht umgewandelt werden: {e}")
+        return response
@@ -0,0 +1,33 @@
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import qti  # noqa: E402
+from core import convert_json_to_text_format  # noqa: E402
+
+
+def test_inline_choice_identifiers_are_unique_within_an_item():
+    items = [{
+        "text": "Die Schweiz hat 26 Kantone und vier Landessprachen.",
+        "blanks": ["26", "vier"],
+        "wrong_substitutes": ["drei"],
+    }]
+    _, inline_choice_text = convert_json_to_text_format(items)
+    item = ET.fromstring(qti.question_item("inline_fib_1", inline_choice_text))
+
+    interactions = item.findall(f".//{{{qti.QTI_NAMESPACE}}}inlineChoiceInteraction")
+    identifiers = [choice.get("identifier") for choice in item.iter(f"{{{qti.QTI_NAMESPACE}}}inlineChoice")]
+    assert len(interactions) == 2
+    assert len(identifiers) == 6
+    assert len(set(identifiers)) == len(identifiers)
+
+    # The correct response and the mapping of every gap refer to choices of that gap.
+    for interaction in interactions:
+        response_id = interaction.get("responseIdentifier")
+        declaration = item.find(f"{{{qti.QTI_NAMESPACE}}}responseDeclaration[@identifier='{response_id}']")
+        referenced = {value.text for value in declaration.iter(f"{{{qti.QTI_NAMESPACE}}}value")}
+        referenced |= {entry.get("mapKey") for entry in declaration.iter(f"{{{qti.QTI_NAMESPACE}}}mapEntry")}
+        choices = {choice.get("identifier") for choice in interaction}
+        assert referenced and referenced <= choices
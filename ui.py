@@ -67,7 +67,7 @@ def render_main_page(text_from_files, images_from_files):
         st.success(f"{len(images_from_files)} Bild(er) erfolgreich geladen.")
         cols = st.columns(min(len(images_from_files), 5))
         for idx, img in enumerate(images_from_files):
-            cols[idx % 5].image(img, use_column_width=True, caption=f"Bild {idx+1}")
+            cols[idx % 5].image(img.thumbnail_bytes, use_column_width=True, caption=f"Bild {idx+1}")
 
     user_input = st.text_area("Geben Sie Ihren Text ein oder fügen Sie den extrahierten Text hier ein:", value=text_from_files, height=300)
     learning_goals = st.text_area("Lernziele (Optional):", help="Beschreiben Sie, was die Lernenden nach Beantwortung der Fragen wissen oder können sollen.")
@@ -4,53 +4,159 @@
 Contains utility functions for image processing, text cleaning, and file reading.
 """
 
-import streamlit as st
-import os
 import io
 import base64
 import re
-from PIL import Image
+import hashlib
+from dataclasses import dataclass
+import metrics
+from config import BLANK_IMAGE_STDDEV
+from prompt_registry import get_prompt
 
-@st.cache_data
 def read_prompt_from_md(filename):
-    """Reads a prompt from a markdown file and caches the result."""
-    file_path = os.path.join("prompts", f"{filename}.md")
-    with open(file_path, "r", encoding="utf-8") as file:
-        return file.read()
+    """Returns the prompt prompts/<filename>.md from the process-wide prompt registry."""
+    return get_prompt(filename)
 
-def process_image(_image):
+@dataclass(frozen=True)
+class EncodedImage:
     """
-    Processes and resizes an image to reduce memory usage, returning a base64 string.
-    This function now correctly handles file paths, bytes, PIL.Image objects, and Streamlit's UploadedFile.
+    An image that has already been converted, downscaled and JPEG-encoded.
+    It is produced once per upload and reused for content hashing, previews and API payloads.
+    Only compressed bytes are kept; no decoded bitmap outlives encode_image.
     """
+    jpeg_bytes: bytes
+    thumbnail_bytes: bytes
+    digest: str
+    width: int
+    height: int
+    # Perceptual difference hash and blank-page flag, see image_dedupe.py.
+    dhash: int = None
+    is_blank: bool = False
+
+    @property
+    def base64(self):
+        """Returns the JPEG as base64 string; computed on demand so it is not held in memory twice."""
+        return base64.b64encode(self.jpeg_bytes).decode('utf-8')
+
+    @property
+    def data_url(self):
+        """Returns the image as a data URL suitable for the OpenAI image inputs."""
+        return f"data:image/jpeg;base64,{self.base64}"
+
+    @property
+    def size_bytes(self):
+        """Returns the number of bytes held by this image."""
+        return len(self.jpeg_bytes) + len(self.thumbnail_bytes)
+
+
+# Longest side in pixels of images sent to the model.
+MAX_IMAGE_SIZE = 1024
+# Longest side in pixels of the preview thumbnails shown in the app.
+THUMBNAIL_SIZE = 256
+# The difference hash compares neighbouring pixels of a (DHASH_SIZE + 1) x DHASH_SIZE grayscale image.
+DHASH_SIZE = 16
+
+
+def _to_jpeg(img, quality):
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def encode_image(_image):
+    """
+    Processes and resizes an image to reduce memory usage, returning an EncodedImage.
+    This function handles base64 strings, bytes, PIL.Image objects, Streamlit's UploadedFile
+    and EncodedImage objects (which are returned unchanged).
+    """
+    if isinstance(_image, EncodedImage):
+        return _image
+    with metrics.timed("image_encoding"):
+        return _encode_image(_image)
+
+
+def _encode_image(_image, max_size=MAX_IMAGE_SIZE):
+    # Pillow is only needed once an image is actually processed.
+    from PIL import Image, ImageStat
+
     img = None
-    # --- START OF FIX ---
     # Check if the input is already a PIL Image object.
     if isinstance(_image, Image.Image):
         img = _image
-    # Check if the input is a file path (string) or raw bytes.
+    # Check if the input is a base64 string or raw bytes.
     elif isinstance(_image, (str, bytes)):
         img = Image.open(io.BytesIO(base64.b64decode(_image) if isinstance(_image, str) else _image))
     # Otherwise, assume it's a file-like object (e.g., from st.file_uploader)
     else:
         img = Image.open(_image)
-    # --- END OF FIX ---
+
+    # Let the JPEG decoder downscale while decoding, so phone photos are never held at full resolution.
+    if img.format == 'JPEG':
+        img.draft('RGB', (max_size, max_size))
 
     # Convert to RGB mode if necessary (e.g., for PNGs with transparency)
     if img.mode != 'RGB':
         img = img.convert('RGB')
 
     # Resize the image if it's too large to save tokens and processing time
-    max_size = 1024
     if max(img.size) > max_size:
         img.thumbnail((max_size, max_size))
 
-    # Save the processed image to an in-memory byte buffer
-    img_byte_arr = io.BytesIO()
-    img.save(img_byte_arr, format='JPEG', quality=85)
-    
-    # Return the image as a base64 encoded string
-    return base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+    # Keep only the compressed image and a small preview; decoded bitmaps are not retained.
+    jpeg_bytes = _to_jpeg(img, quality=85)
+    width, height = img.size
+    preview = img.copy()
+    preview.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    thumbnail_bytes = _to_jpeg(preview, quality=75)
+    gray = preview.convert('L')
+
+    return EncodedImage(
+        jpeg_bytes=jpeg_bytes,
+        thumbnail_bytes=thumbnail_bytes,
+        digest=hashlib.sha256(jpeg_bytes).hexdigest(),
+        width=width,
+        height=height,
+        dhash=_dhash(gray),
+        is_blank=ImageStat.Stat(gray).stddev[0] < BLANK_IMAGE_STDDEV,
+    )
+
+
+def scaled_size(width, height, max_size):
+    """Returns the size of a width x height image after downscaling its longest side to `max_size`."""
+    if max(width, height) <= max_size:
+        return width, height
+    scale = max_size / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def downscale_image(image, max_size):
+    """
+    Returns an EncodedImage whose longest side is at most `max_size`, re-encoded from the JPEG of
+    `image`; images that are already small enough are returned unchanged.
+    """
+    image = encode_image(image)
+    if max(image.width, image.height) <= max_size:
+        return image
+    with metrics.timed("image_encoding"):
+        return _encode_image(image.jpeg_bytes, max_size)
+
+
+def _dhash(gray):
+    """Returns the difference hash of a grayscale image: one bit per horizontally adjacent pixel pair."""
+    from PIL import Image
+
+    pixels = gray.resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BILINEAR).tobytes()
+    bits = 0
+    for row in range(DHASH_SIZE):
+        for col in range(DHASH_SIZE):
+            left = pixels[row * (DHASH_SIZE + 1) + col]
+            bits = (bits << 1) | (left > pixels[row * (DHASH_SIZE + 1) + col + 1])
+    return bits
+
+
+def process_image(_image):
+    """Processes and resizes an image, returning a base64 string."""
+    return encode_image(_image).base64
 
 
 def replace_german_sharp_s(text):
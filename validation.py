@@ -0,0 +1,277 @@
+# validation.py
+
+"""
+Per-question validation of model output against the formats in prompts/*.md.
+The OLAT rules of a type are read from its //templates_closed.txt template (fields, number of
+answers, correct answers and points); the table limits and the inline_fib rules mirror the
+//rules sections, which are prose. Invalid questions can then be re-requested on their own.
+"""
+
+import json
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from utils import read_prompt_from_md, clean_json_string
+from streaming import split_olat_blocks
+
+TEMPLATE_MARKER = "//templates_closed.txt"
+# Rows of Truefalse and Drag&Drop questions, from the //rules sections: (min, max) columns and rows.
+TABLE_LIMITS = {
+    "truefalse": {"columns": (3, 3), "rows": (3, 3)},
+    "drag&drop": {"columns": (2, 4), "rows": (2, 5)},
+}
+# Blanks and wrong substitutes per inline_fib text, from the //rules section of inline_fib.md.
+FIB_BLANKS = 5
+
+NUMBER_PATTERN = re.compile(r"^-?\d+(\.\d+)?$")
+# "Title: ..." or "Title    ..." instead of "Title\t...", as in some of the prompt examples.
+SEPARATOR_PATTERN = re.compile(r"\s*:\s*|\s{2,}")
+
+
+@dataclass(frozen=True)
+class OlatTemplate:
+    """The format of one OLAT question type, as given by its //templates_closed.txt template."""
+    type_name: str
+    fields: tuple
+    # (field, template value) of every field, e.g. ("Max answers", "4"); placeholders included.
+    values: tuple
+    points: str
+    answer_markers: tuple
+    is_table: bool
+
+    @property
+    def correct_answers(self):
+        """Number of answers with a positive score in the template, e.g. 2 for multiple_choice2."""
+        return sum(1 for marker in self.answer_markers if NUMBER_PATTERN.match(marker) and float(marker) > 0)
+
+
+def _is_placeholder(cell):
+    return cell.startswith("{") and cell.endswith("}")
+
+
+@lru_cache(maxsize=None)
+def _parse_template(template_line):
+    fields = []
+    values = []
+    points = ""
+    answer_markers = []
+    is_table = False
+    in_answers = False
+    for line in template_line.strip().split("\\n"):
+        cells = line.split("\\t")
+        if in_answers:
+            if cells[0] == "":
+                is_table = True
+            else:
+                answer_markers.append(cells[0])
+            continue
+        if _is_placeholder(cells[0]):
+            continue
+        fields.append(cells[0])
+        values.append((cells[0], cells[1] if len(cells) > 1 else ""))
+        if cells[0] == "Points":
+            points = cells[1] if len(cells) > 1 else ""
+            in_answers = True
+    type_name = template_line.split("\\n", 1)[0].split("\\t")[-1]
+    return OlatTemplate(type_name, tuple(fields), tuple(values), points, tuple(answer_markers), is_table)
+
+
+def olat_template(msg_type):
+    """Returns the OlatTemplate of a question type, or None for types without an OLAT template (inline_fib)."""
+    lines = read_prompt_from_md(msg_type).splitlines()
+    # The marker is also mentioned in the prose of the prompts; the template follows it on its own line.
+    start = next((i for i, line in enumerate(lines) if line.strip() == TEMPLATE_MARKER), None)
+    if start is None:
+        return None
+    template_line = next((line for line in lines[start + 1:] if line.strip()), "")
+    return _parse_template(template_line)
+
+
+def normalize_olat_block(block, template):
+    """
+    Fixes formatting slips that need no new content: a ':' or a run of spaces instead of the tab
+    after a field name, runs of spaces instead of tabs in answer rows, and trailing whitespace.
+    """
+    # Longest names first, so that "Type" is not taken for "Typ" followed by "e".
+    field_names = sorted(set(template.fields) | {"Typ", "Type"}, key=len, reverse=True)
+    lines = []
+    for line in block.split("\n"):
+        line = line.rstrip()
+        if line and "\t" not in line:
+            name = next((name for name in field_names if line.startswith(name)), None)
+            if name and SEPARATOR_PATTERN.match(line[len(name):]):
+                line = name + "\t" + SEPARATOR_PATTERN.sub("", line[len(name):], count=1)
+            elif name is None:
+                line = re.sub(r" {2,}", "\t", line)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _number(value):
+    value = value.strip()
+    return float(value) if NUMBER_PATTERN.match(value) else None
+
+
+def validate_olat_block(block, template):
+    """Returns the list of rule violations of one OLAT question block (empty if it is valid)."""
+    errors = []
+    fields = {}
+    answer_rows = []
+    in_answers = False
+    for line in block.split("\n"):
+        if not line.strip():
+            continue
+        name, tab, value = line.partition("\t")
+        if in_answers:
+            answer_rows.append(line.split("\t"))
+            continue
+        if not tab:
+            errors.append(f"Zeile ohne Tabulator: '{line[:60]}'")
+            continue
+        fields.setdefault("Typ" if name.strip() == "Type" else name.strip(), value.strip())
+        if name.strip() == "Points":
+            in_answers = True
+
+    for field in template.fields:
+        if not fields.get(field):
+            errors.append(f"Feld '{field}' fehlt")
+    if fields.get("Typ") and fields["Typ"].casefold() != template.type_name.casefold():
+        errors.append(f"Typ '{fields['Typ']}' statt '{template.type_name}'")
+    points = _number(fields.get("Points", ""))
+    if "Points" in fields and points is None:
+        errors.append(f"Points '{fields['Points']}' ist keine Zahl")
+    if errors:
+        return errors
+
+    if template.is_table:
+        return errors + _validate_table(answer_rows, points, template)
+
+    if len(answer_rows) != len(template.answer_markers):
+        errors.append(f"{len(answer_rows)} statt {len(template.answer_markers)} Antworten")
+    for row in answer_rows:
+        if len(row) != 2 or not row[1].strip():
+            errors.append(f"Antwortzeile nicht im Format 'Wert<Tab>Antwort': '{chr(9).join(row)[:60]}'")
+    if errors:
+        return errors
+
+    markers = [row[0].strip() for row in answer_rows]
+    if all(marker in ("+", "-") for marker in template.answer_markers):
+        if any(marker not in ("+", "-") for marker in markers):
+            errors.append("Antworten müssen mit '+' oder '-' beginnen")
+        if NUMBER_PATTERN.match(template.points) and points != float(template.points):
+            errors.append(f"Points {fields['Points']} statt {template.points}")
+        return errors
+
+    scores = [_number(marker) for marker in markers]
+    if None in scores:
+        return errors + ["Antworten müssen mit einer Punktzahl beginnen"]
+    correct = [score for score in scores if score > 0]
+    if len(correct) != template.correct_answers:
+        errors.append(f"{len(correct)} statt {template.correct_answers} richtige Antwort(en)")
+    elif abs(sum(correct) - points) > 1e-6:
+        errors.append(f"Points {fields['Points']} entsprechen nicht der Summe der richtigen Antworten ({sum(correct):g})")
+    return errors
+
+
+def _validate_table(rows, points, template):
+    limits = TABLE_LIMITS.get(template.type_name.casefold(), {"columns": (1, 99), "rows": (1, 99)})
+    if not rows or rows[0][0].strip():
+        return ["Kopfzeile der Tabelle (beginnt mit einem Tabulator) fehlt"]
+    columns = [cell for cell in rows[0][1:] if cell.strip()]
+    items = rows[1:]
+    errors = []
+    if not limits["columns"][0] <= len(columns) <= limits["columns"][1]:
+        errors.append(f"{len(columns)} Spalten, erlaubt sind {limits['columns'][0]} bis {limits['columns'][1]}")
+    if not limits["rows"][0] <= len(items) <= limits["rows"][1]:
+        errors.append(f"{len(items)} Zeilen, erlaubt sind {limits['rows'][0]} bis {limits['rows'][1]}")
+    for row in items:
+        values = [_number(cell) for cell in row[1:] if cell.strip()]
+        if not row[0].strip() or len(values) != len(columns) or None in values:
+            errors.append(f"Zeile passt nicht zur Kopfzeile: '{chr(9).join(row)[:60]}'")
+        elif sum(1 for value in values if value > 0) != 1:
+            errors.append(f"Zeile ohne genau eine richtige Zuordnung: '{row[0][:40]}'")
+    if not errors and points != len(items):
+        errors.append(f"Points {points:g} statt {len(items)} (Anzahl Zeilen)")
+    return errors
+
+
+def validate_fib_item(item):
+    """Returns the list of rule violations of one inline_fib item (empty if it is valid)."""
+    if not isinstance(item, dict):
+        return ["Eintrag ist kein JSON-Objekt"]
+    text = item.get("text")
+    blanks = item.get("blanks")
+    substitutes = item.get("wrong_substitutes")
+    if not isinstance(text, str) or not text.strip():
+        return ["'text' fehlt"]
+    if not isinstance(blanks, list) or not isinstance(substitutes, list):
+        return ["'blanks' oder 'wrong_substitutes' fehlt"]
+    errors = []
+    if len(blanks) != FIB_BLANKS or len(substitutes) != FIB_BLANKS:
+        errors.append(f"{len(blanks)} Lücken und {len(substitutes)} Ersatzwörter statt je {FIB_BLANKS}")
+    options = [str(option) for option in blanks + substitutes]
+    if len(set(options)) != len(options):
+        errors.append("Lücken und Ersatzwörter sind nicht eindeutig")
+    missing = [blank for blank in blanks if str(blank) not in text]
+    if missing:
+        errors.append(f"Lücken kommen im Text nicht vor: {', '.join(map(str, missing))}")
+    return errors
+
+
+def split_questions(msg_type, response):
+    """
+    Splits a raw response into its questions: OLAT blocks, with formatting slips fixed, or
+    inline_fib items. Returns None if the response cannot be split.
+    """
+    if msg_type == "inline_fib":
+        try:
+            data = json.loads(clean_json_string(response))
+        except json.JSONDecodeError:
+            return None
+        return data if isinstance(data, list) else [data]
+    template = olat_template(msg_type)
+    blocks = split_olat_blocks(response)
+    if not template or not blocks:
+        return None
+    return [normalize_olat_block(block, template) for block in blocks]
+
+
+def join_questions(msg_type, questions):
+    """Inverse of split_questions."""
+    if msg_type == "inline_fib":
+        return json.dumps(questions, ensure_ascii=False, indent=2)
+    return "\n\n".join(questions)
+
+
+def find_invalid(msg_type, questions):
+    """Returns {index: errors} for the questions that violate the rules of their type."""
+    if msg_type == "inline_fib":
+        results = (validate_fib_item(item) for item in questions)
+    else:
+        template = olat_template(msg_type)
+        results = (validate_olat_block(block, template) for block in questions)
+    return {index: errors for index, errors in enumerate(results) if errors}
+
+
+def repair_prompt(msg_type, count):
+    """Returns the prompt template of a follow-up request that corrects `count` invalid questions."""
+    return (
+        f"{read_prompt_from_md(msg_type)}\n\n"
+        "//repair\n"
+        f"- IMPORTANT: do NOT generate new questions. The user input contains {count} questions that violate "
+        "the format or the //rules, each preceded by its errors.\n"
+        f"- Return exactly these {count} questions, corrected, in the same order and in the same output format.\n"
+        "- Keep their content and language; change only what is needed to fix the listed errors.\n"
+        "- Output only the corrected questions, without the '# Frage' headings and the error lines."
+    )
+
+
+def repair_input(msg_type, questions, invalid):
+    """Lists the invalid questions with their errors, as the user input of the repair request."""
+    parts = []
+    for number, (index, errors) in enumerate(sorted(invalid.items()), start=1):
+        question = questions[index]
+        if msg_type == "inline_fib":
+            question = json.dumps(question, ensure_ascii=False, indent=2)
+        parts.append(f"# Frage {number}\nFehler: {'; '.join(errors)}\n{question}")
+    return "\n\n".join(parts)